@@ -0,0 +1,329 @@
+"""
+Aggregator of a federated fleet: one dashboard over several shard servers.
+
+The aggregator polls no agents and stores nothing. It follows every
+shard's /stream to keep a merged live snapshot, so /metrics and /stream
+are answered locally as on a single server. Queries over logged data
+(/csv_data, /query, /download_csv, /anomalies, /alerts, /agents, /schedule)
+are sent to all shards in parallel and their answers merged. A shard that
+fails to answer is left out and named in the X-Failed-Shards header.
+
+Start it with `lamn aggregator start`; the shards are listed under
+"federation" in ~/.lamn_config.json (see lamn/federation.py).
+"""
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+from lamn.config import agent_labels, load_settings
+from lamn.events import EventHub
+from lamn.federation import Federation, Shard, ShardFeed
+from lamn.prometheus import CONTENT_TYPE, agents_exposition
+from lamn.responses import ResponseCache
+from lamn.snapshot import LiveSnapshot, dumps
+
+# --- Setup Flask ---
+template_dir = os.path.join(os.path.dirname(__file__), "templates")
+app = Flask(__name__, template_folder=template_dir)
+app.logger.disabled = True
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+settings = load_settings()
+federation = Federation.from_settings(settings)
+shards = [Shard(name, url) for name, url in sorted(federation.shards.items())]
+
+# --- Merged live state ---
+live_metrics = LiveSnapshot()  # latest payload of every agent of every shard
+owners = {}  # ip -> name of the shard that reported it
+owners_lock = threading.Lock()
+events = EventHub()  # live updates for /stream clients
+responses = ResponseCache()  # serialized /metrics bodies
+pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(4, 2 * len(shards)), thread_name_prefix="lamn-fanout")
+
+CURSOR_ENTRIES = 1024  # /csv_data?since= cursors remembered per aggregator
+cursors = collections.OrderedDict()  # aggregator cursor -> {shard: shard cursor}
+cursors_lock = threading.Lock()
+next_cursor = 1
+
+def on_snapshot(shard, data):
+    """A shard (re)connected: replace everything it reported before."""
+    with owners_lock:
+        removed = [ip for ip, name in owners.items() if name == shard.name and ip not in data]
+        for ip in removed:
+            del owners[ip]
+        owners.update({ip: shard.name for ip in data})
+    snapshot = live_metrics.update_many(data, removed)
+    events.publish('snapshot', snapshot.body)
+
+def on_agent(shard, ip, data, raw):
+    with owners_lock:
+        owners[ip] = shard.name
+    live_metrics.update(ip, data)
+    events.publish('agent', raw)
+
+feeds = [ShardFeed(shard, on_snapshot, on_agent) for shard in shards]
+
+# --- Fan-out to the shards ---
+def fan_out(path, params=None, get=None):
+    """
+    GET path from every shard in parallel; params is a dict, or a function of
+    the shard returning one, and get(shard, params) optionally replaces the
+    plain GET. Returns ([(shard, response)], failed shard names).
+    """
+    def fetch(shard):
+        query = params(shard) if callable(params) else params
+        response = get(shard, query) if get else shard.get(path, query)
+        response.raise_for_status()
+        return response
+    futures = [(shard, pool.submit(fetch, shard)) for shard in shards]
+    answered, failed = [], []
+    for shard, future in futures:
+        try:
+            answered.append((shard, future.result()))
+        except Exception as e:
+            print(f"Shard {shard.name} failed on {path}: {e}")
+            failed.append(shard.name)
+    return answered, failed
+
+def merged(body, failed, mimetype='application/json', headers=None):
+    response = Response(body if isinstance(body, bytes) else dumps(body), mimetype=mimetype, headers=headers)
+    if failed:
+        response.headers['X-Failed-Shards'] = ','.join(failed)
+    return response
+
+def forwarded_args():
+    """Query arguments as sent by the viewer, with end pinned so every shard covers the same range."""
+    args = request.args.to_dict()
+    if any(key in args for key in ('start', 'span', 'resolution')) and 'end' not in args:
+        args['end'] = str(time.time())
+    return args
+
+# --- Flask Routes ---
+@app.route('/')
+def index():
+    return render_template('dashboard.html')
+
+@app.route('/plots')
+def plots():
+    return render_template('plots.html')
+
+@app.route('/hybrid')
+def hybrid():
+    return render_template('hybrid_plots.html')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latest metrics of every agent of every shard; tags are resolved by the shards."""
+    if request.args.get('tags'):
+        answered, failed = fan_out('/metrics', request.args.to_dict())
+        data = {}
+        for _, response in answered:
+            data.update(response.json())
+        return merged(data, failed)
+    snapshot = live_metrics.current
+    return responses.respond('metrics', snapshot.version, lambda: (snapshot.body, None))
+
+@app.route('/metrics/prom', methods=['GET'])
+def metrics_prom():
+    """Agent gauges of every shard and the state of the shard feeds, in the Prometheus text format."""
+    exposition = agents_exposition(live_metrics.current.data)
+    for shard in shards:
+        exposition.add('lamn_shard_up', shard.connected, {'shard': shard.name},
+                       help='1 while the shard\'s event stream is connected')
+    return Response(exposition.render(), content_type=CONTENT_TYPE)
+
+@app.route('/stream')
+def stream():
+    """Server-Sent Events merged from every shard's stream."""
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    body = events.stream(lambda: live_metrics.current.body, last_event_id)
+    return Response(stream_with_context(body), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/csv_data', methods=['GET'])
+def csv_data():
+    """/csv_data of every shard: rows merged by time, or recent samples merged per host."""
+    global next_cursor
+    args = forwarded_args()
+    since = request.args.get('since')
+    if since is not None:
+        # Every shard has its own cursor; hand out one cursor standing for all of them
+        try:
+            since = int(since)
+        except ValueError:
+            since = -1
+        with cursors_lock:
+            previous = cursors.get(since, {} if since == 0 else None)
+        if previous is None:
+            # Never handed out or forgotten; the pages then start over from 0
+            return jsonify({"error": f"unknown cursor {request.args['since']}"}), 400
+        def get_recent(shard, params):
+            response = shard.get('/csv_data', params)
+            if response.status_code == 400 and params['since']:
+                # The shard restarted and no longer knows its cursor: read its whole window again
+                response = shard.get('/csv_data', dict(params, since=0))
+            return response
+        answered, failed = fan_out('/csv_data', lambda shard: dict(args, since=previous.get(shard.name, 0)),
+                                   get_recent)
+        result = {"cursor": since, "capacity": None, "fields": [], "hosts": {}}
+        current = dict(previous)
+        for shard, response in answered:
+            data = response.json()
+            if 'error' in data:
+                failed.append(shard.name)
+                continue
+            current[shard.name] = data['cursor']
+            result['capacity'] = result['capacity'] or data['capacity']
+            result['fields'] = result['fields'] or data['fields']
+            result['hosts'].update(data['hosts'])
+        if current != previous or since not in cursors:
+            with cursors_lock:
+                result['cursor'] = next_cursor
+                cursors[next_cursor] = current
+                next_cursor += 1
+                while len(cursors) > CURSOR_ENTRIES:
+                    cursors.popitem(last=False)
+        return merged(result, failed)
+
+    answered, failed = fan_out('/csv_data', args)
+    rows, headers = [], {}
+    for shard, response in answered:
+        data = response.json()
+        if isinstance(data, dict):
+            failed.append(shard.name)
+            continue
+        rows.extend(data)
+        if 'X-Resolution' in response.headers:
+            headers['X-Resolution'] = response.headers['X-Resolution']
+    # Timestamps are 'YYYY-MM-DD HH:MM:SS', which sort as strings
+    rows.sort(key=lambda row: row['timestamp'])
+    if not headers:
+        rows = rows[-request.args.get('limit', 1000, type=int):]
+    return merged(rows, failed, headers=headers)
+
+@app.route('/query', methods=['GET'])
+def query():
+    """/query of every shard, hosts merged."""
+    args = forwarded_args()
+    answered, failed = fan_out('/query', args)
+    if request.args.get('format') == 'csv':
+        return merged(concat_csv(response.content for _, response in answered), failed, mimetype='text/csv', headers={
+            'Content-Disposition': 'attachment; filename=machine_metrics_query.csv'
+        })
+    result = None
+    for shard, response in answered:
+        data = response.json()
+        if result is None:
+            result = data
+        else:
+            result['hosts'].update(data['hosts'])
+            result['metrics'] = result['metrics'] or data['metrics']
+    if result is None:
+        return jsonify({"error": "no shard answered"}), 502
+    return merged(result, failed)
+
+def concat_csv(bodies):
+    """CSV bodies joined under the first one's header."""
+    parts, header = [], None
+    for body in bodies:
+        first, _, rest = body.partition(b'\n')
+        if header is None:
+            header = first
+            parts.append(body)
+        elif rest:
+            parts.append(rest)
+    return b''.join(part if part.endswith(b'\n') else part + b'\n' for part in parts if part)
+
+@app.route('/download_csv')
+def download_csv():
+    """Logged rows of every shard as one CSV, streamed one shard after the other."""
+    args = forwarded_args()
+    def rows():
+        header_sent = False
+        for shard in shards:
+            try:
+                with shard.get('/download_csv', args, stream=True) as response:
+                    response.raise_for_status()
+                    lines = response.iter_lines()
+                    header = next(lines, None)
+                    if header is None:
+                        continue
+                    if not header_sent:
+                        yield header + b'\n'
+                        header_sent = True
+                    for line in lines:
+                        yield line + b'\n'
+            except Exception as e:
+                print(f"Shard {shard.name} failed on /download_csv: {e}")
+    return Response(stream_with_context(rows()), mimetype='text/csv', headers={
+        'Content-Disposition': 'attachment; filename=machine_metrics.csv'
+    })
+
+def merged_lists(path, sort_key):
+    answered, failed = fan_out(path, request.args.to_dict())
+    items = []
+    for _, response in answered:
+        items.extend(response.json())
+    items.sort(key=sort_key)
+    return merged(items, failed)
+
+@app.route('/anomalies', methods=['GET'])
+def anomalies():
+    return merged_lists('/anomalies', lambda a: a['start'])
+
+@app.route('/alerts', methods=['GET'])
+def active_alerts():
+    return merged_lists('/alerts', lambda a: a['since'])
+
+@app.route('/agents', methods=['GET'])
+def agents():
+    """Agents of every shard, each with the shard polling it."""
+    answered, failed = fan_out('/agents')
+    seen = {}
+    for shard, response in answered:
+        data = response.json()
+        polled = set(data.get('polled') or ())
+        for agent in data['agents']:
+            if agent['ip'] in polled:
+                seen[agent['ip']] = dict(agent, shard=shard.name)
+            elif agent['ip'] not in seen:
+                seen[agent['ip']] = agent
+    tags = collections.Counter(label for agent in seen.values() for label in agent_labels(agent))
+    return merged({"agents": list(seen.values()), "tags": dict(sorted(tags.items()))}, failed)
+
+@app.route('/schedule', methods=['GET'])
+def schedule():
+    answered, failed = fan_out('/schedule')
+    result = {}
+    for shard, response in answered:
+        for ip, entry in response.json().items():
+            result[ip] = dict(entry, shard=shard.name)
+    return merged(result, failed)
+
+@app.route('/federation', methods=['GET'])
+def federation_status():
+    """Connection state of every shard's feed and the number of agents it reported."""
+    with owners_lock:
+        counts = collections.Counter(owners.values())
+    return jsonify({shard.name: dict(shard.status(), agents=counts.get(shard.name, 0)) for shard in shards})
+
+# --- Aggregator Entrypoint ---
+def start(port=8000):
+    if not shards:
+        raise SystemExit("No shards configured: add \"federation\": {\"shards\": {...}} to ~/.lamn_config.json")
+    for shard in shards:
+        print(f"Following shard {shard.name} at {shard.url}")
+    for feed in feeds:
+        feed.start()
+    print(f"View the federated dashboard at: http://localhost:{port}/")
+    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
+
+if __name__ == '__main__':
+    start()
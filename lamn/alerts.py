@@ -0,0 +1,428 @@
+"""
+Incremental alert rules evaluated on every logged sample.
+
+Each rule keeps a small state per host and updates it in constant
+(amortized) time per sample, so evaluation cost grows with the number of
+samples and never with how much history a rule looks at:
+
+- threshold: a metric above (or below) a level
+- rate: change per second of a metric over a sliding window
+- disk_full: a rolling linear regression of disk usage, firing when the
+  forecast says the disk fills up within a given number of hours
+
+Every rule can require its condition to hold for a duration ("for") and
+clears at a separate level ("clear") so a value hovering around the limit
+does not flap. Notifications are sent only when an alert fires or
+resolves (optionally repeated while it stays active), by a background
+thread that hands them to the configured sinks: log, file and webhook.
+"""
+import collections
+import json
+import math
+import queue
+import threading
+from datetime import datetime
+
+import requests
+
+REPEAT_INTERVAL = 0        # seconds between reminders of an active alert; 0 sends none
+FORECAST_WINDOW = 6 * 3600  # seconds of disk usage the regression is fitted on
+FORECAST_STEP = 60         # seconds between points kept for the regression
+FORECAST_MIN_SPAN = 1800   # seconds of history needed before forecasting
+WEBHOOK_TIMEOUT = 5
+
+DEFAULT_RULES = [
+    {"name": "disk_space", "type": "threshold", "metric": "disk_percent", "above": 95, "clear": 90},
+    {"name": "disk_full", "type": "disk_full", "metric": "disk_percent", "hours": 24},
+]
+DEFAULT_SINKS = [{"type": "log"}]
+
+
+# --- Rules ---
+
+class _Level:
+    """Hysteresis on a value: trips beyond `limit`, resets back past `clear`."""
+
+    def __init__(self, above=None, below=None, clear=None):
+        if (above is None) == (below is None):
+            raise ValueError("exactly one of 'above' and 'below' is required")
+        self.above = above is not None
+        self.limit = above if self.above else below
+        self.clear = self.limit if clear is None else clear
+
+    def check(self, value, firing):
+        level = self.clear if firing else self.limit
+        return value > level if self.above else value < level
+
+    def describe(self):
+        return f"{'>' if self.above else '<'} {self.limit:g}"
+
+
+class RuleState:
+    """Per host state of one rule."""
+
+    __slots__ = ('firing', 'pending_since', 'fired_at', 'notified_at', 'value', 'data')
+
+    def __init__(self):
+        self.firing = False
+        self.pending_since = None  # when the condition started to hold
+        self.fired_at = None
+        self.notified_at = None
+        self.value = None
+        self.data = None           # rule specific
+
+
+class Rule:
+    """
+    Base rule. Subclasses implement measure(state, ts, value), returning the
+    value the level is checked against, or None while they cannot tell yet.
+    """
+
+    def __init__(self, name, metric, level, duration=0, severity='warning'):
+        self.name = name
+        self.metric = metric
+        self.level = level
+        self.duration = duration
+        self.severity = severity
+
+    def measure(self, state, ts, value):
+        raise NotImplementedError
+
+    def update(self, state, ts, value):
+        """Feed one sample; returns the new firing state."""
+        measured = self.measure(state, ts, value)
+        if measured is None:
+            return state.firing
+        state.value = measured
+        if not self.level.check(measured, state.firing):
+            state.pending_since = None
+            return False
+        if state.pending_since is None:
+            state.pending_since = ts
+        return state.firing or ts - state.pending_since >= self.duration
+
+    def describe(self, state):
+        text = f"{self.metric} at {_format(state.value)}, limit {self.level.describe()}"
+        if self.duration:
+            text += f" for {self.duration:g}s"
+        return text
+
+
+class ThresholdRule(Rule):
+    def measure(self, state, ts, value):
+        return value
+
+
+class RateRule(Rule):
+    """Change per second of the metric between the oldest and newest sample in the window."""
+
+    def __init__(self, name, metric, level, window=60, **kwargs):
+        super().__init__(name, metric, level, **kwargs)
+        self.window = window
+
+    def measure(self, state, ts, value):
+        if state.data is None:
+            state.data = collections.deque()
+        points = state.data
+        points.append((ts, value))
+        # Keep one point at or beyond the window as the base of the rate
+        while len(points) > 2 and ts - points[1][0] >= self.window:
+            points.popleft()
+        first_ts, first_value = points[0]
+        if ts - first_ts < self.window / 2:
+            return None
+        return (value - first_value) / (ts - first_ts)
+
+    def describe(self, state):
+        text = f"{self.metric} changing {_format(state.value)}/s, limit {self.level.describe()}/s"
+        if self.duration:
+            text += f" for {self.duration:g}s"
+        return text
+
+
+class _Regression:
+    """Least squares line through a sliding window of points, kept as running sums."""
+
+    __slots__ = ('points', 'base', 'n', 'sx', 'sy', 'sxx', 'sxy', 'removed')
+
+    def __init__(self):
+        self.points = collections.deque()
+        self.base = None
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.removed = 0
+
+    def _add(self, x, y, sign):
+        self.n += sign
+        self.sx += sign * x
+        self.sy += sign * y
+        self.sxx += sign * x * x
+        self.sxy += sign * x * y
+
+    def add(self, t, y):
+        if self.base is None:
+            self.base = t
+        self.points.append((t, y))
+        self._add(t - self.base, y, 1)
+
+    def drop_before(self, t):
+        while self.points and self.points[0][0] < t:
+            old_t, old_y = self.points.popleft()
+            self._add(old_t - self.base, old_y, -1)
+            self.removed += 1
+        if self.removed >= len(self.points):
+            # Re-base on the oldest point and recompute, which keeps the sums
+            # accurate and costs O(1) per point on average
+            self.removed = 0
+            self.base = self.points[0][0] if self.points else None
+            self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+            for old_t, old_y in self.points:
+                self._add(old_t - self.base, old_y, 1)
+
+    def fit(self):
+        """(slope, intercept at the base time), or None with too few points."""
+        if self.n < 3:
+            return None
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if denominator <= 0:
+            return None
+        slope = (self.n * self.sxy - self.sx * self.sy) / denominator
+        return slope, (self.sy - slope * self.sx) / self.n
+
+
+class DiskFullRule(Rule):
+    """Fires when the fitted disk usage trend reaches `full` percent within `hours`."""
+
+    def __init__(self, name, metric, hours=24, clear=None, full=100.0,
+                 window=FORECAST_WINDOW, step=FORECAST_STEP, **kwargs):
+        level = _Level(below=hours, clear=hours * 1.25 if clear is None else clear)
+        super().__init__(name, metric, level, **kwargs)
+        self.full = full
+        self.window = window
+        self.step = step
+
+    def measure(self, state, ts, value):
+        if state.data is None:
+            state.data = _Regression()
+        regression = state.data
+        if regression.points and ts - regression.points[-1][0] < self.step:
+            return None
+        regression.add(ts, value)
+        regression.drop_before(ts - self.window)
+        if ts - regression.points[0][0] < FORECAST_MIN_SPAN:
+            return None
+        fit = regression.fit()
+        if fit is None:
+            return None
+        slope, intercept = fit
+        if slope <= 0:
+            return math.inf
+        now = intercept + slope * (ts - regression.base)
+        return max(0.0, (self.full - now) / slope / 3600)
+
+    def describe(self, state):
+        return f"{self.metric} forecast to reach {self.full:g}% in {_format(state.value)} hours"
+
+
+RULE_TYPES = {
+    'threshold': ThresholdRule,
+    'rate': RateRule,
+    'disk_full': DiskFullRule,
+}
+
+
+def build_rule(spec):
+    """Rule from its JSON settings."""
+    spec = dict(spec)
+    kind = spec.pop('type', 'threshold')
+    if kind not in RULE_TYPES:
+        raise ValueError(f"unknown alert rule type '{kind}'")
+    metric = spec.pop('metric')
+    name = spec.pop('name', f"{metric}_{kind}")
+    kwargs = {'duration': spec.pop('for', 0), 'severity': spec.pop('severity', 'warning')}
+    if kind == 'disk_full':
+        kwargs.update(spec)
+    else:
+        kwargs['level'] = _Level(spec.pop('above', None), spec.pop('below', None), spec.pop('clear', None))
+        kwargs.update(spec)
+    return RULE_TYPES[kind](name, metric, **kwargs)
+
+
+def _format(value):
+    if value is None:
+        return '?'
+    if isinstance(value, float) and math.isinf(value):
+        return 'inf'
+    return f"{value:.3g}" if abs(value) < 1000 else f"{value:.0f}"
+
+
+# --- Sinks ---
+
+class LogSink:
+    """Print alerts to the server log."""
+
+    def send(self, alert):
+        print(f"ALERT {alert['status'].upper()} [{alert['severity']}] "
+              f"{alert['hostname']} ({alert['ip']}): {alert['rule']} - {alert['message']}")
+
+
+class FileSink:
+    """Append alerts to a file, one JSON object per line."""
+
+    def __init__(self, path='logs/alerts.log'):
+        self.path = path
+
+    def send(self, alert):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(alert) + '\n')
+
+
+class WebhookSink:
+    """POST every alert as JSON to a URL."""
+
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.headers = headers or {}
+
+    def send(self, alert):
+        requests.post(self.url, json=alert, headers=self.headers, timeout=self.timeout).raise_for_status()
+
+
+SINK_TYPES = {
+    'log': LogSink,
+    'file': FileSink,
+    'webhook': WebhookSink,
+}
+
+
+def build_sink(spec):
+    spec = dict(spec)
+    kind = spec.pop('type', 'log')
+    if kind not in SINK_TYPES:
+        raise ValueError(f"unknown alert sink type '{kind}'")
+    return SINK_TYPES[kind](**spec)
+
+
+class Notifier:
+    """Background thread delivering alerts to the sinks, so a slow webhook never stalls polling."""
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def put(self, alert):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lamn-alerts", daemon=True)
+                self._thread.start()
+        self._queue.put(alert)
+
+    def _run(self):
+        while True:
+            alert = self._queue.get()
+            for sink in self.sinks:
+                try:
+                    sink.send(alert)
+                except Exception as e:
+                    print(f"Error sending alert to {type(sink).__name__}: {e}")
+
+
+# --- Engine ---
+
+class AlertEngine:
+    """
+    Evaluates every rule on every sample of every host.
+
+    observe() is called with each host's new samples; alerts are deduplicated
+    per (host, rule) and only fire, repeat or resolve notifications are sent.
+    """
+
+    def __init__(self, rules, sinks, repeat=REPEAT_INTERVAL):
+        self.rules = list(rules)
+        self.notifier = Notifier(sinks)
+        self.repeat = repeat
+        self._by_metric = collections.defaultdict(list)
+        for rule in self.rules:
+            self._by_metric[rule.metric].append(rule)
+        self._states = {}   # (ip, rule name) -> RuleState
+        self._hostnames = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Engine for the "alerts" section of ~/.lamn_config.json."""
+        config = settings.get('alerts') or {}
+        rules = [build_rule(spec) for spec in config.get('rules', DEFAULT_RULES)]
+        sinks = [build_sink(spec) for spec in config.get('sinks', DEFAULT_SINKS)]
+        return cls(rules, sinks, repeat=config.get('repeat', REPEAT_INTERVAL))
+
+    def observe(self, ip, hostname, timestamps, samples):
+        """
+        Feed one host's samples in time order; samples are dicts of metric
+        values, one per timestamp.
+        """
+        with self._lock:
+            self._hostnames[ip] = hostname
+            for ts, sample in zip(timestamps, samples):
+                for metric, rules in self._by_metric.items():
+                    value = sample.get(metric)
+                    if value is None:
+                        continue
+                    for rule in rules:
+                        self._update(ip, rule, ts, float(value))
+
+    def _update(self, ip, rule, ts, value):
+        key = (ip, rule.name)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = RuleState()
+        firing = rule.update(state, ts, value)
+        if firing and not state.firing:
+            state.firing, state.fired_at, state.notified_at = True, ts, ts
+            self._notify(ip, rule, state, 'firing', ts)
+        elif not firing and state.firing:
+            state.firing = False
+            self._notify(ip, rule, state, 'resolved', ts)
+        elif firing and self.repeat and ts - state.notified_at >= self.repeat:
+            state.notified_at = ts
+            self._notify(ip, rule, state, 'firing', ts)
+
+    def _alert(self, ip, rule, state, status, ts):
+        return {
+            'ip': ip,
+            'hostname': self._hostnames.get(ip, ip),
+            'rule': rule.name,
+            'metric': rule.metric,
+            'severity': rule.severity,
+            'status': status,
+            'value': None if state.value is None or math.isinf(state.value) else state.value,
+            'message': rule.describe(state),
+            'since': state.fired_at,
+            'timestamp': ts,
+            'time': datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+    def _notify(self, ip, rule, state, status, ts):
+        self.notifier.put(self._alert(ip, rule, state, status, ts))
+
+    def active(self):
+        """Alerts currently firing, oldest first."""
+        rules = {rule.name: rule for rule in self.rules}
+        with self._lock:
+            alerts = [self._alert(ip, rules[name], state, 'firing', state.fired_at)
+                      for (ip, name), state in self._states.items()
+                      if state.firing and name in rules]
+        return sorted(alerts, key=lambda alert: alert['since'])
+
+    def remove(self, ip):
+        """Forget a host's rule state, e.g. when the agent is removed."""
+        with self._lock:
+            self._hostnames.pop(ip, None)
+            for key in [key for key in self._states if key[0] == ip]:
+                del self._states[key]
@@ -0,0 +1,191 @@
+"""
+Streaming anomaly detection for every host and metric.
+
+Each series (one metric of one host) keeps an exponentially weighted
+mean and variance, updated as samples arrive; a sample whose z-score
+against them exceeds the threshold is an outlier. The state of the whole
+fleet lives in a few (hosts x metrics) numpy arrays and a batch of polls
+is processed for all its hosts at once: each step through the samples is
+one array operation over every host and metric, and memory is constant
+per series.
+
+The weight of a sample depends on the time since the previous one, so
+agents sending one sample per second and agents polled every few minutes
+are averaged over the same time span. Outliers are clipped to the
+threshold before they move the mean and do not touch the variance, so a
+single spike barely shifts the estimate while a lasting change (a runaway
+job, a process suddenly eating memory) stays flagged for several minutes.
+Consecutive outliers of a series are reported as one anomaly with its
+start, end and peak.
+"""
+import collections
+import threading
+
+import numpy as np
+
+TIME_CONSTANT = 600      # seconds the moving estimate effectively averages over
+THRESHOLD = 4.0          # z-score beyond which a sample is an outlier
+WARMUP = 120             # samples of a series before it is checked
+MIN_DEVIATION = 0.5      # floor of the standard deviation, in the metric's units
+RELATIVE_DEVIATION = 0.02  # and as a fraction of the mean, so flat series do not flag noise
+MAX_EVENTS = 1000        # anomalies kept for /anomalies
+
+
+class AnomalyDetector:
+    """EWMA z-score detector over a fixed list of metrics; thread-safe."""
+
+    def __init__(self, metrics, time_constant=TIME_CONSTANT, threshold=THRESHOLD, warmup=WARMUP, max_events=MAX_EVENTS):
+        self.metrics = list(metrics)
+        self.time_constant = time_constant
+        self.threshold = threshold
+        self.warmup = warmup
+        self.events = collections.deque(maxlen=max_events)
+        self._rows = {}   # ip -> row of the state arrays
+        self._free = []   # rows of removed hosts, reused before the arrays grow
+        self._mean = np.zeros((0, len(self.metrics)))
+        self._var = np.zeros((0, len(self.metrics)))
+        self._count = np.zeros((0, len(self.metrics)), dtype=np.int64)
+        self._last = np.full(0, np.nan)   # timestamp of each host's previous sample
+        self._open_count = np.zeros(0, dtype=np.int64)   # open anomalies of each host
+        self._open = {}   # (ip, metric index) -> event of a series currently anomalous
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, metrics, settings):
+        """Detector tuned by the "anomaly" section of ~/.lamn_config.json."""
+        config = settings.get('anomaly') or {}
+        return cls(metrics,
+                   time_constant=config.get('time_constant', TIME_CONSTANT),
+                   threshold=config.get('threshold', THRESHOLD),
+                   warmup=config.get('warmup', WARMUP))
+
+    @property
+    def series(self):
+        return len(self._rows) * len(self.metrics)
+
+    def _row(self, ip):
+        row = self._rows.get(ip)
+        if row is None and self._free:
+            row = self._rows[ip] = self._free.pop()
+            self._mean[row] = self._var[row] = self._count[row] = self._open_count[row] = 0
+            self._last[row] = np.nan
+        elif row is None:
+            row = self._rows[ip] = len(self._rows)
+            if row >= len(self._mean):
+                # Grow by doubling so adding hosts stays cheap
+                size = max(16, 2 * len(self._mean))
+                for name in ('_mean', '_var', '_count', '_last', '_open_count'):
+                    old = getattr(self, name)
+                    new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+                    new[:len(old)] = old
+                    setattr(self, name, new)
+                self._last[row:] = np.nan
+        return row
+
+    def observe(self, ip, hostname, timestamps, samples):
+        """Feed one host's samples in time order; samples are dicts of metric values."""
+        self.observe_many([(ip, hostname, timestamps, samples)])
+
+    def observe_many(self, batch):
+        """
+        Feed the samples of many hosts, as (ip, hostname, timestamps, samples)
+        tuples with each host's samples in time order. All hosts step through
+        their samples together: one array operation per step updates every
+        metric of every host that has a sample at that step.
+        """
+        hosts = {}
+        for ip, hostname, timestamps, samples in batch:
+            if len(samples):
+                entry = hosts.setdefault(ip, [hostname, [], []])
+                entry[0] = hostname
+                entry[1].extend(timestamps)
+                entry[2].extend(samples)
+        if not hosts:
+            return
+        ips = list(hosts)
+        names = [hosts[ip][0] for ip in ips]
+        lengths = np.array([len(hosts[ip][1]) for ip in ips])
+        # (hosts x steps) timestamps and (hosts x steps x metrics) values, NaN-padded
+        times = np.full((len(ips), lengths.max()), np.nan)
+        data = np.full(times.shape + (len(self.metrics),), np.nan)
+        for h, ip in enumerate(ips):
+            _, timestamps, samples = hosts[ip]
+            times[h, :len(timestamps)] = timestamps
+            data[h, :len(samples)] = np.array([[sample.get(m) for m in self.metrics] for sample in samples],
+                                              dtype=float)
+        with self._lock:
+            rows = np.array([self._row(ip) for ip in ips])
+            for k in range(times.shape[1]):
+                active = np.flatnonzero(lengths > k)
+                row = rows[active]
+                ts, values = times[active, k], data[active, k]
+                mean, var, count, last = self._mean[row], self._var[row], self._count[row], self._last[row]
+                elapsed = np.maximum(np.nan_to_num(ts - last), 0.0)
+                weight = np.where(np.isnan(last), 1.0, -np.expm1(-elapsed / self.time_constant))
+                valid = ~np.isnan(values)
+                std = np.maximum(np.sqrt(var), np.maximum(MIN_DEVIATION, RELATIVE_DEVIATION * np.abs(mean)))
+                z = (values - mean) / std
+                checked = valid & (count >= self.warmup)
+                outlier = checked & (np.abs(z) > self.threshold)
+                # Only hosts with an outlier or an anomaly of their own still open are recorded
+                for i in np.flatnonzero(outlier.any(axis=1) | (self._open_count[row] > 0)):
+                    h = active[i]
+                    self._record(row[i], ips[h], names[h], float(ts[i]), values[i], mean[i], z[i],
+                                 outlier[i], checked[i])
+
+                # Clip checked samples to the threshold, then update the estimate;
+                # during warm-up the weight starts at 1/n, i.e. a plain average
+                limit = self.threshold * std
+                clipped = np.where(checked, np.clip(values, mean - limit, mean + limit), values)
+                alpha = np.maximum(weight[:, None], 1.0 / (count + 1))
+                diff = np.where(valid, clipped - mean, 0.0)
+                step = alpha * diff
+                self._mean[row] = mean + step
+                self._var[row] = np.where(valid & ~outlier, (1 - alpha) * (var + diff * step), var)
+                self._count[row] = count + valid
+                self._last[row] = ts
+
+    def _record(self, row, ip, hostname, ts, values, mean, z, outlier, checked):
+        for i in np.flatnonzero(outlier | checked):
+            key = (ip, int(i))
+            event = self._open.get(key)
+            if not outlier[i]:
+                if event is not None:
+                    event['active'] = False
+                    del self._open[key]
+                    self._open_count[row] -= 1
+                continue
+            if event is None:
+                event = self._open[key] = {
+                    'id': self._next_id, 'ip': ip, 'hostname': hostname, 'metric': self.metrics[i],
+                    'start': ts, 'end': ts, 'samples': 0, 'active': True,
+                    'value': None, 'expected': None, 'z': 0.0
+                }
+                self._next_id += 1
+                self._open_count[row] += 1
+                self.events.append(event)
+            event['end'] = ts
+            event['samples'] += 1
+            if abs(z[i]) >= abs(event['z']):
+                event['value'] = float(values[i])
+                event['expected'] = float(mean[i])
+                event['z'] = round(float(z[i]), 2)
+
+    def remove(self, ip):
+        """Forget a host's state, e.g. when the agent is removed; its open anomalies end."""
+        with self._lock:
+            row = self._rows.pop(ip, None)
+            if row is not None:
+                self._free.append(row)
+            for key in [key for key in self._open if key[0] == ip]:
+                self._open.pop(key)['active'] = False
+
+    def anomalies(self, start=None, hosts=None, metrics=None, active=False):
+        """Copies of the recorded anomalies ending at or after start, oldest first."""
+        with self._lock:
+            return [dict(event) for event in self.events
+                    if (start is None or event['end'] >= start)
+                    and (hosts is None or event['ip'] in hosts or event['hostname'] in hosts)
+                    and (metrics is None or event['metric'] in metrics)
+                    and (not active or event['active'])]
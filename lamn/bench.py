@@ -0,0 +1,511 @@
+"""
+Load benchmark of the monitoring server against a simulated fleet.
+
+`lamn bench server --agents 10,100,1000` runs, for each fleet size, a
+fresh server process that polls that many fake agents with the server's own
+code: the asyncio poller, handle_poll_results (snapshot, alerts, anomaly
+detection, recent window) and the batch writer into a temporary store. It
+reports the poll-cycle time, the rows ingested per second, /csv_data
+latencies and the server's memory, and can write everything as JSON to
+diff between versions.
+
+All fake agents are served by one asyncio HTTP stub in a separate process,
+so they do not compete with the server for the GIL. Each agent has its own
+loopback address (127.1.x.y, up to 65535 agents), which Linux routes to the
+stub without any setup. Agents answer /metrics with a payload shaped like
+lamn/client.py's and /metrics/history with a fixed number of per-second
+samples per poll, on a clock that starts in the past so that the last cycle
+ends at the present. Latency, jitter, failure rate and payload size are
+configurable.
+
+Each fleet size runs with HOME and the working directory set to a temporary
+directory holding a copy of ~/.lamn_config.json, so neither ~/.agents.json
+nor the real metric store is touched.
+
+`lamn bench client` measures the observer overhead on the machine it runs
+on instead: every collector of lamn/client.py is called repeatedly and
+timed on its own, with wall-clock p50/p99, CPU time (all threads of the
+process, so the disk probe pool counts, and the child processes py-cpuinfo
+starts) and the memory Python allocates per call, measured in a separate
+tracemalloc pass so that tracing does not inflate the timings. The full
+per-second sample gives the overhead budget: CPU time per second of
+sampling, in percent of one core.
+"""
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import psutil
+
+from lamn.config import load_settings
+
+AGENTS = [10, 100, 1000]
+CYCLES = 5
+INTERVAL = 0           # seconds between the starts of two cycles; 0 polls back to back
+HISTORY = 150          # samples returned per poll, the server's POLL_INTERVAL at one per second
+MAX_AGENTS = 65535
+STUB_TIMEOUT = 10      # seconds for the fake fleet to start listening
+CLIENT_ITERATIONS = 200  # timed calls per client collector
+MEMORY_ITERATIONS = 20   # calls per client collector traced for memory
+CLIENT_BUDGET = 10       # seconds per collector and pass; slow collectors get fewer calls
+MIN_CALLS = 5
+
+# /csv_data requests timed after every cycle: (name, query)
+CSV_QUERIES = [
+    ('limit', 'limit=1000'),
+    ('span', 'span=3600'),
+    ('since', 'since=0'),
+]
+
+
+def agent_ip(n):
+    """Loopback address of fake agent n, counting from 1."""
+    return f"127.1.{n >> 8}.{n & 255}"
+
+
+def summarize(values):
+    """mean, p50, p95 and max of a list of numbers."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+    return {"mean": sum(ordered) / len(ordered), "p50": percentile(0.5),
+            "p95": percentile(0.95), "max": ordered[-1]}
+
+
+def raise_fd_limit(needed):
+    """Raise the soft open-file limit towards needed; every agent holds a keep-alive connection."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+# --- Fake agents ---
+
+class FakeAgent:
+    """One simulated agent: a /metrics payload and a per-second sample history."""
+
+    def __init__(self, n, fields, clock, history, payload_bytes, rng):
+        self.host = f"bench-{n:05d}"
+        self.fields = fields
+        self.clock = clock        # timestamp of the agent's next sample
+        self.history = history
+        self.rng = rng
+        self.phase = rng.uniform(0, 2 * math.pi)
+        self.metrics = self._payload(payload_bytes)
+
+    def _payload(self, payload_bytes):
+        disk = {"device": "/dev/nvme0n1p1", "mountpoint": "/", "fstype": "ext4",
+                "total": 1 << 40, "used": 1 << 39, "free": 1 << 39, "percent_used": 50.0}
+        metrics = {
+            "host": self.host, "cpu": 0, "memory": 0, "gpu": None, "gpus": [],
+            "disk_total": "1.00 TB", "disk_used": "512.00 GB", "disk_free": "512.00 GB",
+            "disk_percent_used": 50.0, "timestamp": None, "spec_version": "bench",
+            "io": {"disks": {"nvme0n1": {"read_bps": 0.0, "write_bps": 0.0, "read_iops": 0.0, "write_iops": 0.0}},
+                   "nics": {"eth0": {"rx_bps": 0.0, "tx_bps": 0.0, "rx_pps": 0.0, "tx_pps": 0.0}}},
+            "specs": {
+                "cpu": "Simulated CPU", "gpu": "No GPU", "gpus": [], "ram": 256 << 30,
+                "disks": [disk],
+                "disk_summary": {"total_space": 1 << 40, "total_used": 1 << 39, "total_free": 1 << 39,
+                                 "percent_used": 50.0, "total_space_human": "1.00 TB",
+                                 "total_used_human": "512.00 GB", "total_free_human": "512.00 GB",
+                                 "stale_mounts": []},
+                "connectivity": {"eth0": {"addresses": ["10.0.0.1"], "speed": 10000}},
+                "os": {"system": "Linux", "release": "bench", "version": "", "platform": "Linux-bench"},
+                "version": "bench"
+            }
+        }
+        for field in ('disk_read_bps', 'disk_write_bps', 'disk_iops', 'net_rx_bps', 'net_tx_bps', 'net_pps'):
+            metrics[field] = 0.0
+        # Pad with more mounts until the payload reaches the requested size
+        while len(json.dumps(metrics)) < payload_bytes:
+            mount = dict(disk, device=f"/dev/sd{len(metrics['specs']['disks'])}",
+                         mountpoint=f"/data/{len(metrics['specs']['disks'])}")
+            metrics['specs']['disks'].append(mount)
+        return metrics
+
+    def value(self, ts, scale=100):
+        return round(scale * (0.5 + 0.4 * math.sin(ts / 300 + self.phase)) + self.rng.uniform(-2, 2), 1)
+
+    def current(self):
+        now = time.time()
+        metrics = dict(self.metrics, cpu=self.value(now), memory=self.value(now + 100),
+                       timestamp=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)))
+        return json.dumps(metrics).encode()
+
+    def samples(self, since):
+        """The next `history` samples; since, when given, moves the clock past it."""
+        if since is not None:
+            self.clock = max(self.clock, math.floor(since) + 1)
+        times = [self.clock + i for i in range(self.history)]
+        self.clock += self.history
+        columns = {"timestamp": times}
+        for i, field in enumerate(self.fields):
+            columns[field] = [self.value(ts + 60 * i) for ts in times]
+        return json.dumps({"host": self.host, "interval": 1.0, "fields": self.fields,
+                           "samples": columns}).encode()
+
+
+class FakeFleet:
+    """Asyncio HTTP/1.1 stub answering for every fake agent, told apart by the address connected to."""
+
+    def __init__(self, agents, history, clock, latency=0, jitter=0, failure_rate=0,
+                 payload_bytes=0, seed=0):
+        from lamn.client import HISTORY_FIELDS
+        rng = random.Random(seed)
+        self.agents = {agent_ip(n): FakeAgent(n, list(HISTORY_FIELDS), clock, history, payload_bytes, rng)
+                       for n in range(1, agents + 1)}
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.failure_rate = failure_rate
+        self.rng = rng
+
+    @property
+    def payload_bytes(self):
+        agent = next(iter(self.agents.values()))
+        return len(agent.current())
+
+    async def handle(self, reader, writer):
+        agent = self.agents.get(writer.get_extra_info('sockname')[0])
+        try:
+            while agent is not None:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                target = request_line.split()[1].decode('latin-1')
+                delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.rng.random() < self.failure_rate:
+                    status, body = "500 INTERNAL SERVER ERROR", b'{"error": "simulated failure"}'
+                elif target.startswith('/metrics/history'):
+                    since = None
+                    for pair in target.partition('?')[2].split('&'):
+                        name, _, value = pair.partition('=')
+                        if name == 'since':
+                            since = float(value)
+                    status, body = "200 OK", agent.samples(since)
+                elif target == '/metrics':
+                    status, body = "200 OK", agent.current()
+                else:
+                    status, body = "404 NOT FOUND", b'{}'
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def serve(self, sock):
+        async def main():
+            server = await asyncio.start_server(self.handle, sock=sock, backlog=min(len(self.agents), 4096))
+            async with server:
+                await server.serve_forever()
+        asyncio.run(main())
+
+
+def run_fleet(options, clock, sock, ready):
+    raise_fd_limit(options['agents'] + 256)
+    fleet = FakeFleet(options['agents'], options['history'], clock, options['latency'],
+                      options['jitter'], options['failure_rate'], options['payload_bytes'], options['seed'])
+    ready.send(fleet.payload_bytes)
+    fleet.serve(sock)
+
+
+# --- One fleet size, in its own server process ---
+
+def run_server(options):
+    """Poll a fake fleet with the server's code; returns the result dict."""
+    agents = options['agents']
+    raise_fd_limit(agents + 256)
+    clock = math.floor(time.time()) - options['cycles'] * options['history']
+
+    # Any port on every address: the agents' addresses are all of 127.1.0.0/16
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', 0))
+    port = sock.getsockname()[1]
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    fleet = multiprocessing.Process(target=run_fleet, args=(options, clock, sock, sender), daemon=True)
+    fleet.start()
+    sock.close()
+    if not receiver.poll(STUB_TIMEOUT + agents / 1000):
+        raise RuntimeError("the fake fleet did not start")
+    payload_bytes = receiver.recv()
+
+    from lamn import server
+    server.poller.port = port
+    client = server.app.test_client()
+    process = psutil.Process()
+    rss_start = process.memory_info().rss
+    rss_peak = rss_start
+    cpu_start = sum(process.cpu_times()[:2])
+
+    ips = [agent_ip(n) for n in range(1, agents + 1)]
+    cycles, failed = [], 0
+    queries = {name: [] for name, _ in CSV_QUERIES}
+    started = time.monotonic()
+    for cycle in range(options['cycles']):
+        cycle_started = time.monotonic()
+        results = server.poll_agents(ips)
+        cycles.append(time.monotonic() - cycle_started)
+        failed += sum(1 for result in results if not result.ok)
+        for name, query in CSV_QUERIES:
+            # A query string of its own per cycle, so the response cache never answers
+            query_started = time.perf_counter()
+            client.get(f"/csv_data?{query}&bench={cycle}")
+            queries[name].append(time.perf_counter() - query_started)
+        rss_peak = max(rss_peak, process.memory_info().rss)
+        time.sleep(max(0, cycle_started + options['interval'] - time.monotonic()))
+    polled = time.monotonic() - started
+    server.store_writer.stop(timeout=None)
+    elapsed = time.monotonic() - started
+    rss_peak = max(rss_peak, process.memory_info().rss)
+
+    rows = server.store_writer.rows_written
+    write_time = server.stats.histogram('store.write').total
+    fleet.terminate()
+    return {
+        "agents": agents,
+        "cycles": options['cycles'],
+        "payload_bytes": payload_bytes,
+        "samples_per_poll": options['history'],
+        "storage": server.store.kind,
+        "poll_cycle_seconds": summarize(cycles),
+        "poll_seconds": server.stats.histogram('poll').summary(),
+        "polls": agents * options['cycles'],
+        "polls_failed": failed,
+        "rows_written": rows,
+        "ingest_rows_per_second": rows / elapsed if elapsed else None,
+        "poll_rows_per_second": rows / polled if polled else None,
+        "write_rows_per_second": rows / write_time if write_time else None,
+        "writer_drain_seconds": elapsed - polled,
+        "csv_data_seconds": {name: summarize(times) for name, times in queries.items()},
+        "rss_bytes": {"start": rss_start, "peak": rss_peak, "end": process.memory_info().rss},
+        "cpu_seconds": sum(process.cpu_times()[:2]) - cpu_start
+    }
+
+
+def run_size(options, keep=False):
+    """Run one fleet size in a fresh interpreter, isolated in a temporary HOME."""
+    workdir = tempfile.mkdtemp(prefix=f"lamn-bench-{options['agents']}-")
+    try:
+        settings = load_settings()
+        settings.pop('storage_path', None)
+        if options.get('storage'):
+            settings['storage'] = options['storage']
+        with open(os.path.join(workdir, '.lamn_config.json'), 'w') as f:
+            json.dump(settings, f)
+        result_path = os.path.join(workdir, 'result.json')
+        log_path = os.path.join(workdir, 'server.log')
+        env = dict(os.environ, HOME=workdir)
+        with open(log_path, 'w') as log:
+            completed = subprocess.run([sys.executable, '-m', 'lamn.bench', json.dumps(options), result_path],
+                                       cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if completed.returncode != 0 or not os.path.exists(result_path):
+            with open(log_path) as log:
+                tail = log.read()[-2000:]
+            raise RuntimeError(f"benchmark of {options['agents']} agents failed:\n{tail}")
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        if keep:
+            print(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def benchmark(agents=AGENTS, cycles=CYCLES, interval=INTERVAL, history=HISTORY, latency=0, jitter=0,
+              failure_rate=0, payload_bytes=0, storage=None, seed=0, keep=False, report=print):
+    """Benchmark every fleet size in agents; returns the JSON-serializable report."""
+    results = []
+    for size in agents:
+        if not 1 <= size <= MAX_AGENTS:
+            raise ValueError(f"fleet size must be between 1 and {MAX_AGENTS}")
+        options = {"agents": size, "cycles": cycles, "interval": interval, "history": history,
+                   "latency": latency, "jitter": jitter, "failure_rate": failure_rate,
+                   "payload_bytes": payload_bytes, "storage": storage, "seed": seed}
+        result = run_size(options, keep)
+        results.append(result)
+        if report:
+            report(format_result(result))
+    return {
+        "benchmark": "server",
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {"cycles": cycles, "interval": interval, "samples_per_poll": history,
+                    "latency_ms": latency, "jitter_ms": jitter, "failure_rate": failure_rate,
+                    "payload_bytes": payload_bytes, "storage": storage, "seed": seed},
+        "results": results
+    }
+
+
+def format_result(result):
+    cycle = result['poll_cycle_seconds']
+    csv = result['csv_data_seconds']
+    return (f"{result['agents']:>6} agents  cycle p50 {cycle['p50']:.3f}s max {cycle['max']:.3f}s  "
+            f"failed {result['polls_failed']}/{result['polls']}  "
+            f"ingest {result['ingest_rows_per_second']:,.0f} rows/s (writer {result['write_rows_per_second'] or 0:,.0f})  "
+            f"/csv_data p50 limit {csv['limit']['p50'] * 1000:.0f}ms span {csv['span']['p50'] * 1000:.0f}ms "
+            f"since {csv['since']['p50'] * 1000:.0f}ms  "
+            f"RSS peak {result['rss_bytes']['peak'] / 2**20:.0f} MB")
+
+
+# --- Client collectors ---
+
+def client_collectors():
+    """(name, function) of every collector timed by `lamn bench client`."""
+    from lamn import client
+    metrics = client.get_metrics(cpu_interval=None)
+    sampler = client.MetricsSampler()
+    def get_specs_cold():
+        client.spec_cache.invalidate()
+        return client.get_specs()
+    return [
+        ('sample', sampler.sample),
+        ('get_metrics', lambda: client.get_metrics(cpu_interval=None)),
+        ('get_specs', client.get_specs),
+        ('get_specs_cold', get_specs_cold),
+        ('cpuinfo', client.cpu_model),
+        ('disk_partitions', client.collect_disks),
+        ('nic_enumeration', client.collect_connectivity),
+        ('io_rates', client.io_rates.sample),
+        ('gpu_probe', client.gpu_monitor.gpus),
+        ('json_serialize', lambda: json.dumps(metrics).encode()),
+    ]
+
+
+def cpu_time():
+    """CPU time of this process and of its finished children."""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+def calls(iterations, budget):
+    """Call numbers up to iterations, stopping once budget seconds have passed (after MIN_CALLS)."""
+    deadline = time.monotonic() + budget
+    for i in range(iterations):
+        if i >= MIN_CALLS and time.monotonic() >= deadline:
+            return
+        yield i
+
+
+def time_collector(function, iterations=CLIENT_ITERATIONS, memory_iterations=MEMORY_ITERATIONS,
+                   budget=CLIENT_BUDGET):
+    """Wall and CPU time of each call, and memory allocated per call in a traced pass."""
+    first_started = time.perf_counter()
+    function()
+    first = time.perf_counter() - first_started
+
+    wall, cpu = [], []
+    for _ in calls(iterations, budget):
+        cpu_started = cpu_time()
+        started = time.perf_counter()
+        function()
+        wall.append(time.perf_counter() - started)
+        cpu.append(cpu_time() - cpu_started)
+
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in calls(memory_iterations, budget):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            result = function()
+            current, peak = tracemalloc.get_traced_memory()
+            del result
+            peaks.append(peak - before)
+            retained.append(tracemalloc.get_traced_memory()[0] - before)
+    finally:
+        tracemalloc.stop()
+
+    def seconds(values):
+        ordered = sorted(values)
+        return {"mean": sum(ordered) / len(ordered),
+                "p50": ordered[int(math.ceil(0.5 * len(ordered))) - 1],
+                "p99": ordered[int(math.ceil(0.99 * len(ordered))) - 1],
+                "max": ordered[-1]}
+    return {
+        "calls": len(wall),
+        "first_call_seconds": first,
+        "wall_seconds": seconds(wall),
+        "cpu_seconds": seconds(cpu),
+        "allocated_bytes": {"mean": sum(peaks) / len(peaks), "max": max(peaks)},
+        "retained_bytes": {"mean": sum(retained) / len(retained)}
+    }
+
+
+def benchmark_client(iterations=CLIENT_ITERATIONS, memory_iterations=MEMORY_ITERATIONS, budget=CLIENT_BUDGET,
+                     report=print):
+    """Time every client collector; returns the JSON-serializable report."""
+    from lamn import client
+    if iterations < 1 or memory_iterations < 1:
+        raise ValueError("iterations must be at least 1")
+    process = psutil.Process()
+    # Prime the non-blocking CPU reading, as the sampler thread does
+    psutil.cpu_percent(interval=None)
+    collectors = {}
+    for name, function in client_collectors():
+        collectors[name] = result = time_collector(function, iterations, memory_iterations, budget)
+        if report:
+            report(format_collector(name, result))
+    sample = collectors['sample']
+    overhead = {
+        "sample_interval": client.SAMPLE_INTERVAL,
+        "cpu_percent_p50": 100 * sample['cpu_seconds']['p50'] / client.SAMPLE_INTERVAL,
+        "cpu_percent_p99": 100 * sample['cpu_seconds']['p99'] / client.SAMPLE_INTERVAL,
+        "rss_bytes": process.memory_info().rss
+    }
+    if report:
+        report(f"Overhead at one sample every {client.SAMPLE_INTERVAL:g}s: "
+               f"{overhead['cpu_percent_p50']:.2f}% of one core (p99 {overhead['cpu_percent_p99']:.2f}%), "
+               f"RSS {overhead['rss_bytes'] / 2**20:.0f} MB")
+    return {
+        "benchmark": "client",
+        "time": time.time(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "gpu_backend": type(client.gpu_monitor.backend).__name__,
+        "spec_version": client.spec_cache.version,
+        "options": {"iterations": iterations, "memory_iterations": memory_iterations, "budget": budget},
+        "collectors": collectors,
+        "overhead": overhead
+    }
+
+
+def format_collector(name, result):
+    wall, cpu = result['wall_seconds'], result['cpu_seconds']
+    return (f"{name:<16} p50 {wall['p50'] * 1000:8.3f}ms  p99 {wall['p99'] * 1000:8.3f}ms  "
+            f"cpu {cpu['p50'] * 1000:8.3f}ms  alloc {result['allocated_bytes']['mean'] / 1024:8.1f} KB  "
+            f"first {result['first_call_seconds'] * 1000:.1f}ms  ({result['calls']} calls)")
+
+
+if __name__ == '__main__':
+    # Worker entry point of run_size(): python -m lamn.bench <options json> <result path>
+    result = run_server(json.loads(sys.argv[1]))
+    with open(sys.argv[2], 'w') as f:
+        json.dump(result, f)
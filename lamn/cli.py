@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import logging
 import subprocess
 import requests
 from lamn import server, client
-from lamn.config import add_agent, load_agents, remove_agent
+from lamn.config import add_agent, load_agents, registry, remove_agent
+from lamn.storage import migrate_csv
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("lamn.cli")
@@ -55,18 +57,38 @@ def display_terminal_metrics(url):
         for row in table:
             print(row)
 
+def print_agents():
+    agents = registry.agents()
+    if not agents:
+        print("No configured agents.")
+        return
+    print("Configured Agents:")
+    for agent in agents:
+        attributes = ', '.join(f"{k}={','.join(v) if isinstance(v, list) else v}"
+                               for k, v in agent.items() if k != 'ip')
+        print(f"{agent['ip']}  {attributes}" if attributes else agent['ip'])
+
 def main():
     parser = argparse.ArgumentParser(description='lamn - LAN Monitoring Tool')
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
 
     server_parser = subparsers.add_parser('server', help='Manage server commands')
     server_parser.add_argument('action', choices=['start', 'stop'], help='Start or stop the server')
+    server_parser.add_argument('--shard', help='Poll only the agents of this federation shard')
+
+    aggregator_parser = subparsers.add_parser('aggregator', help='Serve one dashboard over federated servers')
+    aggregator_parser.add_argument('action', choices=['start'], help='Start the aggregator')
+    aggregator_parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
 
     client_parser = subparsers.add_parser('client', help='Manage client commands')
     client_parser.add_argument('action', choices=['start', 'stop', 'list'], help='Start, stop or list configured agents')
 
     add_parser = subparsers.add_parser('add', help='Add an agent IP address to monitor')
     add_parser.add_argument('ip_address', help='IP address of the agent to add')
+    add_parser.add_argument('--port', type=int, help='Port the agent listens on (default: 5000)')
+    add_parser.add_argument('--interval', type=float, help='Seconds between polls of this agent')
+    add_parser.add_argument('--group', help='Group the agent belongs to')
+    add_parser.add_argument('--tag', dest='tags', action='append', help='Tag the agent (repeatable)')
 
     remove_parser = subparsers.add_parser('remove', help='Remove an agent IP address from monitoring')
     remove_parser.add_argument('ip_address', help='IP address of the agent to remove')
@@ -76,6 +98,9 @@ def main():
 
     list_parser = subparsers.add_parser('list', help='List all agent IPs from agents.json')
 
+    migrate_parser = subparsers.add_parser('migrate', help='Import CSV logs into the configured metric store')
+    migrate_parser.add_argument('csv_files', nargs='*', help='CSV files to import (default: logs/machine_metrics*.csv)')
+
     start_parser = subparsers.add_parser('start', help='Start components')
     start_parser.add_argument('target', choices=['all'], help='Start the server and all remote clients')
 
@@ -85,11 +110,27 @@ def main():
     restart_parser = subparsers.add_parser('restart', help='Restart components')
     restart_parser.add_argument('target', choices=['all'], help='Restart the server and all remote clients')
 
+    bench_parser = subparsers.add_parser('bench', help='Benchmark the server or the client')
+    bench_parser.add_argument('target', choices=['server', 'client'],
+                              help='The server against a simulated fleet, or the client collectors on this machine')
+    bench_parser.add_argument('--agents', default='10,100,1000', help='Comma-separated fleet sizes (default: 10,100,1000)')
+    bench_parser.add_argument('--cycles', type=int, default=5, help='Poll cycles per fleet size (default: 5)')
+    bench_parser.add_argument('--interval', type=float, default=0, help='Seconds between cycle starts (default: 0, back to back)')
+    bench_parser.add_argument('--samples', type=int, default=150, help='History samples returned per poll (default: 150)')
+    bench_parser.add_argument('--latency', type=float, default=0, help='Agent response latency in milliseconds')
+    bench_parser.add_argument('--jitter', type=float, default=0, help='Random +/- variation of the latency in milliseconds')
+    bench_parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of requests answered with HTTP 500')
+    bench_parser.add_argument('--payload-bytes', type=int, default=0, help='Pad /metrics payloads to this size')
+    bench_parser.add_argument('--storage', choices=['sqlite', 'csv'], help='Store to benchmark (default: as configured)')
+    bench_parser.add_argument('--output', help='Write the results as JSON to this file')
+    bench_parser.add_argument('--keep', action='store_true', help='Keep the temporary store and server log')
+    bench_parser.add_argument('--iterations', type=int, default=200, help='Timed calls per client collector (default: 200)')
+
     args = parser.parse_args()
 
     if args.command == 'server':
         if args.action == 'start':
-            server.start()
+            server.start(shard=args.shard)
         elif args.action == 'stop':
             try:
                 response = requests.post('http://127.0.0.1:8000/shutdown')
@@ -97,6 +138,10 @@ def main():
             except Exception as e:
                 logger.error("Error stopping server: " + str(e))
 
+    elif args.command == 'aggregator':
+        from lamn import aggregator
+        aggregator.start(port=args.port)
+
     elif args.command == 'client':
         if args.action == 'start':
             client.start()
@@ -107,18 +152,16 @@ def main():
             except Exception as e:
                 logger.error("Error stopping client: " + str(e))
         elif args.action == 'list':
-            agents = load_agents()
-            if agents:
-                print("Configured Agents:")
-                for ip in agents:
-                    print(ip)
-            else:
-                print("No configured agents.")
+            print_agents()
 
     elif args.command == 'add':
-        added = add_agent(args.ip_address)
-        if added:
+        known = registry.get(args.ip_address) is not None
+        changed = add_agent(args.ip_address, port=args.port, interval=args.interval,
+                            group=args.group, tags=args.tags)
+        if not known:
             print(f"Agent {args.ip_address} added successfully.")
+        elif changed:
+            print(f"Agent {args.ip_address} updated.")
         else:
             print(f"Agent {args.ip_address} is already in the list.")
 
@@ -133,14 +176,15 @@ def main():
         display_terminal_metrics(args.url)
 
     elif args.command == 'list':
-        agents = load_agents()
-        if agents:
-            print("Configured Agents:")
-            for ip in agents:
-                print(ip)
-        else:
-            print("No configured agents.")
+        print_agents()
     
+    elif args.command == 'migrate':
+        if server.store.kind == 'csv':
+            print("The configured store is the CSV log; set \"storage\": \"sqlite\" in ~/.lamn_config.json to migrate.")
+            return
+        total = migrate_csv(server.store, args.csv_files)
+        print(f"Imported {total} rows into {server.store.path}")
+
     elif args.command == 'start' and args.target == 'all':
         # Prompt for SSH username first
         username = input("Enter SSH username: ").strip()
@@ -198,6 +242,22 @@ def main():
                 shell=True
             )
 
+    elif args.command == 'bench':
+        from lamn import bench
+        if args.target == 'client':
+            report = bench.benchmark_client(iterations=args.iterations)
+        else:
+            report = bench.benchmark(
+                agents=[int(n) for n in args.agents.split(',') if n],
+                cycles=args.cycles, interval=args.interval, history=args.samples,
+                latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                payload_bytes=args.payload_bytes, storage=args.storage, keep=args.keep
+            )
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {args.output}")
+
     else:
         parser.print_help()
 
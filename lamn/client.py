@@ -1,85 +1,83 @@
 # lamn/client.py
-from flask import Flask, jsonify, request
-import psutil, datetime, subprocess, socket, platform, logging, os
+from flask import Flask, Response, jsonify, request
+import psutil, datetime, socket, platform, logging, os
+import collections, concurrent.futures, fnmatch, hashlib, json, threading, time
+from lamn.config import load_settings
+from lamn import gpu
+from lamn.history import SampleRing
+from lamn.prometheus import CONTENT_TYPE, Exposition, add_agent_metrics
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-def get_specs():
-    """
-    Collect additional hardware specifications including detailed CPU model,
-    network interface speed (filtered), OS details, and more.
-    Includes summary of total disk space usage and free space.
-    """
-    # CPU: get detailed model using py-cpuinfo if available.
+# Optional client settings from ~/.lamn_config.json
+settings = load_settings()
+
+# --- GPU telemetry ---
+gpu_monitor = gpu.GpuMonitor()
+
+# --- Spec cache ---
+# Hardware specs barely change, so they are cached with separate lifetimes:
+# CPU/GPU/RAM/OS once per process, the NIC layout whenever it changes and the
+# disk usage on its own short TTL.
+NIC_REFRESH_SECONDS = 60
+DISK_REFRESH_SECONDS = 15
+
+
+def format_bytes(bytes_val):
+    """Convert bytes to a human-readable string."""
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if bytes_val < 1024:
+            return f"{bytes_val:.2f} {unit}"
+        bytes_val /= 1024
+    return f"{bytes_val:.2f} PB"
+
+
+def cpu_model():
+    """Detailed CPU model from py-cpuinfo if available, else what platform reports."""
     try:
         import cpuinfo
-        cpu_info_full = cpuinfo.get_cpu_info()
-        cpu_model = cpu_info_full.get('brand_raw', 'Unknown CPU')
     except ImportError:
-        cpu_model = platform.processor() or "Unknown CPU"
+        return platform.processor() or "Unknown CPU"
+    return cpuinfo.get_cpu_info().get('brand_raw', 'Unknown CPU')
 
-    # GPU: try to get the GPU name using nvidia-smi.
-    try:
-        gpu_output = subprocess.check_output(
-            ["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
-            universal_newlines=True,
-            timeout=2
-        ).strip()
-        gpu_info = gpu_output if gpu_output else "No GPU"
-    except Exception as e:
-        logger.error("Error fetching GPU info: " + str(e))
-        gpu_info = "No GPU"
-
-    # Total RAM in bytes.
-    ram_total = psutil.virtual_memory().total
-
-    # Disk specifications: list disks with device, mountpoint, total capacity, and free space.
-    disks = psutil.disk_partitions()
-    disk_specs = []
-    total_space = 0
-    total_used = 0
-    total_free = 0
-
-    for disk in disks:
-        try:
-            usage = psutil.disk_usage(disk.mountpoint)
-            disk_specs.append({
-                "device": disk.device,
-                "mountpoint": disk.mountpoint,
-                "total": usage.total,
-                "used": usage.used,
-                "free": usage.free,
-                "percent_used": usage.percent
-            })
-            total_space += usage.total
-            total_used += usage.used
-            total_free += usage.free
-        except Exception:
-            continue
-
-    # Convert bytes to human-readable format
-    def format_bytes(bytes_val):
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if bytes_val < 1024:
-                return f"{bytes_val:.2f} {unit}"
-            bytes_val /= 1024
-        return f"{bytes_val:.2f} PB"
-
-    # Overall disk usage summary
-    disk_summary = {
-        "total_space": total_space,
-        "total_used": total_used,
-        "total_free": total_free,
-        "percent_used": round(100 * total_used / total_space, 2) if total_space > 0 else None,
-        "total_space_human": format_bytes(total_space),
-        "total_used_human": format_bytes(total_used),
-        "total_free_human": format_bytes(total_free)
+
+def collect_gpu_specs():
+    """
+    GPU names and memory size from the GPU backend, as (gpu, gpus, final).
+    final is False for an empty list read before the backend's first
+    complete reading, which does not mean the host has no GPU.
+    """
+    ready = gpu_monitor.ready
+    gpus = [
+        {"index": g["index"], "name": g["name"], "memory_total": g["memory_total"]}
+        for g in gpu_monitor.gpus()
+    ]
+    gpu_info = ", ".join(g["name"] for g in gpus) if gpus else "No GPU"
+    return gpu_info, gpus, bool(gpus) or ready
+
+
+def collect_static_specs():
+    """Collect specs that never change while the client runs: CPU, RAM and OS."""
+    # OS information.
+    os_info = {
+        "system": platform.system(),
+        "release": platform.release(),
+        "version": platform.version(),
+        "platform": platform.platform()
+    }
+
+    return {
+        "cpu": cpu_model(),
+        "ram": psutil.virtual_memory().total,
+        "os": os_info
     }
 
-    # Network connectivity: list IPv4 addresses and interface speed.
+
+def collect_connectivity():
+    """List IPv4 addresses and interface speed for every NIC."""
     nics = psutil.net_if_addrs()
     nic_stats = psutil.net_if_stats()
     connectivity = {}
@@ -93,52 +91,329 @@ def get_specs():
             "addresses": ipv4_addresses,
             "speed": speed
         }
+    return connectivity
 
-    # OS information.
-    os_info = {
-        "system": platform.system(),
-        "release": platform.release(),
-        "version": platform.version(),
-        "platform": platform.platform()
-    }
 
-    return {
-        "cpu": cpu_model,
-        "gpu": gpu_info,
-        "ram": ram_total,
-        "disks": disk_specs,
-        "disk_summary": disk_summary,
-        "connectivity": connectivity,
-        "os": os_info
+# --- Disk probing ---
+DISK_PROBE_TIMEOUT = 2.0  # seconds a mount may take to answer statvfs
+DISK_PROBE_WORKERS = 8
+
+
+def disk_selected(partition, rules):
+    """
+    Apply the include/exclude rules from the lamn config to a partition.
+    Filesystem types match exactly, mountpoints as shell-style patterns.
+    """
+    fstype = partition.fstype
+    mountpoint = partition.mountpoint
+    if fstype in rules.get("disk_exclude_fstypes", []):
+        return False
+    include_fstypes = rules.get("disk_include_fstypes")
+    if include_fstypes and fstype not in include_fstypes:
+        return False
+    if any(fnmatch.fnmatch(mountpoint, p) for p in rules.get("disk_exclude_mounts", [])):
+        return False
+    include_mounts = rules.get("disk_include_mounts")
+    if include_mounts and not any(fnmatch.fnmatch(mountpoint, p) for p in include_mounts):
+        return False
+    return True
+
+
+class DiskProber:
+    """
+    Probe disk usage of every selected mount in a bounded worker pool.
+
+    A mount that does not answer within the deadline (typically a stale NFS
+    mount) is reported with its last known usage and "stale": True. Its
+    probe is left running and no new probe is queued for that mount until
+    it returns, so one hung mount holds at most one worker.
+    """
+
+    def __init__(self, rules=None, timeout=DISK_PROBE_TIMEOUT, workers=DISK_PROBE_WORKERS):
+        self.rules = rules or {}
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="lamn-disk")
+        self._pending = {}     # mountpoint -> future of a probe still in flight
+        self._last_known = {}  # mountpoint -> last successful usage
+
+    def probe(self):
+        # A mountpoint can be listed more than once (bind mounts, overmounts);
+        # probe and report it once, for its first entry
+        partitions = {}
+        for partition in psutil.disk_partitions():
+            if disk_selected(partition, self.rules):
+                partitions.setdefault(partition.mountpoint, partition)
+        partitions = list(partitions.values())
+        futures = {}
+        for partition in partitions:
+            future = self._pending.get(partition.mountpoint)
+            if future is None or future.done():
+                future = self._executor.submit(psutil.disk_usage, partition.mountpoint)
+                self._pending[partition.mountpoint] = future
+            futures[partition.mountpoint] = future
+        if futures:
+            concurrent.futures.wait(list(futures.values()), timeout=self.timeout)
+
+        disk_specs = []
+        for partition in partitions:
+            mountpoint = partition.mountpoint
+            future = futures[mountpoint]
+            entry = {"device": partition.device, "mountpoint": mountpoint, "fstype": partition.fstype}
+            if future.done():
+                self._pending.pop(mountpoint, None)
+                try:
+                    usage = future.result()
+                except Exception:
+                    continue
+                self._last_known[mountpoint] = {
+                    "total": usage.total,
+                    "used": usage.used,
+                    "free": usage.free,
+                    "percent_used": usage.percent
+                }
+                entry.update(self._last_known[mountpoint])
+            else:
+                logger.warning("Disk usage probe of %s timed out, reporting last known value", mountpoint)
+                entry.update(self._last_known.get(mountpoint, {
+                    "total": None, "used": None, "free": None, "percent_used": None
+                }))
+                entry["stale"] = True
+            disk_specs.append(entry)
+        return disk_specs
+
+
+disk_prober = DiskProber(
+    rules=settings,
+    timeout=settings.get("disk_probe_timeout", DISK_PROBE_TIMEOUT),
+    workers=settings.get("disk_probe_workers", DISK_PROBE_WORKERS)
+)
+
+
+def collect_disks():
+    """
+    List disks with device, mountpoint, total capacity and free space,
+    plus a summary of total disk space usage.
+    """
+    disk_specs = disk_prober.probe()
+    counted = [d for d in disk_specs if d["total"] is not None]
+    total_space = sum(d["total"] for d in counted)
+    total_used = sum(d["used"] for d in counted)
+    total_free = sum(d["free"] for d in counted)
+
+    disk_summary = {
+        "total_space": total_space,
+        "total_used": total_used,
+        "total_free": total_free,
+        "percent_used": round(100 * total_used / total_space, 2) if total_space > 0 else None,
+        "total_space_human": format_bytes(total_space),
+        "total_used_human": format_bytes(total_used),
+        "total_free_human": format_bytes(total_free),
+        "stale_mounts": [d["mountpoint"] for d in disk_specs if d.get("stale")]
     }
+    return disk_specs, disk_summary
+
+
+class SpecCache:
+    """
+    Cache of the hardware specs reported in every /metrics payload.
+
+    get() returns a shared dict that callers must treat as read-only; a new
+    dict is built whenever one of the cached parts is refreshed.
+    """
+
+    def __init__(self, nic_ttl=NIC_REFRESH_SECONDS, disk_ttl=DISK_REFRESH_SECONDS):
+        self.nic_ttl = nic_ttl
+        self.disk_ttl = disk_ttl
+        self._lock = threading.Lock()
+        self._static = None
+        self._gpu = None  # (gpu, gpus, final) from collect_gpu_specs()
+        self._connectivity = None
+        self._nic_expires = 0
+        self._disks = None
+        self._disk_summary = None
+        self._disk_expires = 0
+        self._specs = None
+        self.version = None
+
+    def _compute_version(self):
+        # Only the layout goes into the hash, not the usage numbers, so the
+        # version changes when the hardware does rather than on every refresh.
+        layout = {
+            "static": self._static,
+            "gpus": self._gpu[1],
+            "connectivity": self._connectivity,
+            "disks": [(d["device"], d["mountpoint"], d["total"]) for d in self._disks],
+        }
+        blob = json.dumps(layout, sort_keys=True, default=str).encode()
+        return hashlib.sha1(blob).hexdigest()[:12]
+
+    def get(self):
+        """Return the current specs, refreshing whatever part has expired."""
+        with self._lock:
+            now = time.monotonic()
+            changed = False
+
+            if self._static is None:
+                self._static = collect_static_specs()
+                changed = True
+
+            # Read the GPUs again until the list is final, so an empty list
+            # read while nvidia-smi starts up is not cached as "No GPU"
+            if self._gpu is None or not self._gpu[2]:
+                gpu = collect_gpu_specs()
+                if gpu != self._gpu:
+                    self._gpu = gpu
+                    changed = True
+
+            if now >= self._nic_expires:
+                connectivity = collect_connectivity()
+                if connectivity != self._connectivity:
+                    self._connectivity = connectivity
+                    changed = True
+                self._nic_expires = now + self.nic_ttl
+
+            if now >= self._disk_expires:
+                self._disks, self._disk_summary = collect_disks()
+                self._disk_expires = now + self.disk_ttl
+                changed = True
+
+            if changed or self._specs is None:
+                self.version = self._compute_version()
+                self._specs = {
+                    "cpu": self._static["cpu"],
+                    "gpu": self._gpu[0],
+                    "gpus": self._gpu[1],
+                    "ram": self._static["ram"],
+                    "disks": self._disks,
+                    "disk_summary": self._disk_summary,
+                    "connectivity": self._connectivity,
+                    "os": self._static["os"],
+                    "version": self.version
+                }
+            return self._specs
+
+    def invalidate(self):
+        """Force every part of the specs to be collected again on the next get()."""
+        with self._lock:
+            self._static = None
+            self._gpu = None
+            self._nic_expires = 0
+            self._disk_expires = 0
+
+
+spec_cache = SpecCache()
+
+
+def get_specs():
+    """
+    Collect additional hardware specifications including detailed CPU model,
+    network interface speed (filtered), OS details, and more.
+    Includes summary of total disk space usage and free space.
+    Served from the spec cache; the result must not be modified.
+    """
+    return spec_cache.get()
+
+
+# --- I/O rates ---
+LOOPBACK_NICS = ('lo', 'lo0')
+
+
+class IoRates:
+    """
+    Turn psutil's cumulative disk and network counters into per-second rates
+    by keeping the previous snapshot. The first call only records a baseline
+    and reports no rates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prev = None
+
+    @staticmethod
+    def _rate(new, old, dt):
+        # Counters can reset (device re-attached, driver reload); never report
+        # negative rates.
+        return round(max(0, new - old) / dt, 2)
+
+    def sample(self):
+        now = time.monotonic()
+        disks = psutil.disk_io_counters(perdisk=True) or {}
+        disk_total = psutil.disk_io_counters(perdisk=False)
+        nics = psutil.net_io_counters(pernic=True) or {}
+        with self._lock:
+            prev, self._prev = self._prev, (now, disks, disk_total, nics)
+        if prev is None or now <= prev[0]:
+            return None
+        prev_time, prev_disks, prev_disk_total, prev_nics = prev
+        dt = now - prev_time
+        rate = self._rate
+
+        disk_rates = {}
+        for name, c in disks.items():
+            p = prev_disks.get(name)
+            if p is None:
+                continue
+            disk_rates[name] = {
+                "read_bps": rate(c.read_bytes, p.read_bytes, dt),
+                "write_bps": rate(c.write_bytes, p.write_bytes, dt),
+                "read_iops": rate(c.read_count, p.read_count, dt),
+                "write_iops": rate(c.write_count, p.write_count, dt)
+            }
+
+        nic_rates = {}
+        for name, c in nics.items():
+            p = prev_nics.get(name)
+            if p is None:
+                continue
+            nic_rates[name] = {
+                "rx_bps": rate(c.bytes_recv, p.bytes_recv, dt),
+                "tx_bps": rate(c.bytes_sent, p.bytes_sent, dt),
+                "rx_pps": rate(c.packets_recv, p.packets_recv, dt),
+                "tx_pps": rate(c.packets_sent, p.packets_sent, dt)
+            }
+
+        # psutil's whole-system disk counters skip partitions, so they don't
+        # double count the way summing the per-disk entries would.
+        totals = {}
+        if disk_total and prev_disk_total:
+            totals.update({
+                "disk_read_bps": rate(disk_total.read_bytes, prev_disk_total.read_bytes, dt),
+                "disk_write_bps": rate(disk_total.write_bytes, prev_disk_total.write_bytes, dt),
+                "disk_iops": rate(disk_total.read_count + disk_total.write_count,
+                                  prev_disk_total.read_count + prev_disk_total.write_count, dt)
+            })
+        external = [r for name, r in nic_rates.items() if name not in LOOPBACK_NICS]
+        totals.update({
+            "net_rx_bps": round(sum(r["rx_bps"] for r in external), 2),
+            "net_tx_bps": round(sum(r["tx_bps"] for r in external), 2),
+            "net_pps": round(sum(r["rx_pps"] + r["tx_pps"] for r in external), 2)
+        })
+        return {"totals": totals, "disks": disk_rates, "nics": nic_rates}
+
 
+io_rates = IoRates()
 
-def get_metrics():
+IO_TOTAL_FIELDS = ['disk_read_bps', 'disk_write_bps', 'disk_iops', 'net_rx_bps', 'net_tx_bps', 'net_pps']
+
+
+def get_metrics(cpu_interval=1):
     """
     Collect current performance metrics and include extra hardware specs.
+    cpu_interval is passed to psutil.cpu_percent; None makes the CPU reading
+    non-blocking, relative to the previous call.
     """
     host_name = socket.gethostname()
-    cpu_usage = psutil.cpu_percent(interval=1)
+    cpu_usage = psutil.cpu_percent(interval=cpu_interval)
     memory_usage = psutil.virtual_memory().percent
 
-    # Disk I/O counters.
-    disk_counters = psutil.disk_io_counters()
-    disk_read = disk_counters.read_bytes if disk_counters else None
-    disk_write = disk_counters.write_bytes if disk_counters else None
+    # Disk and network I/O rates since the previous call.
+    io = io_rates.sample()
+    io_totals = io["totals"] if io else {}
 
-    # GPU utilization: try to get the percentage utilization for NVIDIA GPUs.
-    gpu_usage = None
-    try:
-        gpu_output = subprocess.check_output(
-            ["nvidia-smi", "--query-gpu=utilization.gpu", "--format=csv,noheader,nounits"],
-            universal_newlines=True,
-            timeout=2
-        )
-        if gpu_output.strip():
-            gpu_usage = float(gpu_output.splitlines()[0].strip())
-    except Exception as e:
-        logger.error("Error getting GPU utilization: " + str(e))
-        gpu_usage = None
+    # GPU utilization: mean across all GPUs, per-GPU readings alongside.
+    gpus = gpu_monitor.gpus()
+    gpu_usage = gpu.summarize(gpus)
 
     specs = get_specs()
     disk_summary = specs.get("disk_summary", {})
@@ -148,18 +423,141 @@ def get_metrics():
         "cpu": cpu_usage,
         "memory": memory_usage,
         "gpu": gpu_usage,
+        "gpus": gpus,
         "disk_total": disk_summary.get("total_space_human"),
         "disk_used": disk_summary.get("total_used_human"),
         "disk_free": disk_summary.get("total_free_human"),
         "disk_percent_used": disk_summary.get("percent_used"),        
-        "timestamp": datetime.datetime.utcnow().isoformat()
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "spec_version": specs.get("version"),
+        "io": {"disks": io["disks"], "nics": io["nics"]} if io else None
     }
-    metrics["specs"] = get_specs()
+    for field in IO_TOTAL_FIELDS:
+        metrics[field] = io_totals.get(field)
+    metrics["specs"] = specs
     return metrics
 
+# --- Background sampler ---
+SAMPLE_INTERVAL = 1.0  # seconds between samples
+HISTORY_SECONDS = 3600  # samples kept in the on-client ring buffer
+HISTORY_FIELDS = ['cpu', 'memory', 'gpu', 'disk_percent'] + IO_TOTAL_FIELDS
+
+Snapshot = collections.namedtuple('Snapshot', ['metrics', 'body', 'taken_at'])
+
+
+class MetricsSampler:
+    """
+    Collect metrics on a fixed cadence in a background thread.
+
+    Each sample is published as an immutable Snapshot holding the metrics
+    dict and its pre-serialized JSON body, so request handlers never block on
+    collection and the collection cost does not depend on the number of readers.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, history_seconds=HISTORY_SECONDS):
+        self.interval = interval
+        self.history = SampleRing(HISTORY_FIELDS, capacity=max(1, int(history_seconds / interval)))
+        self._latest = None
+        self._exposition = None  # (snapshot, Prometheus text) of the last scrape
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the sampling thread if it is not already running."""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="lamn-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def latest(self, wait=None):
+        """Return the most recent Snapshot, optionally waiting for the first one."""
+        if wait is not None:
+            self._ready.wait(wait)
+        return self._latest
+
+    def prometheus(self, snapshot):
+        """Prometheus text of a snapshot, rendered once however often it is scraped."""
+        cached = self._exposition
+        if cached is None or cached[0] is not snapshot:
+            exposition = Exposition()
+            add_agent_metrics(exposition, snapshot.metrics)
+            exposition.add('lamn_sample_timestamp_seconds', snapshot.taken_at,
+                           help='When the exposed sample was taken, in seconds since the epoch')
+            cached = self._exposition = (snapshot, exposition.render().encode())
+        return cached[1]
+
+    def sample(self):
+        """Take one sample, record it in the history buffer and publish it."""
+        metrics = get_metrics(cpu_interval=None)
+        body = json.dumps(metrics).encode()
+        taken_at = time.time()
+        values = {field: metrics.get(field) for field in HISTORY_FIELDS}
+        values["disk_percent"] = metrics["disk_percent_used"]
+        self.history.append(taken_at, values)
+        self._latest = Snapshot(metrics, body, taken_at)
+        self._ready.set()
+        return self._latest
+
+    def _run(self):
+        # Prime cpu_percent so the first non-blocking reading is meaningful.
+        psutil.cpu_percent(interval=None)
+        next_tick = time.monotonic() + self.interval
+        while not self._stop.wait(max(0, next_tick - time.monotonic())):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error("Error sampling metrics: " + str(e))
+            next_tick += self.interval
+            # Skip missed ticks instead of bursting to catch up.
+            now = time.monotonic()
+            if next_tick < now:
+                next_tick = now + self.interval
+
+
+sampler = MetricsSampler()
+
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    return jsonify(get_metrics())
+    sampler.start()
+    snapshot = sampler.latest(wait=2 * sampler.interval + 1)
+    if snapshot is None:
+        return jsonify(get_metrics())
+    return Response(snapshot.body, mimetype='application/json')
+
+@app.route('/metrics/prom', methods=['GET'])
+def metrics_prom():
+    """The latest sample in the Prometheus text format."""
+    sampler.start()
+    snapshot = sampler.latest(wait=2 * sampler.interval + 1)
+    if snapshot is None:
+        return Response("no sample yet\n", status=503, mimetype='text/plain')
+    return Response(sampler.prometheus(snapshot), content_type=CONTENT_TYPE)
+
+@app.route('/metrics/history', methods=['GET'])
+def metrics_history():
+    """
+    Return buffered per-second samples as columns.
+    ?since=<epoch> returns samples newer than that timestamp,
+    ?window=<seconds> the samples from the last N seconds of this host's clock.
+    """
+    sampler.start()
+    since = request.args.get('since', type=float)
+    window = request.args.get('window', type=float)
+    if since is None and window is not None:
+        since = time.time() - window
+    return jsonify({
+        "host": socket.gethostname(),
+        "interval": sampler.interval,
+        "fields": list(sampler.history.fields),
+        "samples": sampler.history.since(since)
+    })
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
@@ -172,7 +570,15 @@ def shutdown():
 
 def start():
     logger.info("Starting client on port 5000")
-    app.run(host='0.0.0.0', port=5000)
+    sampler.start()
+    # Werkzeug's development server closes every connection; waitress, when
+    # installed, lets the server keep its polling connections alive.
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host='0.0.0.0', port=5000, threaded=True)
+        return
+    serve(app, host='0.0.0.0', port=5000, threads=8)
 
 if __name__ == '__main__':
     start()
\ No newline at end of file
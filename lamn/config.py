@@ -1,31 +1,210 @@
+"""
+Configuration files: ~/.lamn_config.json settings and the ~/.agents.json agent list.
+
+Agents are kept in an in-process registry that re-reads ~/.agents.json
+only when its modification time or size changes, so asking for the agent
+list costs a stat() instead of a parse. Writes go to a temporary file that
+is renamed over the list, so a reader never sees a half-written file.
+
+Each entry of the list is either an IP address or an object with per-agent
+attributes:
+
+    ["10.0.0.1", {"ip": "10.0.0.2", "port": 5001, "interval": 60,
+                  "group": "gpu-lab", "tags": ["gpu", "a100"]}]
+
+Entries without attributes are written back as plain IP addresses, so the
+file stays readable by older versions as long as no attributes are used.
+"""
 import os
 import json
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
 
 CONFIG_PATH = os.path.expanduser("~/.agents.json")  # Global per-user config file
+SETTINGS_PATH = os.path.expanduser("~/.lamn_config.json")  # Shared with start_clients.py
+
+def load_settings():
+    """Return the settings in ~/.lamn_config.json, or {} if it is missing or unreadable."""
+    try:
+        with open(SETTINGS_PATH, 'r') as f:
+            settings = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return settings if isinstance(settings, dict) else {}
+
+# --- Agent registry ---
+
+def normalize_agent(entry):
+    """Agent attributes of one ~/.agents.json entry, an IP string or an object with "ip"."""
+    if isinstance(entry, str):
+        return {'ip': entry}
+    if isinstance(entry, dict) and entry.get('ip'):
+        agent = dict(entry)
+        if isinstance(agent.get('tags'), str):
+            agent['tags'] = [agent['tags']]
+        return agent
+    raise ValueError(f"invalid agent entry: {entry!r}")
+
+def agent_labels(agent):
+    """Tags of an agent, its group included."""
+    labels = set(agent.get('tags') or ())
+    if agent.get('group'):
+        labels.add(agent['group'])
+    return labels
+
+
+class AgentRegistry:
+    """
+    The agents in ~/.agents.json, in file order. All methods are thread-safe
+    and pick up changes made to the file by other processes.
+    """
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self._agents = {}   # ip -> attributes
+        self._by_label = {}  # tag or group -> frozenset of ips
+        self._stamp = None  # (mtime_ns, size) of the file last read
+        self.version = 0    # incremented every time the list is (re)loaded
+        self._lock = threading.RLock()
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # Ensure the file exists and is initialized as an empty list
+            self._write([])
+            st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                agents = {}
+                for entry in json.load(f):
+                    agent = normalize_agent(entry)
+                    agents[agent['ip']] = agent
+        except ValueError as e:
+            if self._stamp is None:
+                raise
+            # Probably caught mid-edit: keep the last good list and retry on the next call
+            logger.warning("Ignoring invalid %s: %s", self.path, e)
+            return
+        by_label = {}
+        for ip, agent in agents.items():
+            for label in agent_labels(agent):
+                by_label.setdefault(label, set()).add(ip)
+        self._agents = agents
+        self._by_label = {label: frozenset(ips) for label, ips in by_label.items()}
+        self._stamp = stamp
+        self.version += 1
+
+    def _write(self, agents):
+        entries = [agent['ip'] if len(agent) == 1 else agent for agent in agents]
+        path = os.path.realpath(self.path)
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        fd, tmp = tempfile.mkstemp(prefix='.agents.', suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2)
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _save(self, agents):
+        self._write(agents)
+        self._stamp = None
+        self._refresh()
+
+    def agents(self):
+        """Attributes of every agent, as copies."""
+        with self._lock:
+            self._refresh()
+            return [dict(agent) for agent in self._agents.values()]
+
+    def get(self, ip):
+        with self._lock:
+            self._refresh()
+            agent = self._agents.get(ip)
+            return dict(agent) if agent is not None else None
+
+    def ips(self, tags=None):
+        """Agent IPs in file order; with tags, only agents carrying any of them."""
+        with self._lock:
+            self._refresh()
+            if not tags:
+                return list(self._agents)
+            tagged = self.tagged(tags)
+            return [ip for ip in self._agents if ip in tagged]
+
+    def tagged(self, tags):
+        """Set of the IPs of agents carrying any of tags (tag or group names)."""
+        with self._lock:
+            self._refresh()
+            ips = set()
+            for tag in tags:
+                ips |= self._by_label.get(tag, frozenset())
+            return ips
+
+    def labels(self):
+        """Every tag and group name with the number of agents carrying it."""
+        with self._lock:
+            self._refresh()
+            return {label: len(ips) for label, ips in sorted(self._by_label.items())}
+
+    def attribute(self, name):
+        """{ip: value} of one attribute, for the agents that set it."""
+        with self._lock:
+            self._refresh()
+            return {ip: agent[name] for ip, agent in self._agents.items() if agent.get(name) is not None}
+
+    def add(self, ip, **attributes):
+        """Add an agent, or update the attributes of an existing one; returns False if nothing changed."""
+        with self._lock:
+            self._refresh()
+            agents = dict(self._agents)
+            agent = dict(agents.get(ip) or {'ip': ip})
+            agent.update({k: v for k, v in attributes.items() if v is not None})
+            if agents.get(ip) == agent:
+                return False
+            agents[ip] = agent
+            self._save(agents.values())
+            return True
+
+    def replace(self, agents):
+        """Replace the whole list; entries are IPs or attribute objects."""
+        agents = [normalize_agent(entry) for entry in agents]
+        with self._lock:
+            self._save(agents)
+
+    def remove(self, ip):
+        with self._lock:
+            self._refresh()
+            if ip not in self._agents:
+                return False
+            self._save([agent for key, agent in self._agents.items() if key != ip])
+            return True
+
+
+registry = AgentRegistry()
 
 def load_agents():
-    if not os.path.exists(CONFIG_PATH):
-        # Ensure the file exists and is initialized as an empty list
-        save_agents([])
-    with open(CONFIG_PATH, 'r') as f:
-        return json.load(f)
+    """IPs of the configured agents."""
+    return registry.ips()
 
 def save_agents(agents):
-    with open(CONFIG_PATH, 'w') as f:
-        json.dump(agents, f, indent=2)
+    """Replace the agent list; entries are IPs or attribute objects."""
+    registry.replace(agents)
 
-def add_agent(ip):
-    agents = load_agents()
-    if ip not in agents:
-        agents.append(ip)
-        save_agents(agents)
-        return True
-    return False
+def add_agent(ip, **attributes):
+    return registry.add(ip, **attributes)
 
 def remove_agent(ip):
-    agents = load_agents()
-    if ip in agents:
-        agents.remove(ip)
-        save_agents(agents)
-        return True
-    return False
+    return registry.remove(ip)
@@ -0,0 +1,102 @@
+"""
+Server-Sent Events fan-out for live dashboard updates.
+
+The server publishes one event per agent poll; every connected browser
+gets it pushed over its /stream connection instead of re-fetching the
+whole snapshot on a timer. Each event is serialized once, whatever the
+number of clients. A client that falls too far behind is disconnected and
+catches up when the browser reconnects: from the replay buffer when its
+Last-Event-ID is still there, otherwise from a fresh snapshot.
+"""
+import collections
+import queue
+import threading
+
+from lamn.snapshot import dumps
+
+REPLAY_EVENTS = 1000   # recent events kept for reconnecting clients
+CLIENT_QUEUE = 1000    # events buffered per client before it is dropped
+HEARTBEAT = 15         # seconds between keep-alive comments
+RETRY_MS = 5000        # reconnect delay suggested to browsers
+
+
+def format_event(event_id, event, data):
+    """SSE message; data is JSON-encoded unless it already is JSON bytes."""
+    if not isinstance(data, bytes):
+        data = dumps(data)
+    return f"id: {event_id}\nevent: {event}\ndata: {data.decode('utf-8')}\n\n"
+
+
+class _Client:
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = False
+
+
+class EventHub:
+    """Publish events to every subscribed stream; all methods are thread-safe."""
+
+    def __init__(self, replay=REPLAY_EVENTS, client_queue=CLIENT_QUEUE):
+        self.client_queue = client_queue
+        self._recent = collections.deque(maxlen=replay)  # (id, message)
+        self._clients = set()
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    @property
+    def clients(self):
+        return len(self._clients)
+
+    @property
+    def backlog(self):
+        """Most events waiting to be sent to any one client."""
+        with self._lock:
+            return max((client.queue.qsize() for client in self._clients), default=0)
+
+    def publish(self, event, data):
+        with self._lock:
+            self._seq += 1
+            message = format_event(self._seq, event, data)
+            self._recent.append((self._seq, message))
+            for client in list(self._clients):
+                try:
+                    client.queue.put_nowait(message)
+                except queue.Full:
+                    client.dropped = True
+                    self._clients.discard(client)
+
+    def _subscribe(self, last_event_id):
+        """Register a client; returns (client, event id of its snapshot or None if replayed)."""
+        client = _Client(self.client_queue)
+        with self._lock:
+            self._clients.add(client)
+            if last_event_id is not None and self._recent and self._recent[0][0] <= last_event_id + 1 \
+                    and last_event_id <= self._seq:
+                for event_id, message in self._recent:
+                    if event_id > last_event_id:
+                        client.queue.put_nowait(message)
+                return client, None
+            return client, self._seq
+
+    def _unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def stream(self, snapshot, last_event_id=None, heartbeat=HEARTBEAT):
+        """
+        Generator of SSE text for one client. snapshot() returns the full
+        state, sent first as a `snapshot` event unless the missed events
+        could be replayed.
+        """
+        client, snapshot_id = self._subscribe(last_event_id)
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            if snapshot_id is not None:
+                yield format_event(snapshot_id, 'snapshot', snapshot())
+            while not client.dropped:
+                try:
+                    yield client.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            self._unsubscribe(client)
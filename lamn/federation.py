@@ -0,0 +1,187 @@
+"""
+Federation: several servers sharing one fleet.
+
+Each server (a shard) polls and stores only its own part of the agents in
+~/.agents.json, so polling and storage stay inside the network segment the
+agents live in. An aggregator (lamn/aggregator.py) gives viewers a single
+dashboard over all shards.
+
+Agents are assigned to shards by, in order of precedence:
+- a "shard" attribute on the agent's entry in ~/.agents.json
+- with "assign": "tags", the first shard listing one of the agent's tags or its group
+- a consistent hash of the agent's IP, so adding or removing a shard only
+  moves the agents of that shard
+
+All of it is configured in the "federation" section of ~/.lamn_config.json,
+which every shard and the aggregator can share:
+
+    "federation": {
+        "shards": {"lab": "http://10.20.0.5:8000", "cluster": "http://10.30.0.5:8000"},
+        "assign": "tags",
+        "tags": {"cluster": ["hpc"]}
+    }
+
+A server becomes a shard with `lamn server start --shard lab` (or "shard"
+in the section).
+"""
+import bisect
+import hashlib
+import json
+import threading
+import time
+
+import requests
+
+from lamn.config import agent_labels
+
+REPLICAS = 64            # points per shard on the hash ring
+QUERY_TIMEOUT = 30       # seconds a shard has to answer a fanned-out query
+STREAM_TIMEOUT = 60      # seconds without data (heartbeats included) before a stream is reopened
+MAX_RECONNECT_DELAY = 30
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent hashing of keys onto named nodes."""
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        if not self._keys:
+            return None
+        return self._nodes[bisect.bisect(self._keys, _hash(key)) % len(self._keys)]
+
+
+class Federation:
+    """The shards of the fleet and which of them owns each agent."""
+
+    def __init__(self, shards=None, shard=None, assign='hash', tags=None):
+        self.shards = dict(shards or {})   # name -> base URL
+        self.shard = shard                 # this server's shard, None when not sharded
+        self.assign = assign
+        self.tags = {name: set(labels) for name, labels in (tags or {}).items()}
+        self.ring = HashRing(sorted(self.shards))
+
+    @classmethod
+    def from_settings(cls, settings, shard=None):
+        config = settings.get('federation') or {}
+        return cls(config.get('shards'), shard or config.get('shard'),
+                   config.get('assign', 'hash'), config.get('tags'))
+
+    @property
+    def enabled(self):
+        return self.shard is not None
+
+    def owner(self, agent):
+        """Name of the shard polling an agent (a ~/.agents.json entry)."""
+        if agent.get('shard') in self.shards:
+            return agent['shard']
+        if self.assign == 'tags':
+            labels = agent_labels(agent)
+            for name, tags in self.tags.items():
+                if labels & tags:
+                    return name
+        return self.ring.node(agent['ip'])
+
+    def local(self, agents):
+        """IPs of the agents this server polls: all of them unless it is a shard."""
+        if not self.enabled:
+            return [agent['ip'] for agent in agents]
+        return [agent['ip'] for agent in agents if self.owner(agent) == self.shard]
+
+    def check(self):
+        if self.enabled and self.shard not in self.shards:
+            raise ValueError(f"shard '{self.shard}' is not listed in federation.shards")
+
+
+class Shard:
+    """A shard as seen from the aggregator: its URL, a keep-alive session and its live feed."""
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.trust_env = False   # shards are reached directly, like agents
+        self.connected = False
+        self.last_event = None
+        self.error = None
+
+    def get(self, path, params=None, **kwargs):
+        kwargs.setdefault('timeout', QUERY_TIMEOUT)
+        return self.session.get(self.url + path, params=params, **kwargs)
+
+    def status(self):
+        return {"url": self.url, "connected": self.connected,
+                "last_event": self.last_event, "error": self.error}
+
+
+class ShardFeed:
+    """
+    Follows one shard's /stream and hands its events to callbacks:
+    on_snapshot(shard, {ip: data}) and on_agent(shard, ip, data, raw bytes).
+    Reconnects with Last-Event-ID, so short interruptions are replayed.
+    """
+
+    def __init__(self, shard, on_snapshot, on_agent):
+        self.shard = shard
+        self.on_snapshot = on_snapshot
+        self.on_agent = on_agent
+        self.last_id = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"lamn-feed-{self.shard.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        delay = 1
+        while True:
+            try:
+                self._follow()
+                delay = 1
+            except Exception as e:
+                self.shard.error = str(e)
+            self.shard.connected = False
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _follow(self):
+        headers = {'Accept': 'text/event-stream'}
+        if self.last_id is not None:
+            headers['Last-Event-ID'] = str(self.last_id)
+        with self.shard.get('/stream', headers=headers, stream=True, timeout=(5, STREAM_TIMEOUT)) as response:
+            response.raise_for_status()
+            self.shard.connected, self.shard.error = True, None
+            event_id, event, data = None, None, []
+            for line in response.iter_lines():
+                if line:
+                    field, _, value = line.partition(b':')
+                    value = value[1:] if value.startswith(b' ') else value
+                    if field == b'id':
+                        event_id = int(value)
+                    elif field == b'event':
+                        event = value.decode()
+                    elif field == b'data':
+                        data.append(value)
+                    continue
+                # A blank line ends the event
+                if data:
+                    self._dispatch(event, b'\n'.join(data))
+                    if event_id is not None:
+                        self.last_id = event_id
+                    self.shard.last_event = time.time()
+                event_id, event, data = None, None, []
+
+    def _dispatch(self, event, raw):
+        if event == 'snapshot':
+            self.on_snapshot(self.shard, json.loads(raw))
+        elif event == 'agent':
+            update = json.loads(raw)
+            self.on_agent(self.shard, update['ip'], update['data'], raw)
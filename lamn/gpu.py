@@ -0,0 +1,306 @@
+"""
+GPU telemetry backends for the lamn client.
+
+Three backends report the same per-GPU dicts:
+- NvmlBackend reads NVML directly through the pynvml bindings when installed.
+- NvidiaSmiLoopBackend keeps one long-lived `nvidia-smi --loop` process and
+  parses its CSV stream as it arrives, instead of forking per request.
+- NullBackend reports no GPUs; it replaces a backend that fails without
+  ever reporting a GPU, so hosts without GPUs pay for one failed probe and
+  nothing afterwards. Backends that fail on a host with GPUs are recreated.
+
+The backend can be forced with LAMN_GPU_BACKEND=nvml|smi|none. The
+nvidia-smi executable is looked up on PATH (or LAMN_NVIDIA_SMI), so a fake
+script can stand in for it.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SMI_FIELDS = ['index', 'name', 'utilization.gpu', 'memory.used', 'memory.total', 'temperature.gpu']
+FIRST_READING_TIMEOUT = 3  # seconds to wait for the first nvidia-smi output
+RETRY_DELAY = 5            # seconds before recreating a backend that failed after reporting GPUs
+MAX_RETRY_DELAY = 300      # longest delay between such retries
+
+
+class GpuBackendError(Exception):
+    """Raised when a backend can no longer report GPU telemetry."""
+
+
+def _number(text):
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        # nvidia-smi prints "[N/A]" or "[Not Supported]" for missing readings.
+        return None
+
+
+def parse_smi_line(line):
+    """Parse one `--format=csv,noheader,nounits` line into a GPU dict, or None."""
+    parts = [p.strip() for p in line.split(',')]
+    if len(parts) != len(SMI_FIELDS):
+        return None
+    index = _number(parts[0])
+    if index is None:
+        return None
+    return {
+        "index": int(index),
+        "name": parts[1],
+        "utilization": _number(parts[2]),
+        "memory_used": _number(parts[3]),
+        "memory_total": _number(parts[4]),
+        "temperature": _number(parts[5])
+    }
+
+
+class GpuBackend:
+    """Base class; gpus() returns one dict per GPU with utilization (%),
+    memory_used and memory_total (MiB) and temperature (C)."""
+
+    name = "base"
+    ready = True  # False until the backend has a complete reading
+
+    def gpus(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NullBackend(GpuBackend):
+    name = "none"
+
+    def gpus(self):
+        return []
+
+
+class NvmlBackend(GpuBackend):
+    name = "nvml"
+
+    def __init__(self):
+        import pynvml  # optional dependency
+        self._nvml = pynvml
+        try:
+            pynvml.nvmlInit()
+            count = pynvml.nvmlDeviceGetCount()
+            self._handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(count)]
+            self._names = []
+            for handle in self._handles:
+                name = pynvml.nvmlDeviceGetName(handle)
+                self._names.append(name.decode() if isinstance(name, bytes) else name)
+        except pynvml.NVMLError as e:
+            raise GpuBackendError(f"NVML unavailable: {e}")
+
+    def gpus(self):
+        nvml = self._nvml
+        result = []
+        try:
+            for index, (handle, name) in enumerate(zip(self._handles, self._names)):
+                memory = nvml.nvmlDeviceGetMemoryInfo(handle)
+                result.append({
+                    "index": index,
+                    "name": name,
+                    "utilization": float(nvml.nvmlDeviceGetUtilizationRates(handle).gpu),
+                    "memory_used": memory.used / (1024 ** 2),
+                    "memory_total": memory.total / (1024 ** 2),
+                    "temperature": float(nvml.nvmlDeviceGetTemperature(handle, nvml.NVML_TEMPERATURE_GPU))
+                })
+        except nvml.NVMLError as e:
+            raise GpuBackendError(f"NVML query failed: {e}")
+        return result
+
+    def close(self):
+        try:
+            self._nvml.nvmlShutdown()
+        except Exception:
+            pass
+
+
+class NvidiaSmiLoopBackend(GpuBackend):
+    """Stream readings from a single `nvidia-smi --loop` process."""
+
+    name = "smi"
+
+    def __init__(self, executable, interval=1):
+        self.executable = executable
+        self.interval = max(1, int(interval))
+        self.count = self._count()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._deadline = time.monotonic() + FIRST_READING_TIMEOUT
+        self._proc = subprocess.Popen(
+            [executable, "--query-gpu=" + ",".join(SMI_FIELDS),
+             "--format=csv,noheader,nounits", f"--loop={self.interval}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            bufsize=1
+        )
+        self._reader = threading.Thread(target=self._read, name="lamn-nvidia-smi", daemon=True)
+        self._reader.start()
+
+    def _count(self):
+        """Number of GPUs from `--query-gpu=count`, or None if nvidia-smi cannot tell."""
+        try:
+            output = subprocess.run(
+                [self.executable, "--query-gpu=count", "--format=csv,noheader,nounits"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+                timeout=FIRST_READING_TIMEOUT
+            ).stdout
+            return int(output.split()[0])
+        except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+            return None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def _publish(self, reading):
+        with self._lock:
+            self._latest = reading
+        self._ready.set()
+
+    def _read(self):
+        # nvidia-smi prints one line per GPU every interval. A reading is
+        # published only once complete: when `count` lines have arrived, or
+        # when an index seen in this round comes round again.
+        reading = {}
+        for line in self._proc.stdout:
+            gpu = parse_smi_line(line)
+            if gpu is None:
+                continue
+            if gpu["index"] in reading:
+                self._publish(reading)
+                reading = {}
+            reading[gpu["index"]] = gpu
+            if self.count and len(reading) >= self.count:
+                self._publish(reading)
+                reading = {}
+        self._proc.wait()
+        # Wake up anyone still waiting for the first reading.
+        self._ready.set()
+
+    def gpus(self):
+        # Wait for the first reading at most FIRST_READING_TIMEOUT after
+        # startup in total, not on every call
+        self._ready.wait(max(0.0, self._deadline - time.monotonic()))
+        if self._proc.poll() is not None:
+            raise GpuBackendError(f"nvidia-smi exited with code {self._proc.returncode}")
+        with self._lock:
+            if not self._latest:
+                if self._ready.is_set():
+                    raise GpuBackendError("nvidia-smi produced no GPU readings")
+                return []
+            return [dict(gpu) for _, gpu in sorted(self._latest.items())]
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+
+
+def find_nvidia_smi():
+    return os.environ.get("LAMN_NVIDIA_SMI") or shutil.which("nvidia-smi")
+
+
+def create_backend(kind=None, interval=1):
+    """
+    Create the best available backend, or the one named by kind /
+    LAMN_GPU_BACKEND. Falls back to NullBackend when nothing works.
+    """
+    kind = (kind or os.environ.get("LAMN_GPU_BACKEND") or "auto").lower()
+    if kind in ("auto", "nvml"):
+        try:
+            return NvmlBackend()
+        except (ImportError, GpuBackendError) as e:
+            if kind == "nvml":
+                logger.warning("NVML backend unavailable: %s", e)
+                return NullBackend()
+    if kind in ("auto", "smi"):
+        executable = find_nvidia_smi()
+        if executable:
+            try:
+                return NvidiaSmiLoopBackend(executable, interval)
+            except OSError as e:
+                logger.warning("Could not start nvidia-smi: %s", e)
+    return NullBackend()
+
+
+class GpuMonitor:
+    """
+    Lazily created GPU backend. If it fails before ever reporting a GPU the
+    host has none and the monitor degrades to NullBackend for good, logging
+    it once instead of on every sample. A backend that did report GPUs (a
+    transient NVML error, nvidia-smi restarting) is closed and recreated
+    after a backoff, reporting no GPUs meanwhile.
+    """
+
+    def __init__(self, kind=None, interval=1):
+        self.kind = kind
+        self.interval = interval
+        self._backend = None
+        self._had_gpus = False
+        self._retry_at = None  # monotonic time at which to recreate a failed backend
+        self._retry_delay = RETRY_DELAY
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None or (self._retry_at is not None and time.monotonic() >= self._retry_at):
+                self._retry_at = None
+                self._backend = create_backend(self.kind, self.interval)
+                logger.info("Using GPU backend: %s", self._backend.name)
+            return self._backend
+
+    @property
+    def ready(self):
+        """False while the backend is still waiting for its first complete reading."""
+        return self.backend.ready
+
+    def gpus(self):
+        backend = self.backend
+        try:
+            gpus = backend.gpus()
+        except GpuBackendError as e:
+            with self._lock:
+                backend.close()
+                if self._backend is not backend:
+                    return []   # another thread already handled it
+                self._backend = NullBackend()
+                if not self._had_gpus:
+                    logger.error("GPU backend %s failed, disabling GPU telemetry: %s", backend.name, e)
+                else:
+                    logger.warning("GPU backend %s failed, retrying in %ds: %s", backend.name, self._retry_delay, e)
+                    self._retry_at = time.monotonic() + self._retry_delay
+                    self._retry_delay = min(2 * self._retry_delay, MAX_RETRY_DELAY)
+            return []
+        if gpus:
+            self._had_gpus = True
+            self._retry_delay = RETRY_DELAY
+        return gpus
+
+    def close(self):
+        with self._lock:
+            self._retry_at = None
+            if self._backend is not None:
+                self._backend.close()
+                self._backend = None
+
+
+def summarize(gpus):
+    """Mean utilization across GPUs, or None when there are none."""
+    readings = [g["utilization"] for g in gpus if g.get("utilization") is not None]
+    if not readings:
+        return None
+    return round(sum(readings) / len(readings), 1)
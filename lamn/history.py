@@ -0,0 +1,196 @@
+"""
+Fixed-memory ring buffer of metric samples.
+
+Samples are stored column-wise in float arrays instead of one dict per
+sample, so a buffer holding an hour of per-second samples costs a few
+hundred kilobytes regardless of how long the process runs. The arrays start
+small and double up to the capacity, so a buffer only costs that much once
+it has held that many samples. Missing values are stored as NaN and come
+back out as None.
+
+HostWindows keeps one ring per host and numbers every append, so a reader
+can fetch just what arrived since its previous read.
+"""
+import collections
+import math
+import threading
+from array import array
+
+INITIAL_SIZE = 64  # samples allocated for a new ring, doubled as it fills
+
+
+class SampleRing:
+    """
+    Ring buffer of (timestamp, values) samples with a fixed set of fields.
+
+    Timestamps are epoch seconds and must be appended in increasing order,
+    which lets range lookups use a binary search.
+    """
+
+    def __init__(self, fields, capacity=3600):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        size = min(capacity, INITIAL_SIZE)
+        self._times = array('d', [0.0]) * size
+        self._columns = [array('d', [math.nan]) * size for _ in self.fields]
+        self._start = 0   # physical index of the oldest sample
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, values):
+        """Append a sample; values is a mapping of field name to number or None."""
+        with self._lock:
+            if self._count == len(self._times) < self.capacity:
+                self._grow()
+            if self._count < self.capacity:
+                idx = (self._start + self._count) % self.capacity
+                self._count += 1
+            else:
+                # Overwrite the oldest sample.
+                idx = self._start
+                self._start = (self._start + 1) % self.capacity
+            self._times[idx] = timestamp
+            for column, field in zip(self._columns, self.fields):
+                value = values.get(field)
+                column[idx] = math.nan if value is None else float(value)
+
+    def _grow(self):
+        # The ring only wraps once it holds capacity samples, so until then
+        # the samples sit at the start of the arrays and can simply be extended
+        extra = min(len(self._times), self.capacity - len(self._times))
+        self._times.extend(array('d', [0.0]) * extra)
+        for column in self._columns:
+            column.extend(array('d', [math.nan]) * extra)
+
+    def _physical(self, logical):
+        return (self._start + logical) % self.capacity
+
+    def _first_after(self, timestamp):
+        """Logical index of the first sample strictly newer than timestamp."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[self._physical(mid)] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def latest_timestamp(self):
+        with self._lock:
+            if not self._count:
+                return None
+            return self._times[self._physical(self._count - 1)]
+
+    def since(self, timestamp=None, limit=None):
+        """
+        Return samples newer than timestamp as columns:
+        {"timestamp": [...], <field>: [...], ...}.
+        With limit, only the most recent `limit` of those samples are returned.
+        """
+        with self._lock:
+            first = 0 if timestamp is None else self._first_after(timestamp)
+            if limit is not None:
+                first = max(first, self._count - limit)
+            indices = [self._physical(i) for i in range(first, self._count)]
+            result = {"timestamp": [self._times[i] for i in indices]}
+            for column, field in zip(self._columns, self.fields):
+                result[field] = [None if math.isnan(column[i]) else column[i] for i in indices]
+            return result
+
+
+class _HostWindow:
+    __slots__ = ('ring', 'info', 'total', 'marks')
+
+    def __init__(self, fields, capacity):
+        self.ring = SampleRing(fields, capacity)
+        self.info = {}
+        self.total = 0   # samples ever appended
+        # (sequence number, total after that append); older marks only ever
+        # cover samples that have already left the ring
+        self.marks = collections.deque(maxlen=capacity)
+
+
+class HostWindows:
+    """
+    Recent samples of many hosts, one SampleRing each.
+
+    Hosts report at different times and their samples arrive out of time
+    order across hosts, so readers resume from a sequence number (the
+    cursor) instead of a timestamp: since(cursor) returns exactly the
+    samples appended after the read that returned that cursor.
+    """
+
+    def __init__(self, fields, capacity=1800):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._hosts = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def append(self, key, timestamps, samples, info=None):
+        """
+        Append one host's samples: parallel lists of timestamps and mappings
+        of field to value. Samples not newer than the host's latest are
+        dropped. info (hostname etc.) replaces the host's details.
+        """
+        with self._lock:
+            window = self._hosts.get(key)
+            if window is None:
+                window = self._hosts[key] = _HostWindow(self.fields, self.capacity)
+            if info is not None:
+                window.info = dict(info)
+            latest = window.ring.latest_timestamp()
+            added = 0
+            for timestamp, values in zip(timestamps, samples):
+                if latest is not None and timestamp <= latest:
+                    continue
+                window.ring.append(timestamp, values)
+                latest = timestamp
+                added += 1
+            if added:
+                self._seq += 1
+                window.total += added
+                window.marks.append((self._seq, window.total))
+            return added
+
+    def since(self, cursor=0, keys=None):
+        """
+        Return (cursor, {key: dict(info, timestamp=[...], <field>=[...])})
+        with the samples appended after cursor, for every host or only
+        those whose key or hostname is in keys. Raises ValueError for a
+        cursor never handed out, e.g. one from before a restart.
+        """
+        with self._lock:
+            if not 0 <= cursor <= self._seq:
+                raise ValueError(f"unknown cursor {cursor}, the latest is {self._seq}")
+            hosts = {}
+            for key, window in self._hosts.items():
+                if keys is not None and key not in keys and window.info.get('hostname') not in keys:
+                    continue
+                seen = 0
+                for seq, total in reversed(window.marks):
+                    if seq <= cursor:
+                        seen = total
+                        break
+                new = min(window.total - seen, len(window.ring))
+                if new > 0:
+                    hosts[key] = dict(window.info, **window.ring.since(limit=new))
+            return self._seq, hosts
+
+    @property
+    def sequence(self):
+        """Cursor of the latest append; changes whenever new samples arrive."""
+        return self._seq
+
+    def remove(self, key):
+        with self._lock:
+            self._hosts.pop(key, None)
+
+    def __len__(self):
+        return len(self._hosts)
@@ -0,0 +1,259 @@
+"""
+Self-instrumentation of the monitoring server, served at /debug/stats.
+
+Latencies (agent polls, storage writes, store queries, JSON encoding and
+every HTTP route) go into log-bucket histograms: constant memory per name
+and percentiles within about 12% of the true value. The same histograms
+back the Prometheus ones at /metrics/prom, so each duration is recorded
+once. Response sizes are counted per route. Recording is a lock and a few
+additions, cheap enough to leave on all the time.
+
+SamplingProfiler is off by default. While it runs (until stopped, or for
+a set time) it samples the stacks of all threads every few milliseconds and renders them as collapsed
+stacks ("frame;frame;frame count" lines), the input format of
+flamegraph.pl and speedscope.
+"""
+import collections
+import math
+import sys
+import threading
+import time
+
+from flask import g, request
+
+from lamn.prometheus import add_histogram
+
+BUCKET_BASE = 1e-4      # seconds, upper bound of the first bucket
+BUCKET_GROWTH = 1.25    # each bucket is 25% wider than the previous one
+BUCKETS = 64            # up to about 160 seconds; slower goes in the last bucket
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_MAX_SECONDS = 60  # longest timed profile a request can start
+
+
+# Upper bounds of the buckets but the last, which has none; rounded for the exposition
+BOUNDS = [float(f'{BUCKET_BASE * BUCKET_GROWTH ** index:.4g}') for index in range(BUCKETS - 1)]
+
+
+class LatencyHistogram:
+    """Count, sum, max and log-spaced buckets of durations in seconds."""
+
+    __slots__ = ('counts', 'count', 'total', 'max', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        if seconds <= BUCKET_BASE:
+            index = 0
+        else:
+            index = min(BUCKETS - 1, int(math.ceil(math.log(seconds / BUCKET_BASE, BUCKET_GROWTH))))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q, counts, count, high):
+        rank = q * count
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKET_BASE * BUCKET_GROWTH ** index, high)
+        return high
+
+    def summary(self):
+        with self._lock:
+            counts, count, total, high = list(self.counts), self.count, self.total, self.max
+        if not count:
+            return {"count": 0}
+        return {
+            "count": count,
+            "mean": total / count,
+            "p50": self.quantile(0.5, counts, count, high),
+            "p95": self.quantile(0.95, counts, count, high),
+            "p99": self.quantile(0.99, counts, count, high),
+            "max": high
+        }
+
+    def collect(self, exposition, name, help):
+        """Add the histogram to a Prometheus exposition, its buckets as the le bounds."""
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.total
+        add_histogram(exposition, name, help, BOUNDS, counts, total, count)
+
+
+class SizeStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0,
+                "max": self.max, "total": self.total}
+
+
+class Stats:
+    """Named latency histograms and per-route response sizes; thread-safe."""
+
+    def __init__(self):
+        self.started = time.time()
+        self._latency = {}
+        self._sizes = collections.defaultdict(SizeStats)
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self._latency.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._latency.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def record(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def timer(self, name):
+        """Context manager recording the duration of its block under name."""
+        return _Timer(self.histogram(name))
+
+    def record_size(self, name, size):
+        with self._lock:
+            sizes = self._sizes[name]
+            sizes.count += 1
+            sizes.total += size
+            sizes.max = max(sizes.max, size)
+
+    def latency(self):
+        return {name: histogram.summary() for name, histogram in sorted(self._latency.items())}
+
+    def sizes(self):
+        with self._lock:
+            return {name: sizes.summary() for name, sizes in sorted(self._sizes.items())}
+
+    def instrument(self, app):
+        """Time every request of a Flask app and count its response size, per route."""
+        @app.before_request
+        def start_timer():
+            g.request_started = time.perf_counter()
+
+        @app.after_request
+        def stop_timer(response):
+            started = g.get('request_started')
+            if started is not None:
+                route = f"{request.method} {request.url_rule.rule if request.url_rule else '<unmatched>'}"
+                self.record(f"route {route}", time.perf_counter() - started)
+                # Streamed responses have no length until they are sent
+                if not response.is_streamed:
+                    self.record_size(route, response.calculate_content_length() or 0)
+            return response
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+def thread_counts():
+    """Live threads by name, numbered suffixes folded together."""
+    names = collections.Counter(thread.name.rstrip('0123456789').rstrip('-_ ') or thread.name
+                                for thread in threading.enumerate())
+    return {"total": sum(names.values()), "by_name": dict(names.most_common())}
+
+
+# --- Sampling profiler ---
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples every thread's stack on a timer; collapsed() renders the counts."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.started = None
+        self._stacks = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, seconds=None):
+        """
+        Start sampling, discarding the previous profile; with seconds, sampling
+        stops by itself after that long. False if already running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._stacks = collections.Counter()
+            self.samples = 0
+            self.started = time.time()
+            self._stop.clear()
+            deadline = None if seconds is None else time.monotonic() + seconds
+            self._thread = threading.Thread(target=self._run, args=(deadline,), name="lamn-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return False
+        self._stop.set()
+        thread.join()
+        return True
+
+    def _run(self, deadline):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+        with self._lock:
+            # Timed out rather than stopped: no longer running
+            if self._thread is threading.current_thread():
+                self._thread = None
+
+    def collapsed(self):
+        """The profile as collapsed stacks, one "thread;outer;...;inner count" line per stack."""
+        stacks = list(self._stacks.items())
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks))
+
+    def status(self):
+        return {"running": self.running, "started": self.started, "samples": self.samples,
+                "interval": self.interval}
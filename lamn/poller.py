@@ -0,0 +1,218 @@
+"""
+Asyncio poller for lamn agents.
+
+All agents are polled from one event loop running in a background thread,
+instead of one OS thread per agent per cycle. Connections are kept alive
+and pooled per agent, the number of requests in flight is capped by a
+semaphore, and every poll has a deadline. Each poll returns a PollResult
+instead of raising, so callers handle successes and failures uniformly.
+
+Only the small subset of HTTP/1.1 needed to talk to the Flask agents is
+implemented here (GET, Content-Length or chunked bodies, keep-alive), which
+keeps the server free of an async HTTP client dependency.
+"""
+import asyncio
+import collections
+import json
+import threading
+import time
+from urllib.parse import urlencode
+
+AGENT_PORT = 5000
+MAX_IN_FLIGHT = 256     # concurrent agent polls
+POLL_TIMEOUT = 10       # seconds allowed for one agent poll, both requests included
+MAX_IDLE_PER_HOST = 2   # idle keep-alive connections kept per agent
+
+PollResult = collections.namedtuple(
+    'PollResult', ['ip', 'ok', 'data', 'samples', 'error', 'latency', 'polled_at'])
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f"HTTP {status} {reason}")
+        self.status = status
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Keep-alive connections to agents, pooled per (host, port)."""
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = collections.defaultdict(list)
+
+    async def _read_body(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers up to the terminating blank line.
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks), True
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length'])), True
+        # No framing: the body runs until the agent closes the connection.
+        return await reader.read(), False
+
+    async def _exchange(self, conn, host, path):
+        conn.writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept: application/json\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode('latin-1'))
+        await conn.writer.drain()
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by agent")
+        parts = status_line.decode('latin-1').split(' ', 2)
+        version, status = parts[0], int(parts[1])
+        reason = parts[2].strip() if len(parts) > 2 else ''
+        headers = {}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body, framed = await self._read_body(conn.reader, headers)
+        connection = headers.get('connection', '').lower()
+        reusable = framed and connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+        return status, reason, body, reusable
+
+    async def get(self, host, port, path):
+        """Return (status, reason, body) for a GET request."""
+        key = (host, port)
+        idle = self._idle[key]
+        while True:
+            reused = bool(idle)
+            if reused:
+                conn = idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(host, port)
+                conn = _Connection(reader, writer)
+            try:
+                status, reason, body, reusable = await self._exchange(conn, host, path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if reused:
+                    # The agent dropped an idle connection; retry on a fresh one.
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if reusable and len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+            else:
+                conn.close()
+            return status, reason, body
+
+    def discard(self, host, port):
+        """Close the idle connections to one agent, e.g. after it stopped answering."""
+        for conn in self._idle.pop((host, port), []):
+            conn.close()
+
+    def close(self):
+        for key in list(self._idle):
+            self.discard(*key)
+
+
+class AgentPoller:
+    """
+    Poll agents' /metrics and /metrics/history from a private event loop.
+
+    poll_many() can be called from any thread; it blocks until every agent
+    has answered or hit its deadline and returns one PollResult per agent.
+    """
+
+    def __init__(self, port=AGENT_PORT, max_in_flight=MAX_IN_FLIGHT, timeout=POLL_TIMEOUT):
+        self.port = port
+        self.ports = {}   # ip -> port of agents not listening on the default one
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.pool = ConnectionPool()
+        self.loop = None
+        self._semaphore = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run, name="lamn-poller", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _get_json(self, ip, path):
+        status, reason, body = await self.pool.get(ip, self.ports.get(ip, self.port), path)
+        if status == 404:
+            return None
+        if status >= 400:
+            raise HttpError(status, reason)
+        return json.loads(body)
+
+    async def _poll(self, ip, history_params):
+        data = await self._get_json(ip, '/metrics')
+        samples = None
+        if history_params is not None:
+            try:
+                history = await self._get_json(ip, '/metrics/history?' + urlencode(history_params))
+                samples = history.get('samples') if history else None
+            except (HttpError, ValueError):
+                samples = None
+        return data, samples
+
+    async def poll(self, ip, history_params=None):
+        """Poll one agent; never raises, failures are reported in the result."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            polled_at = time.time()
+            started = time.monotonic()
+            try:
+                data, samples = await asyncio.wait_for(self._poll(ip, history_params), self.timeout)
+                if data is None:
+                    raise HttpError(404, "NOT FOUND")
+                return PollResult(ip, True, data, samples, None, time.monotonic() - started, polled_at)
+            except asyncio.TimeoutError:
+                error = f"Timeout error: no answer within {self.timeout}s"
+            except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                error = f"Connection error: {e}"
+            except Exception as e:
+                error = f"Unexpected error: {e}"
+            self.pool.discard(ip, self.ports.get(ip, self.port))
+            return PollResult(ip, False, None, None, error, time.monotonic() - started, polled_at)
+
+    async def _poll_all(self, ips, history_params_for):
+        return await asyncio.gather(*(
+            self.poll(ip, history_params_for(ip) if history_params_for else None) for ip in ips))
+
+    def submit(self, coro):
+        """Schedule a coroutine on the poller loop and return a concurrent Future."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def poll_many(self, ips, history_params_for=None):
+        """
+        Poll every agent in ips concurrently and return their PollResults.
+        history_params_for(ip) returns the /metrics/history query for an agent,
+        or None to skip fetching its history.
+        """
+        if not ips:
+            return []
+        return self.submit(self._poll_all(list(ips), history_params_for)).result()
@@ -0,0 +1,160 @@
+"""
+Prometheus text exposition (format 0.0.4) of LAMN metrics.
+
+Written without the prometheus_client package: the client exposes the
+values of its latest sample, the server every agent's latest payload plus
+its own counters. Both build an Exposition once per change of the
+underlying snapshot and serve the cached text to every scrape, so a scrape
+costs little more than sending the bytes, however many series there are.
+"""
+import math
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Exposition:
+    """Samples grouped by metric family, rendered in the text format."""
+
+    def __init__(self):
+        self._families = {}  # name -> (type, help, sample lines)
+
+    def add(self, name, value, labels=None, kind='gauge', help='', family=None):
+        """Add one sample; None values are skipped. family defaults to name."""
+        if value is None:
+            return
+        try:
+            text = _value(value)
+        except (TypeError, ValueError):
+            return
+        entry = self._families.get(family or name)
+        if entry is None:
+            entry = self._families[family or name] = (kind, help, [])
+        entry[2].append(f'{name}{_labels(labels)} {text}')
+
+    def render(self):
+        lines = []
+        for name, (kind, help, samples) in self._families.items():
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class Counter:
+    """Monotonic counter with optional label values; thread-safe."""
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self, exposition):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            exposition.add(self.name, value, dict(zip(self.label_names, label_values)),
+                           kind='counter', help=self.help)
+
+
+def add_histogram(exposition, name, help, bounds, counts, total, count):
+    """
+    Add a histogram family to an exposition: counts[i] observations fell in
+    the bucket ending at bounds[i]; count includes those above the last bound.
+    """
+    cumulative = 0
+    for bound, n in zip(bounds, counts):
+        cumulative += n
+        exposition.add(f'{name}_bucket', cumulative, {'le': _value(float(bound))},
+                       kind='histogram', help=help, family=name)
+    exposition.add(f'{name}_bucket', count, {'le': '+Inf'}, kind='histogram', help=help, family=name)
+    exposition.add(f'{name}_sum', total, family=name)
+    exposition.add(f'{name}_count', count, family=name)
+
+
+# --- Agent metrics ---
+
+# (metric name, key in the agent's /metrics payload, help)
+AGENT_GAUGES = [
+    ('lamn_cpu_percent', 'cpu', 'CPU utilization in percent'),
+    ('lamn_memory_percent', 'memory', 'Memory utilization in percent'),
+    ('lamn_gpu_percent', 'gpu', 'Mean utilization of all GPUs in percent'),
+    ('lamn_disk_used_percent', 'disk_percent_used', 'Used space of the monitored filesystems in percent'),
+    ('lamn_disk_read_bytes_per_second', 'disk_read_bps', 'Disk read rate'),
+    ('lamn_disk_write_bytes_per_second', 'disk_write_bps', 'Disk write rate'),
+    ('lamn_disk_iops', 'disk_iops', 'Disk read and write operations per second'),
+    ('lamn_network_receive_bytes_per_second', 'net_rx_bps', 'Network receive rate, loopback excluded'),
+    ('lamn_network_transmit_bytes_per_second', 'net_tx_bps', 'Network transmit rate, loopback excluded'),
+    ('lamn_network_packets_per_second', 'net_pps', 'Network packets received and sent per second'),
+]
+GPU_GAUGES = [
+    ('lamn_gpu_utilization_percent', 'utilization', 1, 'Utilization of one GPU in percent'),
+    ('lamn_gpu_memory_used_bytes', 'memory_used', 1024 ** 2, 'Memory used on one GPU'),
+    ('lamn_gpu_memory_total_bytes', 'memory_total', 1024 ** 2, 'Memory of one GPU'),
+    ('lamn_gpu_temperature_celsius', 'temperature', 1, 'Temperature of one GPU'),
+]
+DEVICE_GAUGES = [
+    ('lamn_device_read_bytes_per_second', 'disks', 'read_bps', 'device', 'Read rate of one disk'),
+    ('lamn_device_write_bytes_per_second', 'disks', 'write_bps', 'device', 'Write rate of one disk'),
+    ('lamn_nic_receive_bytes_per_second', 'nics', 'rx_bps', 'nic', 'Receive rate of one network interface'),
+    ('lamn_nic_transmit_bytes_per_second', 'nics', 'tx_bps', 'nic', 'Transmit rate of one network interface'),
+]
+
+
+def add_agent_metrics(exposition, metrics, labels=None):
+    """Gauges of one agent's /metrics payload, with labels added to every sample."""
+    labels = labels or {}
+    for name, key, help in AGENT_GAUGES:
+        exposition.add(name, metrics.get(key), labels, help=help)
+    for gpu in metrics.get('gpus') or ():
+        gpu_labels = dict(labels, gpu=str(gpu.get('index')), model=gpu.get('name') or '')
+        for name, key, scale, help in GPU_GAUGES:
+            value = gpu.get(key)
+            exposition.add(name, None if value is None else value * scale, gpu_labels, help=help)
+    io = metrics.get('io') or {}
+    for name, group, key, label, help in DEVICE_GAUGES:
+        for device, rates in sorted((io.get(group) or {}).items()):
+            exposition.add(name, rates.get(key), dict(labels, **{label: device}), help=help)
+
+
+def agents_exposition(agents):
+    """Exposition of every agent's latest payload, {ip: payload}, labelled by ip and hostname."""
+    exposition = Exposition()
+    for ip, payload in agents.items():
+        labels = {'ip': ip, 'hostname': payload.get('host') or ip}
+        failed = 'error' in payload
+        exposition.add('lamn_agent_up', 0 if failed else 1, labels,
+                       help='1 if the last poll of the agent succeeded')
+        if not failed:
+            add_agent_metrics(exposition, payload, labels)
+    return exposition
@@ -0,0 +1,112 @@
+"""
+Cached, compressed and conditional responses for the server's JSON endpoints.
+
+Responses are cached per key (the endpoint and its query string) together
+with the version of the data they were built from, so a body is
+serialized and compressed once per change instead of once per request.
+Every response carries an ETag derived from that version and is answered
+with 304 Not Modified when the client already has it. Large bodies are
+compressed with brotli when the brotli package is installed and the client
+accepts it, otherwise with gzip.
+"""
+import collections
+import gzip
+import hashlib
+import threading
+import time
+
+from flask import Response, request
+
+try:
+    import brotli  # optional: smaller bodies for remote viewers
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_BYTES = 1024   # smaller bodies are sent as they are
+CACHE_ENTRIES = 64          # bodies kept, least recently used dropped first
+
+# Distinguishes ETags of this process from those of an earlier run, whose
+# version counters started from the same values
+BOOT_ID = f"{int(time.time() * 1000):x}"
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+class _Entry:
+    __slots__ = ('version', 'etag', 'body', 'headers', 'encoded')
+
+    def __init__(self, version, etag, body, headers):
+        self.version = version
+        self.etag = etag
+        self.body = body
+        self.headers = headers
+        self.encoded = {}
+
+
+class ResponseCache:
+    """LRU cache of serialized response bodies keyed by request and data version."""
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _etag(self, key, version):
+        digest = hashlib.sha1(f"{BOOT_ID}|{key}|{version}".encode()).hexdigest()[:20]
+        return digest
+
+    def _encoding(self, size):
+        if size < MIN_COMPRESS_BYTES:
+            return None
+        accepted = request.accept_encodings
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def respond(self, key, version, build, mimetype='application/json'):
+        """
+        Response for key at version; build() returns (body bytes, extra
+        headers) and is only called when the cached body is out of date.
+        """
+        etag = self._etag(key, version)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(key)
+            else:
+                entry = None
+        if entry is None:
+            body, headers = build()
+            entry = _Entry(version, etag, body, headers or {})
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        encoding = self._encoding(len(entry.body))
+        if encoding is None:
+            payload = entry.body
+        else:
+            payload = entry.encoded.get(encoding)
+            if payload is None:
+                payload = entry.encoded[encoding] = _compress(entry.body, encoding)
+        response = Response(payload, mimetype=mimetype, headers=entry.headers)
+        response.set_etag(etag)
+        # Browsers revalidate every time, which costs a 304 while nothing changed
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
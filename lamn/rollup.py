@@ -0,0 +1,178 @@
+"""
+Multi-resolution rollups of logged samples.
+
+Samples are aggregated per host into 1 minute, 15 minute and 1 hour
+buckets as they are written, so a long-range query reads a few hundred
+pre-aggregated rows per host instead of every raw sample. Each bucket
+keeps min, max, mean and p95 of every metric. The p95 comes from a
+log-bucket sketch (about 1% relative error) that merges exactly, so a
+bucket can keep absorbing samples across write batches and restarts.
+"""
+import json
+import math
+
+import numpy as np
+
+TIERS = [60, 900, 3600]   # rollup bucket widths, in seconds
+RAW_INTERVAL = 1          # seconds between raw samples
+MAX_POINTS = 1000         # points per host a range query aims to stay under
+STATS = ['min', 'max', 'mean', 'p95']
+SKETCH_ACCURACY = 0.01    # relative error of the p95 estimate
+
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+_MIN_VALUE = 1e-9
+ZERO_KEY = -(2 ** 31)     # sketch bucket of zero (and negative) values
+
+
+def choose_resolution(start, end, max_points=MAX_POINTS):
+    """
+    Resolution (0 for raw samples, otherwise a tier width) for a query
+    from start to end: the finest one returning at most max_points per host.
+    """
+    span = max(0.0, end - start)
+    if span <= max_points * RAW_INTERVAL:
+        return 0
+    for tier in TIERS:
+        if span / tier <= max_points:
+            return tier
+    return TIERS[-1]
+
+
+def sketch_keys(values):
+    """Sketch bucket index of each value in a float array."""
+    keys = np.full(len(values), ZERO_KEY, dtype=np.int64)
+    positive = values > _MIN_VALUE
+    keys[positive] = np.ceil(np.log(values[positive]) / _LOG_GAMMA)
+    return keys
+
+
+class MetricAggregate:
+    """count, sum, min, max and a quantile sketch of one metric."""
+
+    __slots__ = ('count', 'total', 'low', 'high', 'sketch', 'p95')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+        self.sketch = {}   # bucket index -> count
+        self.p95 = None    # fixed p95 of a bucket restored without its sketch
+
+    def add(self, values):
+        """Add an array of samples; NaNs are ignored."""
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        low, high = float(values.min()), float(values.max())
+        self.low = low if self.low is None else min(self.low, low)
+        self.high = high if self.high is None else max(self.high, high)
+        if self.sketch is not None:
+            keys, counts = np.unique(sketch_keys(values), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.sketch[key] = self.sketch.get(key, 0) + count
+
+    def quantile(self, q):
+        if self.sketch is None:
+            return self.p95
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.sketch):
+            seen += self.sketch[key]
+            if seen > rank:
+                if key == ZERO_KEY:
+                    value = 0.0
+                else:
+                    value = 2 * _GAMMA ** key / (_GAMMA + 1)
+                return min(max(value, self.low), self.high)
+        return self.high
+
+    def stats(self):
+        """(min, max, mean, p95), all None without samples."""
+        if not self.count:
+            return (None, None, None, None)
+        return (self.low, self.high, self.total / self.count, self.quantile(0.95))
+
+    def state(self):
+        return [self.count, self.total, self.low, self.high,
+                [[k, c] for k, c in self.sketch.items()]]
+
+    @classmethod
+    def from_state(cls, state):
+        agg = cls()
+        agg.count, agg.total, agg.low, agg.high, pairs = state
+        agg.sketch = {k: c for k, c in pairs}
+        return agg
+
+    @classmethod
+    def from_stats(cls, count, low, high, mean, p95):
+        """Rebuild a closed bucket from its stored stats; p95 stays fixed from then on."""
+        agg = cls()
+        if count and mean is not None:
+            agg.count, agg.total, agg.low, agg.high = count, mean * count, low, high
+        agg.sketch = None
+        agg.p95 = p95
+        return agg
+
+
+class Bucket:
+    """One rollup bucket of one host: an aggregate per metric."""
+
+    def __init__(self, metrics, aggregates=None, samples=0):
+        self.metrics = list(metrics)
+        self.aggregates = aggregates or [MetricAggregate() for _ in self.metrics]
+        self.samples = samples
+
+    def add(self, matrix):
+        """Add samples given as a (samples x metrics) float array."""
+        self.samples += len(matrix)
+        for i, agg in enumerate(self.aggregates):
+            agg.add(matrix[:, i])
+
+    def values(self):
+        """samples followed by min, max, mean and p95 of every metric."""
+        values = [self.samples]
+        for agg in self.aggregates:
+            values.extend(agg.stats())
+        return values
+
+    def state(self):
+        """JSON state needed to keep adding samples to this bucket."""
+        return json.dumps([agg.state() for agg in self.aggregates], separators=(',', ':'))
+
+    @classmethod
+    def from_state(cls, metrics, samples, state):
+        return cls(metrics, [MetricAggregate.from_state(s) for s in json.loads(state)], samples)
+
+    @classmethod
+    def from_values(cls, metrics, values):
+        """Inverse of values(), for buckets stored without state."""
+        samples = values[0] or 0
+        aggregates = []
+        for i in range(len(metrics)):
+            low, high, mean, p95 = values[1 + 4 * i:5 + 4 * i]
+            aggregates.append(MetricAggregate.from_stats(samples, low, high, mean, p95))
+        return cls(metrics, aggregates, samples)
+
+
+def rollup_columns(metrics):
+    """Stat columns of a rollup table, in Bucket.values() order after samples."""
+    return [f'{m}_{s}' for m in metrics for s in STATS]
+
+
+def group_samples(timestamps, keys, tier):
+    """
+    Split samples into (key, bucket start, indices) groups for one tier,
+    ordered by key and then by bucket start.
+    """
+    starts = np.floor(timestamps / tier) * tier
+    order = np.lexsort((timestamps, starts, keys))
+    keys, starts = keys[order], starts[order]
+    breaks = np.flatnonzero((keys[1:] != keys[:-1]) | (starts[1:] != starts[:-1])) + 1
+    for first, indices in zip(np.concatenate(([0], breaks)), np.split(order, breaks)):
+        yield int(keys[first]), float(starts[first]), indices
@@ -0,0 +1,203 @@
+"""
+Per-agent polling schedule.
+
+Every agent has its own next-due time and interval, kept in a heap so the
+polling loop only ever looks at the agents that are actually due. Agents
+are first scheduled at a random offset within their interval so polls are
+spread over the period instead of arriving all at once. Successful polls
+keep a fixed rate relative to the previous due time, failures back off
+exponentially up to a cap and the backoff resets on the next success.
+Flagged agents are polled on a shorter interval.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+
+DEFAULT_INTERVAL = 150   # seconds between polls of a healthy agent
+FAST_INTERVAL = 15       # seconds between polls of a flagged agent
+MAX_BACKOFF = 1800       # longest delay between polls of a failing agent
+JITTER = 0.1             # +/- fraction applied to every delay
+
+
+class AgentSchedule:
+    __slots__ = ('ip', 'interval', 'fast_interval', 'due', 'failures',
+                 'in_flight', 'generation', 'last_ok', 'last_error')
+
+    def __init__(self, ip, interval, due):
+        self.ip = ip
+        self.interval = interval
+        self.fast_interval = None
+        self.due = due
+        self.failures = 0
+        self.in_flight = False
+        self.generation = 0
+        self.last_ok = None
+        self.last_error = None
+
+    @property
+    def effective_interval(self):
+        return self.fast_interval or self.interval
+
+    def as_dict(self):
+        return {
+            "interval": self.interval,
+            "fast_interval": self.fast_interval,
+            "next_due": self.due,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "last_ok": self.last_ok,
+            "last_error": self.last_error
+        }
+
+
+class PollScheduler:
+    """
+    Heap of agents ordered by next-due time.
+
+    pop_due() hands out the agents that are due and marks them in flight;
+    record() reschedules an agent once its poll has finished. All methods
+    are thread-safe.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, max_backoff=MAX_BACKOFF, jitter=JITTER, clock=time.time):
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.clock = clock
+        self._agents = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _push(self, agent):
+        # Generations come from one counter for all agents, so a stale heap
+        # entry never matches an agent removed and added again under its ip
+        agent.generation = next(self._seq)
+        heapq.heappush(self._heap, (agent.due, agent.generation, agent.ip))
+
+    def sync(self, ips, intervals=None):
+        """
+        Make the schedule match the configured agents: new agents are
+        scheduled at a random offset within their interval, removed agents are
+        dropped. intervals optionally maps ip to a per-agent interval.
+        """
+        intervals = intervals or {}
+        now = self.clock()
+        with self._lock:
+            wanted = set(ips)
+            for ip in list(self._agents):
+                if ip not in wanted:
+                    # Heap entries of removed agents are skipped when popped.
+                    del self._agents[ip]
+            for ip in ips:
+                interval = intervals.get(ip) or self.interval
+                agent = self._agents.get(ip)
+                if agent is None:
+                    agent = AgentSchedule(ip, interval, now + random.uniform(0, interval))
+                    self._agents[ip] = agent
+                    self._push(agent)
+                elif agent.interval != interval:
+                    agent.interval = interval
+                    if not agent.in_flight and agent.due > now + agent.effective_interval:
+                        agent.due = now + agent.effective_interval
+                        self._push(agent)
+
+    def pop_due(self, now=None):
+        """Return the agents that are due and mark them in flight."""
+        now = self.clock() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, generation, ip = heapq.heappop(self._heap)
+                agent = self._agents.get(ip)
+                if agent is None or agent.generation != generation or agent.in_flight:
+                    continue
+                agent.in_flight = True
+                due.append(ip)
+        return due
+
+    def next_due(self):
+        """Time of the earliest scheduled poll, or None when nothing is scheduled."""
+        with self._lock:
+            while self._heap:
+                due, generation, ip = self._heap[0]
+                agent = self._agents.get(ip)
+                if agent is not None and agent.generation == generation and not agent.in_flight:
+                    return due
+                heapq.heappop(self._heap)
+            return None
+
+    def record(self, ip, ok, error=None, now=None):
+        """Reschedule an agent after a poll finished."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            agent = self._agents.get(ip)
+            if agent is None:
+                return
+            agent.in_flight = False
+            if ok:
+                agent.failures = 0
+                agent.last_ok = now
+                agent.last_error = None
+                # Fixed rate: the next poll is due one interval after the
+                # previous due time, unless the poll overran it.
+                agent.due = agent.due + self._jittered(agent.effective_interval)
+                if agent.due <= now:
+                    agent.due = now + self._jittered(agent.effective_interval)
+            else:
+                agent.failures += 1
+                agent.last_error = error
+                backoff = min(agent.effective_interval * 2 ** agent.failures, self.max_backoff)
+                agent.due = now + self._jittered(max(agent.effective_interval, backoff))
+            self._push(agent)
+
+    def flag(self, ip, interval=FAST_INTERVAL):
+        """Poll an agent every `interval` seconds until unflagged; returns False for unknown agents."""
+        now = self.clock()
+        with self._lock:
+            agent = self._agents.get(ip)
+            if agent is None:
+                return False
+            agent.fast_interval = interval
+            agent.failures = 0
+            if not agent.in_flight and agent.due > now + interval:
+                agent.due = now
+                self._push(agent)
+            return True
+
+    def unflag(self, ip):
+        with self._lock:
+            agent = self._agents.get(ip)
+            if agent is None:
+                return False
+            agent.fast_interval = None
+            return True
+
+    def poll_now(self, ips=None):
+        """
+        Make agents (all of them by default) due immediately; returns the
+        ones scheduled. Agents already being polled are left alone.
+        """
+        now = self.clock()
+        scheduled = []
+        with self._lock:
+            for ip in list(self._agents if ips is None else ips):
+                agent = self._agents.get(ip)
+                if agent is not None and not agent.in_flight:
+                    agent.due = now
+                    self._push(agent)
+                    scheduled.append(ip)
+        return scheduled
+
+    def snapshot(self):
+        """Per-agent schedule state, for display."""
+        with self._lock:
+            return {ip: agent.as_dict() for ip, agent in self._agents.items()}
+
+    def __len__(self):
+        return len(self._agents)
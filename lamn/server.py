@@ -1,10 +1,22 @@
-from flask import Flask, render_template, jsonify, request, send_file
-import requests, threading, time, logging
-from lamn.config import load_agents
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
+import threading, time, logging
+import atexit, bisect, queue
+from lamn.alerts import AlertEngine
+from lamn.anomaly import AnomalyDetector
+from lamn.config import load_settings, registry
+from lamn.events import EventHub
+from lamn.federation import Federation
+from lamn.history import HostWindows
+from lamn.instrument import PROFILE_MAX_SECONDS, SamplingProfiler, Stats, thread_counts
+from lamn.responses import ResponseCache
+from lamn.snapshot import LiveSnapshot, dumps
+from lamn.rollup import choose_resolution, RAW_INTERVAL
+from lamn.poller import AgentPoller, MAX_IN_FLIGHT, POLL_TIMEOUT
+from lamn.prometheus import CONTENT_TYPE, Counter, Exposition, agents_exposition
+from lamn.scheduler import PollScheduler, FAST_INTERVAL
+from lamn.storage import ArchiveManager, BatchWriter, CSV_COLUMNS, HOST_COLUMNS, METRIC_COLUMNS, open_store
+from lamn.storage import RETENTION_BYTES, RETENTION_DAYS, STORE_RETENTION_DAYS
 import os
-import csv
-from datetime import datetime
-import pandas as pd
 
 # Clear proxy environment variables for this process only
 if 'ALL_PROXY' in os.environ:
@@ -31,89 +43,134 @@ app.logger.disabled = True
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 logging.getLogger('urllib3').setLevel(logging.ERROR)
 
-# --- SOCKS Proxy Configuration ---
-SOCKS_HOST = '127.0.0.1'
-SOCKS_PORT = 1080  # Your tunnel is on port 1080, not 8080
-USE_SOCKS = False  # Temporarily disable SOCKS to test
-USE_SSH_FORWARD = False
-
-# --- Setup SOCKS Session ---
-def create_session():
-    """Create a requests session for direct connections"""
-    return requests.Session()
-
-# Session for direct connections
-session = create_session()
-
-# Alternative: Global SOCKS setup (uncomment if needed)
-def setup_global_socks():
-    """Setup global SOCKS proxy for all socket connections"""
-    try:
-        socks.set_default_proxy(socks.SOCKS5, SOCKS_HOST, SOCKS_PORT)
-        socket.socket = socks.socksocket
-        print(f"Global SOCKS proxy configured: {SOCKS_HOST}:{SOCKS_PORT}")
-    except Exception as e:
-        print(f"Failed to setup global SOCKS proxy: {e}")
-
-# Uncomment the next line if you want to use global SOCKS instead of session-based
-# setup_global_socks()
+# Optional server settings from ~/.lamn_config.json
+settings = load_settings()
 
 # --- Shared data ---
-metrics_data = {}
+POLL_INTERVAL = 150  # seconds between polls of a healthy agent
+AGENT_SYNC_INTERVAL = 5  # seconds between checks of ~/.agents.json for changes
+live_metrics = LiveSnapshot()  # latest payload of every agent, replaced on each change
+history_cursors = {}  # ip -> timestamp of the newest sample already logged
 csv_file_path = 'logs/machine_metrics.csv'
+events = EventHub()  # live updates for /stream clients
+responses = ResponseCache()  # serialized /metrics and /csv_data bodies
+alerts = AlertEngine.from_settings(settings)  # rules from "alerts" in ~/.lamn_config.json
+federation = Federation.from_settings(settings)  # which agents this server polls when it is a shard
+stats = Stats()  # latencies and response sizes for /debug/stats
+stats.instrument(app)
+profiler = SamplingProfiler()  # started and stopped through /debug/profile
 
 def clear_error_data():
     """Clear any cached error data"""
-    global metrics_data
-    metrics_data = {}
+    live_metrics.clear()
+    events.publish('snapshot', {})
     print("Cleared cached metrics data")
 
-# --- Setup CSV logging ---
-def setup_csv_logging():
+def forget_agents(ips):
+    """Drop everything kept in memory about agents that are no longer polled."""
+    for ip in ips:
+        alerts.remove(ip)
+        recent_samples.remove(ip)
+        detector.remove(ip)
+        history_cursors.pop(ip, None)
+        poll_latency.pop(ip, None)
+    snapshot = live_metrics.update_many({}, ips)
+    events.publish('snapshot', snapshot.body)
+
+def update_agent(ip, data):
+    """Publish a new snapshot with one agent's entry replaced and notify /stream clients."""
+    snapshot = live_metrics.update(ip, data)
+    events.publish('agent', b'{"ip":' + dumps(ip) + b',"data":' + snapshot.encoded(ip) + b'}')
+
+# --- Setup metric storage ---
+# Per-sample metric columns, as (CSV column, field in the agent payload and history)
+SAMPLE_COLUMNS = [
+    ('cpu_percent', 'cpu'),
+    ('memory_percent', 'memory'),
+    ('disk_percent', 'disk_percent'),
+    ('gpu_percent', 'gpu'),
+    ('disk_read_bps', 'disk_read_bps'),
+    ('disk_write_bps', 'disk_write_bps'),
+    ('disk_iops', 'disk_iops'),
+    ('net_rx_bps', 'net_rx_bps'),
+    ('net_tx_bps', 'net_tx_bps'),
+    ('net_pps', 'net_pps'),
+]
+
+# Backend selected by "storage" in ~/.lamn_config.json: "sqlite" (default) or "csv"
+STORAGE_BACKEND = settings.get('storage', 'sqlite')
+store = None
+store_writer = None
+archiver = None
+
+def setup_storage():
+    """
+    Open the metric store; it is only ever written by the batch writer thread.
+    Rotated CSV logs are compressed and expired by the archive manager.
+    """
+    global store, store_writer, archiver
     os.makedirs('logs', exist_ok=True)
+    default_path = csv_file_path if STORAGE_BACKEND == 'csv' else 'logs/metrics.db'
+    store = open_store(STORAGE_BACKEND, settings.get('storage_path') or default_path)
+    store_writer = BatchWriter(store)
+    store_writer.on_write = lambda seconds, rows: stats.record('store.write', seconds)
+    atexit.register(store_writer.stop)
     
-    # Create CSV file with headers if it doesn't exist
-    if not os.path.exists(csv_file_path):
-        with open(csv_file_path, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                'timestamp', 'ip', 'hostname', 'cpu_percent', 'memory_percent', 
-                'disk_percent', 'gpu_percent', 'total_memory_gb', 'total_disk_gb',
-                'cpu_model', 'gpu_model', 'os_info'
-            ])
-
-setup_csv_logging()
+    # Archive retention comes from "retention_days" and "retention_bytes", 0 disabling
+    # one; stored samples are only pruned when "store_retention_days" is set
+    archiver = ArchiveManager(
+        store.path if store.kind == 'csv' else csv_file_path,
+        index=getattr(store, 'archives', None),
+        store=store,
+        compression=settings.get('archive_compression'),
+        max_age_days=settings.get('retention_days', RETENTION_DAYS),
+        max_bytes=settings.get('retention_bytes', RETENTION_BYTES),
+        store_max_age_days=settings.get('store_retention_days', STORE_RETENTION_DAYS)
+    )
+    if store.kind == 'csv':
+        store.log.on_archive = archiver.submit
+
+setup_storage()
+
+# --- Recent samples of every agent, kept in memory for /csv_data?since= ---
+RECENT_SAMPLES = settings.get('recent_samples', 1800)  # per agent, one per second
+recent_samples = HostWindows(METRIC_COLUMNS, capacity=RECENT_SAMPLES)
+detector = AnomalyDetector.from_settings(METRIC_COLUMNS, settings)  # outliers for /anomalies
 
 # --- Get list of agent IPs from config ---
 def get_agent_ips():
-    return load_agents()
-
-# --- Extract data and write to CSV ---
-def log_machine_data(ip, raw_data):
-    """Extract key metrics and append to CSV"""
+    """
+    Configured agents, or this shard's part of them in a federation;
+    ~/.agents.json is only parsed again after it changed.
+    """
+    return federation.local(registry.agents())
+
+# --- Extract data and write to the metric store ---
+def log_machine_data(ip, raw_data, samples=None, anomaly_batch=None):
+    """
+    Extract key metrics and queue them for the metric store.
+    samples are the columns returned by the agent's /metrics/history; when
+    given, one row is written per sample instead of one row for the snapshot.
+    The rows are checked for outliers at once, or appended to anomaly_batch
+    to be checked together with other hosts' rows.
+    """
     try:
-        # Check file size and rotate if needed
-        rotate_csv_if_needed()
-        
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        now = time.time()
         hostname = raw_data.get('host', ip.split('.')[-1])
         
-        # Extract basic metrics
-        cpu_percent = raw_data.get('cpu', 0)
-        memory_percent = raw_data.get('memory', 0)
-        gpu_percent = raw_data.get('gpu', 0) if raw_data.get('gpu') is not None else 0
+        # Extract basic metrics; a reading the agent did not send is stored
+        # as None, as on the history path, not as 0
+        cpu_percent = raw_data.get('cpu')
+        memory_percent = raw_data.get('memory')
+        gpu_percent = raw_data.get('gpu')
         
         # Extract disk percentage
-        disk_percent = 0
+        disk_percent = None
         if 'specs' in raw_data and 'disk_summary' in raw_data['specs']:
-            disk_percent = raw_data['specs']['disk_summary'].get('percent_used', 0)
+            disk_percent = raw_data['specs']['disk_summary'].get('percent_used')
         elif 'disk_percent_used' in raw_data:
             disk_percent = raw_data['disk_percent_used']
         
-        # Check for disk space warning
-        if disk_percent > 95:
-            print(f"DISK SPACE WARNING: {hostname} at {disk_percent:.1f}% disk usage!")
-        
         # Extract system info
         total_memory_gb = 0
         total_disk_gb = 0
@@ -142,126 +199,132 @@ def log_machine_data(ip, raw_data):
             if 'os' in specs:
                 os_info = f"{specs['os'].get('system', '')} {specs['os'].get('release', '')}".strip()
         
-        # Write to CSV
-        with open(csv_file_path, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                timestamp, ip, hostname, cpu_percent, memory_percent,
-                disk_percent, gpu_percent, total_memory_gb, total_disk_gb,
-                cpu_model, gpu_model, os_info
-            ])
+        # Snapshot values; I/O rates are absent on agents that predate them and
+        # are stored as None (NULL), which the aggregations skip
+        snapshot = {field: raw_data.get(field) for _, field in SAMPLE_COLUMNS}
+        snapshot.update(cpu=cpu_percent, memory=memory_percent, disk_percent=disk_percent, gpu=gpu_percent)
+        static = {
+            'ip': ip, 'hostname': hostname,
+            'total_memory_gb': total_memory_gb, 'total_disk_gb': total_disk_gb,
+            'cpu_model': cpu_model, 'gpu_model': gpu_model, 'os_info': os_info
+        }
+        
+        def build_record(ts, values):
+            # Epoch seconds: the store formats local time only where it writes CSV
+            record = dict(static, timestamp=ts)
+            for column, field in SAMPLE_COLUMNS:
+                record[column] = values[field]
+            return record
         
-        status_msg = f"Logged: {hostname} - CPU:{cpu_percent}% MEM:{memory_percent}% DISK:{disk_percent}%"
-        if USE_SOCKS:
-            status_msg += " (via SOCKS)"
+        if samples and samples.get('timestamp'):
+            # Fields missing from the history stay None: the snapshot is the
+            # current value and must not be copied into past samples
+            times = samples['timestamp']
+            missing = [None] * len(times)
+            columns = [(field, samples.get(field) or missing) for _, field in SAMPLE_COLUMNS]
+            records = [build_record(ts, {field: col[i] for field, col in columns})
+                       for i, ts in enumerate(times)]
+        else:
+            times = [now]
+            records = [build_record(now, snapshot)]
+        rows = [[record[column] for column in CSV_COLUMNS] for record in records]
+        
+        # Queue for the storage writer thread, keep the recent window in memory,
+        # check alert rules and look for outliers
+        store_writer.put(rows)
+        recent_samples.append(ip, times, records, info={column: static[column] for column in HOST_COLUMNS})
+        alerts.observe(ip, hostname, times, records)
+        if anomaly_batch is None:
+            detector.observe(ip, hostname, times, records)
+        else:
+            anomaly_batch.append((ip, hostname, times, records))
+        
+        def percent(value):
+            return 'n/a' if value is None else f"{value}%"
+        status_msg = f"Logged: {hostname} - CPU:{percent(cpu_percent)} MEM:{percent(memory_percent)} DISK:{percent(disk_percent)}"
+        if len(rows) > 1:
+            status_msg += f" ({len(rows)} samples)"
         print(status_msg)
         
     except Exception as e:
         print(f"Error logging data for {ip}: {e}")
 
-def rotate_csv_if_needed():
-    """Rotate CSV file if it exceeds 5MB"""
+# --- Asyncio poller ---
+poller = AgentPoller(
+    max_in_flight=settings.get('max_in_flight', MAX_IN_FLIGHT),
+    timeout=settings.get('poll_timeout', POLL_TIMEOUT)
+)
+
+# --- Poll statistics for /metrics/prom; durations are in stats.histogram('poll') ---
+polls_total = Counter('lamn_polls_total', 'Agent polls by result', ('result',))
+poll_latency = {}  # ip -> duration of the agent's last poll, for /debug/stats
+
+def history_params(ip):
+    """Query for the per-second samples the agent buffered since the last pull."""
+    cursor = history_cursors.get(ip)
+    # On first contact ask for one poll interval measured on the agent's own clock.
+    return {'since': cursor} if cursor is not None else {'window': POLL_INTERVAL}
+
+def new_samples(ip, samples):
+    """Drop samples already logged by an overlapping poll of the same agent."""
+    cursor = history_cursors.get(ip)
+    if not samples or not samples.get('timestamp') or cursor is None:
+        return samples
+    first = bisect.bisect_right(samples['timestamp'], cursor)
+    if first == 0:
+        return samples
+    return {field: column[first:] for field, column in samples.items()}
+
+def handle_poll_result(result, anomaly_batch=None):
+    """Record one PollResult: update the live snapshot and log the samples."""
+    ip = result.ip
+    stats.record('poll', result.latency)
+    poll_latency[ip] = result.latency
+    polls_total.inc('ok' if result.ok else 'error')
+    if not result.ok:
+        update_agent(ip, {"error": result.error})
+        print(f"Client {ip} - {result.error}")
+        return
+    
+    update_agent(ip, result.data)
+    samples = new_samples(ip, result.samples)
+    if samples and samples.get('timestamp'):
+        history_cursors[ip] = samples['timestamp'][-1]
+    
+    # Log to the metric store
+    log_machine_data(ip, result.data, samples, anomaly_batch)
+
+def handle_poll_results(results):
+    """Record PollResults; the samples of all their hosts are checked for outliers in one batch."""
+    anomaly_batch = []
+    for result in results:
+        handle_poll_result(result, anomaly_batch)
     try:
-        if os.path.exists(csv_file_path):
-            file_size = os.path.getsize(csv_file_path)
-            size_mb = file_size / (1024 * 1024)
-            
-            if size_mb > 5:  # 5MB limit
-                # Create timestamp for archived file
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                archived_file = f'logs/machine_metrics_{timestamp}.csv'
-                
-                # Rename current file to archived file
-                os.rename(csv_file_path, archived_file)
-                print(f"CSV file rotated: {csv_file_path} -> {archived_file} ({size_mb:.1f}MB)")
-                
-                # Create new CSV file with headers
-                setup_csv_logging()
-                print(f"New CSV file created: {csv_file_path}")
-                
+        detector.observe_many(anomaly_batch)
     except Exception as e:
-        print(f"Error rotating CSV file: {e}")
+        print(f"Error checking {len(anomaly_batch)} agents for anomalies: {e}")
 
-def cleanup_old_csv_files(keep_files=5):
-    """Keep only the most recent N archived CSV files"""
-    try:
-        # Get all archived CSV files
-        log_files = []
-        for filename in os.listdir('logs'):
-            if filename.startswith('machine_metrics_') and filename.endswith('.csv'):
-                filepath = os.path.join('logs', filename)
-                log_files.append((filepath, os.path.getmtime(filepath)))
-        
-        # Sort by modification time (newest first)
-        log_files.sort(key=lambda x: x[1], reverse=True)
-        
-        # Remove old files if we have more than keep_files
-        if len(log_files) > keep_files:
-            files_to_remove = log_files[keep_files:]
-            for filepath, _ in files_to_remove:
-                os.remove(filepath)
-                print(f"Removed old CSV file: {filepath}")
-                
-    except Exception as e:
-        print(f"Error cleaning up old CSV files: {e}")
+# --- Per-agent polling schedule ---
+scheduler = PollScheduler(interval=POLL_INTERVAL)
+# Finished polls for the polling loop, the only thread that records them;
+# None just wakes it up to look at the schedule again
+completed_polls = queue.Queue()
 
-# --- Poll one agent (MODIFIED FOR SOCKS) ---
-def poll_agent(ip):
-    """Poll a single agent using direct HTTP connection (bypassing proxy)"""
-    try:
-        url = f"http://{ip}:5000/metrics"
-        # Use session that explicitly bypasses proxy
-        response = session.get(url, timeout=10)
-        response.raise_for_status()
-        
-        raw_data = response.json()
-        metrics_data[ip] = raw_data
-        
-        # Log to CSV
-        log_machine_data(ip, raw_data)
-        
-    except requests.exceptions.ConnectionError as e:
-        error_msg = f"Connection error: {e}"
-        metrics_data[ip] = {"error": error_msg}
-        print(f"Client {ip} - {error_msg}")
-        
-    except requests.exceptions.Timeout as e:
-        error_msg = f"Timeout error: {e}"
-        metrics_data[ip] = {"error": error_msg}
-        print(f"Client {ip} - {error_msg}")
-        
-    except Exception as e:
-        error_msg = f"Unexpected error: {e}"
-        metrics_data[ip] = {"error": error_msg}
-        print(f"Client {ip} - {error_msg}")
-
-# --- Test SOCKS connectivity ---
-def test_socks_connectivity():
-    """Test if SOCKS proxy is working"""
-    if not USE_SOCKS:
-        print("SOCKS proxy disabled")
-        return True
-        
-    try:
-        # Test basic SOCKS connection
-        test_sock = socks.socksocket()
-        test_sock.set_proxy(socks.SOCKS5, SOCKS_HOST, SOCKS_PORT)
-        test_sock.settimeout(5)
-        
-        # Try to connect to a test endpoint (Google DNS)
-        test_sock.connect(("8.8.8.8", 53))
-        test_sock.close()
-        
-        print(f"SOCKS proxy test successful: {SOCKS_HOST}:{SOCKS_PORT}")
-        return True
-        
-    except Exception as e:
-        print(f"SOCKS proxy test failed: {e}")
-        print(f"  Make sure your SOCKS tunnel is running on {SOCKS_HOST}:{SOCKS_PORT}")
-        return False
+def wake_polling_loop():
+    completed_polls.put(None)
+
+def poll_agents(ips):
+    """Poll agents concurrently and record their results; returns the PollResults."""
+    results = poller.poll_many(ips, history_params)
+    handle_poll_results(results)
+    return results
 
 # --- Main polling loop ---
 def polling_loop():
+    """
+    Poll agents as they fall due on the schedule. Each agent has its own
+    interval and backoff, so slow or dead agents never delay the others.
+    """
     print("Starting machine monitoring...")
     
     # Clear any old error data
@@ -269,29 +332,53 @@ def polling_loop():
     
     time.sleep(10)  # Initial delay
     
+    last_sync = 0
+    polled = set()
+    
     while True:
-        ips = get_agent_ips()
-        if not ips:
-            print("No agents configured in ~/.agents.json")
-            time.sleep(30)
-            continue
-            
-        threads = []
-        
-        print(f"\nPolling {len(ips)} agents...")
-        for ip in ips:
-            t = threading.Thread(target=poll_agent, args=(ip,))
-            t.start()
-            threads.append(t)
+        now = time.time()
+        if now - last_sync >= AGENT_SYNC_INTERVAL:
+            ips = get_agent_ips()
+            if not ips:
+                print("No agents configured in ~/.agents.json")
+            # Per-agent "interval" and "port" attributes
+            scheduler.sync(ips, registry.attribute('interval'))
+            poller.ports = registry.attribute('port')
+            # Alerts of removed agents would otherwise fire forever, with no samples left to clear them
+            removed = polled - set(ips)
+            if removed:
+                print(f"Stopped polling {len(removed)} removed agents")
+                forget_agents(removed)
+            polled = set(ips)
+            last_sync = now
         
-        for t in threads:
-            t.join()
+        due = scheduler.pop_due(now)
+        for ip in due:
+            future = poller.submit(poller.poll(ip, history_params(ip)))
+            future.add_done_callback(lambda f: completed_polls.put(f.result()))
+        if len(due) > 1:
+            print(f"Polling {len(due)} agents...")
         
-        print(f"Waiting 150 seconds until next poll...")
-        time.sleep(150)  # Poll every 150 seconds
-
-# --- Background polling thread ---
-threading.Thread(target=polling_loop, daemon=True).start()
+        # Sleep until the next agent is due, a poll completes or it is time to check the agent list
+        next_due = scheduler.next_due()
+        wait = AGENT_SYNC_INTERVAL if next_due is None else next_due - time.time()
+        wait = max(0, min(wait, last_sync + AGENT_SYNC_INTERVAL - time.time()))
+        try:
+            result = completed_polls.get(timeout=wait)
+        except queue.Empty:
+            continue
+        # Record every poll finished by now as one batch
+        results = []
+        while True:
+            if result is not None:
+                results.append(result)
+            try:
+                result = completed_polls.get_nowait()
+            except queue.Empty:
+                break
+        handle_poll_results(results)
+        for result in results:
+            scheduler.record(result.ip, result.ok, result.error)
 
 # --- Flask Routes (unchanged) ---
 @app.route('/')
@@ -300,64 +387,239 @@ def index():
 
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    return jsonify(metrics_data)
+    """
+    Latest metrics of every agent, or of the agents carrying any of the
+    comma-separated tags; 304 while unchanged, compressed when large.
+    """
+    snapshot = live_metrics.current
+    tags = split_list(request.args.get('tags'))
+    if tags:
+        return responses.respond(request.full_path, f"{snapshot.version}.{registry.version}",
+                                 lambda: (snapshot.body_for(registry.tagged(tags)), None))
+    return responses.respond('metrics', snapshot.version, lambda: (snapshot.body, None))
+
+prom_agents = (None, b'')  # (snapshot version, rendered agent gauges)
+
+def storage_bytes():
+    """Size on disk of the metric store and of the archived CSV logs."""
+    size = 0
+    for path in (store.path, store.path + '-wal'):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return {'store': size, 'archives': archiver.archived_bytes()}
+
+def server_exposition():
+    """The server's own state: polling, storage and viewers."""
+    exposition = Exposition()
+    stats.histogram('poll').collect(exposition, 'lamn_poll_duration_seconds', 'Time taken to poll one agent')
+    polls_total.collect(exposition)
+    schedule = scheduler.snapshot()
+    exposition.add('lamn_agents_scheduled', len(schedule), help='Agents polled by this server')
+    exposition.add('lamn_agents_failing', sum(1 for agent in schedule.values() if agent['failures']),
+                   help='Agents whose last poll failed')
+    exposition.add('lamn_write_queue_batches', store_writer.queue_depth,
+                   help='Batches of rows waiting for the storage writer')
+    exposition.add('lamn_rows_written_total', store_writer.rows_written, kind='counter',
+                   help='Rows written to the metric store')
+    for part, size in storage_bytes().items():
+        exposition.add('lamn_storage_bytes', size, {'part': part}, help='Size of the stored metrics on disk')
+    exposition.add('lamn_stream_clients', events.clients, help='Open /stream connections')
+    exposition.add('lamn_alerts_firing', len(alerts.active()), help='Alerts currently firing')
+    exposition.add('lamn_anomaly_series', detector.series, help='Host and metric pairs checked for anomalies')
+    return exposition
+
+@app.route('/metrics/prom', methods=['GET'])
+def metrics_prom():
+    """
+    Every agent's latest metrics and the server's own state in the
+    Prometheus text format. The agent gauges are rendered once per change.
+    """
+    global prom_agents
+    snapshot = live_metrics.current
+    version, body = prom_agents
+    if version != snapshot.version:
+        body = agents_exposition(snapshot.data).render().encode()
+        prom_agents = (snapshot.version, body)
+    return Response(body + server_exposition().render().encode(), content_type=CONTENT_TYPE)
+
+@app.route('/agents', methods=['GET'])
+def agents():
+    """
+    Configured agents with their attributes, the agent count of every tag
+    and group, and the IPs this server polls (all of them unless it is a shard).
+    """
+    return jsonify({"agents": registry.agents(), "tags": registry.labels(),
+                    "shard": federation.shard, "polled": get_agent_ips()})
+
+@app.route('/stream')
+def stream():
+    """
+    Server-Sent Events: a `snapshot` event with every agent's latest
+    metrics, then an `agent` event ({"ip", "data"}) as each poll completes.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    body = events.stream(lambda: live_metrics.current.body, last_event_id)
+    return Response(stream_with_context(body), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def split_list(value):
+    """Comma-separated query argument as a list, None when absent or empty."""
+    items = [item for item in value.split(',') if item] if value else []
+    return items or None
+
+def query_filters():
+    """
+    start/end (epoch seconds) and hosts (comma-separated IPs or hostnames)
+    from the request; tags (comma-separated tags or groups) narrow hosts down
+    to the agents carrying any of them.
+    """
+    hosts = split_list(request.args.get('hosts'))
+    tags = split_list(request.args.get('tags'))
+    if tags:
+        tagged = registry.tagged(tags)
+        hosts = sorted(tagged) if hosts is None else [h for h in hosts if h in tagged]
+    return {
+        'start': request.args.get('start', type=float),
+        'end': request.args.get('end', type=float),
+        'hosts': hosts
+    }
+
+def parse_resolution(value):
+    """'auto' -> None (pick from the span), 'raw' -> 0, otherwise seconds."""
+    if value in (None, '', 'auto'):
+        return None
+    if value == 'raw':
+        return 0
+    return int(value)
 
 @app.route('/csv_data', methods=['GET'])
 def csv_data():
-    """Return CSV data as JSON for charts"""
+    """
+    Return logged rows as JSON for charts: the newest `limit` rows (default
+    1000), optionally restricted with start, end, hosts and tags.
+    
+    With span (seconds back from end, default now) or resolution
+    (auto, raw, 60, 900 or 3600) the whole range is returned instead, from
+    the rollup tier that fits it; the X-Resolution header names the tier.
+    
+    With since, the samples received after that cursor are returned from
+    memory as columns per host, along with the cursor for the next call;
+    since=0 returns every agent's recent window. Any other value than a
+    cursor handed out by this process is answered with 400.
+    """
     try:
-        # Read CSV file
-        df = pd.read_csv(csv_file_path)
-        if len(df) > 1000:
-            df = df.tail(1000)
-            print(f"CSV file has many entries, returning last 1000 rows")
-            
-        # Debug: Print column names and first few rows
-        print("CSV Columns:", df.columns.tolist())
-        print("First row:", df.iloc[0].to_dict() if len(df) > 0 else "No data")
-        print("Data types:", df.dtypes.to_dict())
+        filters = query_filters()
+        since = request.args.get('since')
+        if since is not None:
+            # A cursor from before a restart is rejected too; callers then start over from 0
+            sequence = recent_samples.sequence
+            try:
+                since = int(since)
+            except ValueError:
+                since = -1
+            if not 0 <= since <= sequence:
+                return jsonify({"error": f"since must be a cursor from 0 to {sequence}"}), 400
+            def build():
+                cursor, hosts = recent_samples.since(since, filters['hosts'])
+                with stats.timer('json.encode'):
+                    return dumps({
+                        "cursor": cursor,
+                        "capacity": recent_samples.capacity,
+                        "fields": list(recent_samples.fields),
+                        "hosts": hosts
+                    }), None
+            # Cached until new samples arrive or the agent list (and so its tags) changes
+            return responses.respond(request.full_path, ('recent', recent_samples.sequence, registry.version), build)
         
-        # Convert to JSON format for charts
-        data = df.to_dict('records')
-        return jsonify(data)
+        def build():
+            span = request.args.get('span', type=float)
+            if span is not None or 'resolution' in request.args:
+                end = filters['end'] if filters['end'] is not None else time.time()
+                start = filters['start'] if filters['start'] is not None else end - (span or 3600)
+                with stats.timer('store.query_range'):
+                    resolution, df = store.query_range(start, end, filters['hosts'],
+                                                       parse_resolution(request.args.get('resolution')))
+                headers = {'X-Resolution': 'raw' if resolution == 0 else str(resolution)}
+            else:
+                limit = request.args.get('limit', 1000, type=int)
+                with stats.timer('store.query'):
+                    df = store.query(limit=limit, **filters)
+                headers = None
+            
+            # Convert to JSON format for charts
+            with stats.timer('json.encode'):
+                data = df.astype(object).where(df.notna(), None).to_dict('records')
+                return dumps(data), headers
+        # Cached until the writer stores more rows or the agent list changes
+        return responses.respond(request.full_path, ('store', store_writer.rows_written, registry.version), build)
         
-    except FileNotFoundError:
-        return jsonify([])
     except Exception as e:
         print(f"CSV data error: {e}")
         return jsonify({"error": str(e)})
 
+@app.route('/query', methods=['GET'])
+def query():
+    """
+    Aggregate logged data over any time range, archives included.
+    start (required) and end are epoch seconds, hosts and metrics are
+    comma-separated, bucket is the bucket width in seconds (default: the
+    rollup tier that fits the range) and agg one of mean, min, max, sum,
+    count, p95 or last. Returns columns per host, or CSV with format=csv.
+    """
+    filters = query_filters()
+    if filters['start'] is None:
+        return jsonify({"error": "start is required"}), 400
+    start = filters['start']
+    end = filters['end'] if filters['end'] is not None else time.time()
+    metrics = [m for m in request.args.get('metrics', '').split(',') if m] or None
+    bucket = request.args.get('bucket', type=int) or max(RAW_INTERVAL, choose_resolution(start, end))
+    agg = request.args.get('agg', 'mean')
+    try:
+        with stats.timer('store.aggregate'):
+            df = store.aggregate(start, end, filters['hosts'], metrics, bucket, agg)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Query error: {e}")
+        return jsonify({"error": str(e)}), 500
+    
+    if request.args.get('format') == 'csv':
+        return Response(df.to_csv(index=False), mimetype='text/csv', headers={
+            'Content-Disposition': 'attachment; filename=machine_metrics_query.csv'
+        })
+    metrics = [c for c in df.columns if c not in ('ts', 'ip', 'hostname')]
+    hosts = {}
+    for ip, rows in df.groupby('ip', sort=False):
+        values = rows.astype(object).where(rows.notna(), None)
+        hosts[ip] = {"hostname": rows['hostname'].iloc[-1], "timestamp": rows['ts'].tolist()}
+        for metric in metrics:
+            hosts[ip][metric] = values[metric].tolist()
+    return jsonify({"start": start, "end": end, "bucket": bucket, "agg": agg, "metrics": metrics, "hosts": hosts})
+
 @app.route('/download_csv')
 def download_csv():
-    """Download the CSV file"""
+    """Download logged rows as CSV, optionally restricted with start, end and hosts"""
     try:
-        return send_file(csv_file_path, as_attachment=True, download_name='machine_metrics.csv')
-    except FileNotFoundError:
-        return "CSV file not found", 404
+        rows = store.export_csv(**query_filters())
+        return Response(stream_with_context(rows), mimetype='text/csv', headers={
+            'Content-Disposition': 'attachment; filename=machine_metrics.csv'
+        })
+    except Exception as e:
+        return f"CSV export failed: {e}", 500
 
 @app.route('/csv_summary')
 def csv_summary():
-    """Show summary of CSV data"""
+    """Show summary of logged data"""
     try:
-        df = pd.read_csv(csv_file_path)
-        
-        # Get latest data for each machine
-        latest = df.groupby('hostname').tail(1)
-        
-        summary = {
-            'total_entries': len(df),
-            'machines': len(df['hostname'].unique()),
-            'time_range': {
-                'start': df['timestamp'].min(),
-                'end': df['timestamp'].max()
-            },
-            'latest_data': latest[['hostname', 'cpu_percent', 'memory_percent', 'disk_percent', 'gpu_percent']].to_dict('records')
-        }
-        
+        summary = store.summary()
+        if not summary['total_entries']:
+            return jsonify({"error": "No data available"})
         return jsonify(summary)
         
-    except FileNotFoundError:
-        return jsonify({"error": "No data available"})
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -377,19 +639,121 @@ def clear_cache():
 
 @app.route('/force_poll', methods=['POST'])
 def force_poll():
-    """Force an immediate poll of all agents"""
-    ips = get_agent_ips()
-    threads = []
-    
-    for ip in ips:
-        t = threading.Thread(target=poll_agent, args=(ip,))
-        t.start()
-        threads.append(t)
-    
-    for t in threads:
-        t.join()
-        
-    return jsonify({"status": f"Polled {len(ips)} agents", "data": metrics_data})
+    """
+    Make all agents (or the one given as ?ip=) due now. The polling loop
+    polls and records them like any other poll; the results arrive on
+    /metrics and /stream.
+    """
+    ip = request.values.get('ip')
+    scheduled = scheduler.poll_now(None if ip is None else [ip])
+    if ip is not None and not scheduled and ip not in scheduler.snapshot():
+        return jsonify({"error": f"Agent {ip} is not scheduled"}), 404
+    wake_polling_loop()
+    return jsonify({"status": f"Polling {len(scheduled)} agents", "scheduled": scheduled}), 202
+
+@app.route('/alerts', methods=['GET'])
+def active_alerts():
+    """Alerts currently firing, one per host and rule."""
+    return jsonify(alerts.active())
+
+@app.route('/anomalies', methods=['GET'])
+def anomalies():
+    """
+    Outliers found in the incoming samples, oldest first: one entry per run
+    of consecutive outliers of a host's metric, with its peak value, the
+    expected value and z-score. Filter with start (epoch seconds), hosts,
+    metrics (comma-separated) and active=1 for the ones still going on.
+    """
+    filters = query_filters()
+    return jsonify(detector.anomalies(
+        start=filters['start'],
+        hosts=filters['hosts'],
+        metrics=split_list(request.args.get('metrics')),
+        active=request.args.get('active') in ('1', 'true')
+    ))
+
+@app.route('/flag_agent', methods=['POST'])
+def flag_agent():
+    """
+    Poll an agent faster while it is being watched.
+    JSON body: {"ip": "...", "interval": 15} to flag, {"ip": "...", "enabled": false} to unflag.
+    """
+    body = request.get_json(silent=True) or {}
+    ip = body.get('ip')
+    if not ip:
+        return jsonify({"error": "ip is required"}), 400
+    if body.get('enabled', True):
+        found = scheduler.flag(ip, float(body.get('interval', FAST_INTERVAL)))
+    else:
+        found = scheduler.unflag(ip)
+    if not found:
+        return jsonify({"error": f"Agent {ip} is not scheduled"}), 404
+    wake_polling_loop()
+    return jsonify({"status": "ok", "schedule": scheduler.snapshot().get(ip)})
+
+@app.route('/schedule', methods=['GET'])
+def schedule():
+    """Per-agent polling schedule: interval, next due time, failures."""
+    return jsonify(scheduler.snapshot())
+
+@app.route('/debug/stats', methods=['GET'])
+def debug_stats():
+    """
+    Where the server spends its time: latency percentiles of polls, storage
+    writes, store queries, JSON encoding and every route; response sizes per
+    route; threads, queue depths and how long ago each agent last answered.
+    """
+    now = time.time()
+    agents = {}
+    for ip, entry in scheduler.snapshot().items():
+        agents[ip] = {
+            "last_success_age": None if entry['last_ok'] is None else now - entry['last_ok'],
+            "last_poll_seconds": poll_latency.get(ip),
+            "failures": entry['failures'],
+            "in_flight": entry['in_flight']
+        }
+    return jsonify({
+        "uptime": now - stats.started,
+        "latency": stats.latency(),
+        "response_bytes": stats.sizes(),
+        "threads": thread_counts(),
+        "queues": {
+            "store_writer": store_writer.queue_depth,
+            "archiver": archiver.queue_depth,
+            "alert_notifier": alerts.notifier.queue_depth,
+            "polls_in_flight": sum(1 for agent in agents.values() if agent['in_flight']),
+            "stream_clients": events.clients,
+            "stream_backlog": events.backlog
+        },
+        "store": {"rows_written": store_writer.rows_written, "bytes": storage_bytes()},
+        "agents": agents,
+        "profiler": profiler.status()
+    })
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """
+    Sampling profiler of every server thread, as collapsed stacks for
+    flamegraph.pl or speedscope. POST {"enabled": true} starts it, with
+    "seconds": N to have it stop by itself after N seconds, and
+    {"enabled": false} stops it; GET returns the profile collected so far.
+    Requests never wait for the profile.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        if not body.get('enabled', True):
+            changed = profiler.stop()
+        else:
+            seconds = body.get('seconds')
+            try:
+                seconds = None if seconds is None else min(max(float(seconds), 0), PROFILE_MAX_SECONDS)
+            except (TypeError, ValueError):
+                return jsonify({"error": "seconds must be a number"}), 400
+            changed = profiler.start(seconds)
+        return jsonify(dict(profiler.status(), changed=changed))
+    return Response(profiler.collapsed(), mimetype='text/plain', headers={
+        'Content-Disposition': 'attachment; filename=lamn-server.folded'
+    })
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
@@ -400,15 +764,27 @@ def shutdown():
     return 'Server shutting down...'
 
 # --- Server Entrypoint ---
-def start():
-    print("Machine data will be logged to: logs/machine_metrics.csv")
+def start(shard=None):
+    if shard is not None:
+        federation.shard = shard
+    federation.check()
+    if federation.enabled:
+        print(f"Polling the agents of shard {federation.shard}")
+    print(f"Machine data will be logged to: {store.path} ({store.kind})")
     print("View CSV summary at: http://localhost:8000/csv_summary")
     print("Download CSV at: http://localhost:8000/download_csv")
     print("View plots at: http://localhost:8000/plots")
     print("View hybrid dashboard at: http://localhost:8000/hybrid")
     print("Using direct HTTP connections to all agents")
     
-    app.run(host='0.0.0.0', port=8000, debug=False, use_reloader=False)
+    # --- Archive compression and retention ---
+    archiver.start()
+    
+    # --- Background polling thread ---
+    threading.Thread(target=polling_loop, daemon=True).start()
+    
+    # Threaded: every open /stream keeps a request thread busy
+    app.run(host='0.0.0.0', port=8000, debug=False, use_reloader=False, threaded=True)
 
 if __name__ == '__main__':
     start()
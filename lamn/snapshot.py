@@ -0,0 +1,109 @@
+"""
+Immutable, pre-serialized snapshot of every agent's latest metrics.
+
+Writers (the poller) never modify a published snapshot: each update
+builds a new one that shares the unchanged entries, and swaps it in with
+a single reference assignment. Readers take the current snapshot without
+locking and always see a consistent set of agents. Each agent's entry is
+serialized once when it arrives and the full body is joined from those
+fragments on first use, so a burst of updates costs one encoding per
+agent rather than one encoding of every agent per update.
+
+JSON is encoded with orjson when it is installed.
+"""
+import json
+import threading
+import types
+
+try:
+    import orjson  # optional: much faster JSON encoding
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    # numpy scalars, e.g. from pandas rows
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Compact JSON encoding of obj, as bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+class AgentSnapshot:
+    """
+    Frozen view of all agents: `data` is a read-only mapping of ip to the
+    agent's latest payload, `version` increases with every change.
+    """
+
+    __slots__ = ('data', 'version', '_fragments', '_body')
+
+    def __init__(self, data, fragments, version):
+        self.data = types.MappingProxyType(data)
+        self.version = version
+        self._fragments = fragments
+        self._body = None
+
+    @property
+    def body(self):
+        """The snapshot as JSON bytes, joined once from the per-agent fragments."""
+        body = self._body
+        if body is None:
+            # Two readers may race to build it; both build the same bytes.
+            body = self._body = b'{' + b','.join(
+                dumps(ip) + b':' + fragment for ip, fragment in self._fragments.items()) + b'}'
+        return body
+
+    def body_for(self, ips):
+        """JSON bytes of the entries of the agents in ips only."""
+        return b'{' + b','.join(
+            dumps(ip) + b':' + fragment for ip, fragment in self._fragments.items() if ip in ips) + b'}'
+
+    def encoded(self, ip):
+        """One agent's entry as JSON bytes."""
+        return self._fragments[ip]
+
+
+class LiveSnapshot:
+    """The current AgentSnapshot, replaced as a whole on every change."""
+
+    def __init__(self):
+        self._lock = threading.Lock()  # serializes writers only
+        self.current = AgentSnapshot({}, {}, 0)
+
+    def update(self, ip, payload):
+        """Publish payload as ip's entry; payload must not be modified afterwards."""
+        fragment = dumps(payload)
+        with self._lock:
+            current = self.current
+            data = dict(current.data)
+            data[ip] = payload
+            fragments = dict(current._fragments)
+            fragments[ip] = fragment
+            self.current = AgentSnapshot(data, fragments, current.version + 1)
+            return self.current
+
+    def update_many(self, payloads, removed=()):
+        """Publish several entries and drop the ips in removed, as one change."""
+        encoded = {ip: dumps(payload) for ip, payload in payloads.items()}
+        with self._lock:
+            current = self.current
+            data = dict(current.data)
+            fragments = dict(current._fragments)
+            for ip in removed:
+                data.pop(ip, None)
+                fragments.pop(ip, None)
+            data.update(payloads)
+            fragments.update(encoded)
+            self.current = AgentSnapshot(data, fragments, current.version + 1)
+            return self.current
+
+    def clear(self):
+        with self._lock:
+            self.current = AgentSnapshot({}, {}, self.current.version + 1)
+            return self.current
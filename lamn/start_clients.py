@@ -35,7 +35,8 @@ def load_agents():
         with open(AGENTS_FILE, "w") as f:
             json.dump([], f)
     with open(AGENTS_FILE, "r") as f:
-        return json.load(f)
+        # Entries are IPs or objects with per-agent attributes
+        return [a if isinstance(a, str) else a["ip"] for a in json.load(f)]
 
 def start_client_on(ip, username, password, conda_env, screen_name, launch_cmd, auto_restart=False):
     print(f"[+] Connecting to {ip} to start client...")
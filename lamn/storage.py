@@ -0,0 +1,1071 @@
+"""
+Metric storage for the lamn server.
+
+Two stores share one interface (write_rows, flush, query, summary,
+export_csv, close):
+- SqliteStore keeps samples in an indexed SQLite database in WAL mode, so
+  time-range and host queries read only the rows they need and readers
+  never block the writer. Host details that repeat on every CSV row are
+  kept once per host.
+- CsvStore is the original rotating CSV log.
+
+Both answer query_range() at raw or rollup resolution (see lamn.rollup).
+SqliteStore maintains the rollup tiers incrementally as rows are written;
+CsvStore computes them from the raw rows on every query. aggregate()
+buckets any time range with one aggregation function; CsvStore answers it
+from the live log and the rotated archives, reading only the archives
+whose time span, kept in a sidecar index, overlaps the range.
+
+ArchiveManager compresses rotated CSV logs in the background (zstd when
+the zstandard package is installed, gzip otherwise) and deletes archives
+past the retention age or total size. Every read path goes through pandas,
+which decompresses archives transparently.
+
+BatchWriter is the only thread that writes to a store: pollers hand rows
+to a queue and the writer flushes them in batches, by size or by age, so
+rows from concurrent polls are never interleaved.
+"""
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard  # optional: better compression of archived logs
+except ImportError:
+    zstandard = None
+
+from lamn.rollup import TIERS, Bucket, choose_resolution, group_samples, rollup_columns
+
+MAX_LOG_BYTES = 5 * 1024 * 1024  # rotate the live log past this size
+MAX_BATCH_ROWS = 1000            # flush once this many rows are queued
+MAX_BATCH_DELAY = 1.0            # or once the oldest queued row is this old (seconds)
+RETENTION_DAYS = 30              # archived logs older than this are deleted
+STORE_RETENTION_DAYS = 0         # raw samples older than this are pruned from the store; 0 keeps them
+RETENTION_BYTES = 1024 ** 3      # archived logs beyond this total size are deleted, oldest first
+RETENTION_CHECK_INTERVAL = 3600  # seconds between retention checks
+READ_CHUNK_ROWS = 100000         # rows per chunk when streaming logs
+
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Row layout shared by every store and by the CSV log
+CSV_COLUMNS = [
+    'timestamp', 'ip', 'hostname', 'cpu_percent', 'memory_percent', 
+    'disk_percent', 'gpu_percent', 'total_memory_gb', 'total_disk_gb',
+    'cpu_model', 'gpu_model', 'os_info',
+    'disk_read_bps', 'disk_write_bps', 'disk_iops', 'net_rx_bps', 'net_tx_bps', 'net_pps'
+]
+METRIC_COLUMNS = [
+    'cpu_percent', 'memory_percent', 'disk_percent', 'gpu_percent',
+    'disk_read_bps', 'disk_write_bps', 'disk_iops', 'net_rx_bps', 'net_tx_bps', 'net_pps'
+]
+HOST_COLUMNS = ['hostname', 'total_memory_gb', 'total_disk_gb', 'cpu_model', 'gpu_model', 'os_info']
+SUMMARY_COLUMNS = ['hostname', 'cpu_percent', 'memory_percent', 'disk_percent', 'gpu_percent']
+# query_range() at rollup resolution: CSV_COLUMNS with the bucket start as
+# timestamp and means as metric values, then the sample count and the
+# remaining stats of every metric
+ROLLUP_QUERY_COLUMNS = CSV_COLUMNS + ['samples'] + [
+    f'{m}_{s}' for m in METRIC_COLUMNS for s in ('min', 'max', 'p95')]
+# aggregate() functions; the first three can be answered from rollup tiers
+AGGREGATIONS = ['mean', 'min', 'max', 'sum', 'count', 'p95', 'last']
+
+
+def archive_path(path, timestamp=None):
+    """logs/machine_metrics.csv -> logs/machine_metrics_<YYYYmmdd_HHMMSS>.csv"""
+    base, ext = os.path.splitext(path)
+    stamp = (timestamp or datetime.now()).strftime('%Y%m%d_%H%M%S')
+    candidate = f"{base}_{stamp}{ext}"
+    n = 1
+    while os.path.exists(candidate):
+        candidate = f"{base}_{stamp}_{n}{ext}"
+        n += 1
+    return candidate
+
+
+class CsvLog:
+    """Append-only CSV file with a fixed header and size-based rotation."""
+
+    def __init__(self, path, columns, max_bytes=MAX_LOG_BYTES):
+        self.path = path
+        self.columns = list(columns)
+        self.max_bytes = max_bytes
+        self.on_archive = None  # called with the path of every archived log
+        self._file = None
+        self.size = 0
+
+    def open(self):
+        """Open the log for appending, archiving a log with a different header first."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Archive a log written with an older column layout so rows never mix schemas
+        if os.path.exists(self.path):
+            with open(self.path, 'r', newline='') as f:
+                header = next(csv.reader(f), None)
+            if header is not None and header != self.columns:
+                archived_file = archive_path(self.path)
+                os.rename(self.path, archived_file)
+                print(f"CSV schema changed, archived old log: {self.path} -> {archived_file}")
+                if self.on_archive:
+                    self.on_archive(archived_file)
+
+        self._file = open(self.path, 'ab')
+        self.size = self._file.tell()
+        if self.size == 0:
+            self._write([self.columns])
+
+    def _write(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        data = buffer.getvalue().encode('utf-8')
+        self._file.write(data)
+        self.size += len(data)
+
+    def write_rows(self, rows):
+        if self._file is None:
+            self.open()
+        if self.size >= self.max_bytes:
+            self.rotate()
+        self._write(rows)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def rotate(self):
+        """Move the live log to a timestamped archive and start a new one."""
+        size_mb = self.size / (1024 * 1024)
+        self.close()
+        archived_file = archive_path(self.path)
+        os.rename(self.path, archived_file)
+        print(f"CSV file rotated: {self.path} -> {archived_file} ({size_mb:.1f}MB)")
+        self.open()
+        print(f"New CSV file created: {self.path}")
+        if self.on_archive:
+            self.on_archive(archived_file)
+        return archived_file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def parse_timestamp(text):
+    """Local 'YYYY-mm-dd HH:MM:SS' timestamp -> epoch seconds."""
+    return time.mktime(time.strptime(text, TIMESTAMP_FORMAT))
+
+
+def format_timestamp(ts):
+    """Epoch seconds -> local 'YYYY-mm-dd HH:MM:SS' timestamp, as written to CSV logs."""
+    return datetime.fromtimestamp(ts).strftime(TIMESTAMP_FORMAT)
+
+
+def local_epoch(timestamps):
+    """Vectorized parse_timestamp() of a Series of CSV timestamps."""
+    naive = (pd.to_datetime(timestamps, format=TIMESTAMP_FORMAT) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+    # The UTC offset, looked up once per hour present, turns naive local time into epoch
+    # seconds; tm_isdst=-1 lets mktime decide on daylight saving time, as in parse_timestamp
+    hours = naive // 3600 * 3600
+    offsets = {h: time.mktime(time.gmtime(h)[:8] + (-1,)) - h for h in hours.unique().tolist()}
+    return naive + hours.map(offsets)
+
+
+def aggregate_frame(df, bucket, agg, metrics):
+    """
+    Aggregate rows with epoch `ts`, `ip`, `hostname` and metric columns into
+    bucket-second buckets per host; returns the same columns, ts being the
+    bucket start.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=['ts', 'ip', 'hostname'] + list(metrics))
+    df = df.astype({m: float for m in metrics})
+    grouped = df.groupby([(df['ts'] // bucket) * bucket, df['ip']], sort=True)
+    if agg == 'p95':
+        values = grouped[metrics].quantile(0.95)
+    else:
+        values = grouped[metrics].agg(agg)
+    values['hostname'] = grouped['hostname'].last()
+    return values.reset_index()[['ts', 'ip', 'hostname'] + list(metrics)]
+
+
+def check_aggregation(metrics, bucket, agg):
+    if agg not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation: {agg}")
+    unknown = [m for m in metrics if m not in METRIC_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+    if bucket <= 0:
+        raise ValueError("bucket must be positive")
+
+
+def filter_frame(df, start=None, end=None, hosts=None, limit=None):
+    """Apply the store query filters to a DataFrame of CSV rows."""
+    if start is not None or end is not None:
+        # CSV timestamps are naive local time, like datetime.fromtimestamp()
+        ts = pd.to_datetime(df['timestamp'], format=TIMESTAMP_FORMAT)
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= ts >= pd.Timestamp(datetime.fromtimestamp(start))
+        if end is not None:
+            mask &= ts < pd.Timestamp(datetime.fromtimestamp(end))
+        df = df[mask]
+    if hosts is not None:
+        df = df[df['ip'].isin(hosts) | df['hostname'].isin(hosts)]
+    if limit is not None and len(df) > limit:
+        df = df.tail(limit)
+    return df
+
+
+def rollup_frame(df, tier):
+    """
+    Aggregate CSV rows into tier-second buckets per host, in ROLLUP_QUERY_COLUMNS
+    layout. Buckets are floored in epoch seconds, like the SQLite rollup tiers,
+    not in local time, so both backends put a sample in the same bucket.
+    """
+    ts = local_epoch(df['timestamp']) // tier * tier
+    grouped = df.assign(timestamp=ts).groupby(['ip', 'timestamp'], sort=False)
+    metrics = grouped[METRIC_COLUMNS]
+    parts = [grouped[HOST_COLUMNS].last(), metrics.mean(), grouped.size().rename('samples')]
+    for stat, frame in (('min', metrics.min()), ('max', metrics.max()), ('p95', metrics.quantile(0.95))):
+        parts.append(frame.add_suffix('_' + stat))
+    out = pd.concat(parts, axis=1).reset_index().sort_values('timestamp', kind='stable')
+    out['timestamp'] = out['timestamp'].map(format_timestamp)
+    return out[ROLLUP_QUERY_COLUMNS].reset_index(drop=True)
+
+
+class ArchiveIndex:
+    """
+    Time span of every archived log, kept in a sidecar JSON file next to
+    the live log. An archive is read once to index it and again only when
+    its size or modification time changes.
+    """
+
+    def __init__(self, log_path):
+        base, _ = os.path.splitext(log_path)
+        self.pattern = base + '_*.csv*'
+        self.path = base + '.index.json'
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _span(self, path):
+        try:
+            timestamps = pd.read_csv(path, usecols=['timestamp'])['timestamp'].dropna()
+        except (ValueError, pd.errors.EmptyDataError):
+            return None, None
+        if timestamps.empty:
+            return None, None
+        epochs = local_epoch(timestamps)
+        return float(epochs.min()), float(epochs.max())
+
+    def files(self, start=None, end=None):
+        """Archives whose rows may fall in [start, end), oldest first."""
+        with self._lock:
+            entries = self._load()
+            changed = False
+            found = {}
+            for path in glob.glob(self.pattern):
+                name = os.path.basename(path)
+                stat = os.stat(path)
+                entry = entries.get(name)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                    first, last = self._span(path)
+                    entry = {'start': first, 'end': last, 'size': stat.st_size, 'mtime': stat.st_mtime}
+                    changed = True
+                found[name] = entry
+            if changed or len(found) != len(entries):
+                self._entries = found
+                self._save()
+        directory = os.path.dirname(self.pattern)
+        selected = []
+        for name, entry in found.items():
+            if entry['start'] is None:
+                continue
+            if (end is not None and entry['start'] >= end) or (start is not None and entry['end'] < start):
+                continue
+            selected.append((entry['start'], os.path.join(directory, name)))
+        return [path for _, path in sorted(selected)]
+
+    def moved(self, old_path, new_path):
+        """Carry an archive's span over to its compressed copy instead of re-reading it."""
+        with self._lock:
+            entries = self._load()
+            entry = entries.pop(os.path.basename(old_path), None)
+            if entry is None:
+                return
+            stat = os.stat(new_path)
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            entries[os.path.basename(new_path)] = entry
+            self._save()
+
+
+def default_compression():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def compress_file(path, method='gzip'):
+    """
+    Compress path to path.gz or path.zst, keeping its modification time,
+    and remove the original; returns the compressed path.
+    """
+    target = path + COMPRESSED_SUFFIXES[method]
+    directory, name = os.path.split(target)
+    # Hidden while incomplete, so log globs never pick up a partial file
+    tmp_path = os.path.join(directory, f'.{name}.tmp')
+    with open(path, 'rb') as src:
+        if method == 'zstd':
+            with open(tmp_path, 'wb') as dst:
+                zstandard.ZstdCompressor(level=10).copy_stream(src, dst)
+        else:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    stat = os.stat(path)
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    os.replace(tmp_path, target)
+    os.remove(path)
+    return target
+
+
+class ArchiveManager:
+    """
+    Background thread that compresses archived logs and enforces retention.
+
+    Archives are deleted once older than max_age_days (by modification
+    time, i.e. their newest row) and, oldest first, while all archives
+    together exceed max_bytes. Only when store_max_age_days is set are the
+    store's raw samples past it pruned, on the same schedule.
+    """
+
+    def __init__(self, log_path, index=None, store=None, compression=None,
+                 max_age_days=RETENTION_DAYS, max_bytes=RETENTION_BYTES,
+                 store_max_age_days=STORE_RETENTION_DAYS, check_interval=RETENTION_CHECK_INTERVAL):
+        base, _ = os.path.splitext(log_path)
+        self.pattern = base + '_*.csv*'
+        self.index = index or ArchiveIndex(log_path)
+        self.store = store
+        self.compression = compression or default_compression()
+        if self.compression not in ('none',) + tuple(COMPRESSED_SUFFIXES):
+            raise ValueError(f"Unknown archive compression: {self.compression}")
+        if self.compression == 'zstd' and zstandard is None:
+            print("zstandard is not installed, compressing archives with gzip")
+            self.compression = 'gzip'
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.store_max_age_days = store_max_age_days
+        self.check_interval = check_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = object()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                # Archives left uncompressed by an earlier run or an older lamn
+                for path in sorted(glob.glob(self.pattern)):
+                    if path.endswith('.csv'):
+                        self._queue.put(path)
+                self._thread = threading.Thread(target=self._run, name="lamn-archiver", daemon=True)
+                self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, path):
+        """Queue a freshly archived log for compression."""
+        self.start()
+        self._queue.put(path)
+
+    def stop(self, timeout=5):
+        if self._thread is not None:
+            self._queue.put(self._stopping)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def compress(self, path):
+        if self.compression == 'none' or not os.path.exists(path):
+            return path
+        before = os.path.getsize(path)
+        target = compress_file(path, self.compression)
+        self.index.moved(path, target)
+        after = os.path.getsize(target)
+        print(f"Compressed archive: {target} ({before / 1024 / 1024:.1f}MB -> {after / 1024 / 1024:.1f}MB)")
+        return target
+
+    def archived_bytes(self):
+        """Total size of the archived logs on disk."""
+        total = 0
+        for path in glob.glob(self.pattern):
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def enforce_retention(self, now=None):
+        """Delete archives past the retention limits, and prune the store if enabled."""
+        now = time.time() if now is None else now
+        cutoff = now - self.max_age_days * 86400 if self.max_age_days else None
+        archives = []
+        for path in glob.glob(self.pattern):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            archives.append((stat.st_mtime, stat.st_size, path))
+        archives.sort()
+        total = sum(size for _, size, _ in archives)
+        for mtime, size, path in archives:
+            too_old = cutoff is not None and mtime < cutoff
+            too_big = bool(self.max_bytes) and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            os.remove(path)
+            total -= size
+            print(f"Removed archived log: {path} ({'age' if too_old else 'total size'} limit)")
+        if self.store_max_age_days and self.store is not None:
+            removed = self.store.prune(now - self.store_max_age_days * 86400)
+            if removed:
+                print(f"Pruned {removed} samples older than {self.store_max_age_days} days")
+
+    def _run(self):
+        next_check = 0
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, next_check - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is self._stopping:
+                return
+            try:
+                if item is not None:
+                    self.compress(item)
+                if item is not None or time.monotonic() >= next_check:
+                    self.enforce_retention()
+                    next_check = time.monotonic() + self.check_interval
+            except Exception as e:
+                print(f"Error managing archives: {e}")
+
+
+class CsvStore:
+    """Store backed by the rotating CSV log."""
+
+    kind = 'csv'
+
+    def __init__(self, path, max_bytes=MAX_LOG_BYTES):
+        self.path = path
+        self.log = CsvLog(path, CSV_COLUMNS, max_bytes=max_bytes)
+        self.archives = ArchiveIndex(path)
+
+    def open(self):
+        self.log.open()
+
+    def write_rows(self, rows):
+        """Append rows laid out as CSV_COLUMNS; epoch timestamps are written as local time."""
+        self.log.write_rows([row if isinstance(row[0], str) else [format_timestamp(row[0])] + list(row[1:])
+                             for row in rows])
+
+    def flush(self):
+        self.log.flush()
+
+    def close(self):
+        self.log.close()
+
+    def _read(self):
+        try:
+            return pd.read_csv(self.path)
+        except FileNotFoundError:
+            return pd.DataFrame(columns=CSV_COLUMNS)
+
+    def query(self, start=None, end=None, hosts=None, limit=None):
+        """Rows of the live log in time order, as a DataFrame with CSV_COLUMNS."""
+        return filter_frame(self._read(), start, end, hosts, limit)
+
+    def query_range(self, start, end, hosts=None, resolution=None):
+        """
+        Rows from start to end at a resolution (0 for raw rows, a tier width,
+        or None to pick one for the span); returns (resolution, DataFrame).
+        """
+        if resolution is None:
+            resolution = choose_resolution(start, end)
+        elif resolution and resolution not in TIERS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        if resolution == 0:
+            return 0, filter_frame(self._read(), start, end, hosts)
+        # Include the bucket that start falls in, as SqliteStore does
+        start = (start // resolution) * resolution
+        return resolution, rollup_frame(filter_frame(self._read(), start, end, hosts), resolution)
+
+    def chunks(self, start=None, end=None, hosts=None, columns=CSV_COLUMNS):
+        """
+        Stream the selected rows, oldest first, as DataFrame chunks with an
+        epoch `ts` column plus columns: from the archives overlapping the
+        range (compressed or not) and then the live log.
+        """
+        wanted = list(dict.fromkeys(['timestamp', 'ip', 'hostname'] + list(columns)))
+        paths = self.archives.files(start, end)
+        if os.path.exists(self.path):
+            paths.append(self.path)
+        for path in paths:
+            for chunk in pd.read_csv(path, usecols=lambda c: c in wanted, chunksize=READ_CHUNK_ROWS):
+                # Archives written before a column existed lack it
+                for column in wanted:
+                    if column not in chunk.columns:
+                        chunk[column] = np.nan
+                chunk['ts'] = local_epoch(chunk['timestamp'])
+                mask = pd.Series(True, index=chunk.index)
+                if start is not None:
+                    mask &= chunk['ts'] >= start
+                if end is not None:
+                    mask &= chunk['ts'] < end
+                if hosts is not None:
+                    mask &= chunk['ip'].isin(hosts) | chunk['hostname'].isin(hosts)
+                if mask.any():
+                    yield chunk.loc[mask, ['ts'] + list(columns)]
+
+    def aggregate(self, start, end, hosts=None, metrics=None, bucket=60, agg='mean'):
+        """
+        agg of each metric per host over bucket-second buckets from start to
+        end, read from the archives that overlap the range and the live log.
+        """
+        metrics = list(metrics or METRIC_COLUMNS)
+        check_aggregation(metrics, bucket, agg)
+        columns = ['ip', 'hostname'] + metrics
+        frames = list(self.chunks(start, end, hosts, columns))
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ts'] + columns)
+        return aggregate_frame(df, bucket, agg, metrics)
+
+    def prune(self, before):
+        # Old rows leave with their archive; see ArchiveManager.
+        return 0
+
+    def summary(self):
+        df = self._read()
+        latest = df.groupby('hostname').tail(1)
+        return {
+            'total_entries': len(df),
+            'machines': len(df['hostname'].unique()),
+            'time_range': {
+                'start': df['timestamp'].min() if len(df) else None,
+                'end': df['timestamp'].max() if len(df) else None
+            },
+            'latest_data': latest[SUMMARY_COLUMNS].to_dict('records')
+        }
+
+    def export_csv(self, start=None, end=None, hosts=None):
+        """
+        Yield the selected rows as CSV text chunks, header first. Archives
+        are included when a time range is given, otherwise only the live log.
+        """
+        if start is None and end is None:
+            yield self.query(hosts=hosts).to_csv(index=False)
+            return
+        header = True
+        for chunk in self.chunks(start, end, hosts):
+            yield chunk[CSV_COLUMNS].to_csv(index=False, header=header)
+            header = False
+        if header:
+            yield ','.join(CSV_COLUMNS) + '\n'
+
+
+class SqliteStore:
+    """
+    Store backed by an SQLite database in WAL mode.
+
+    Samples live in `samples`, unique per (host_id, ts) and indexed by ts,
+    with timestamps as epoch seconds; a sample already stored is ignored.
+    Per-host details live in `hosts`, and the rollup tiers in
+    `rollup_<seconds>` tables keyed by (host_id, ts). The writer uses its
+    own connection; each reading thread gets another.
+
+    The newest bucket of every host and tier stays open: its row carries
+    the aggregate state, so it can keep absorbing samples after a restart.
+    Opening the next bucket drops the state of the previous one.
+    """
+
+    kind = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._write_conn = None
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._hosts = {}  # ip -> (host_id, host column values)
+        self._open_buckets = {}  # (tier, host_id) -> (bucket start, Bucket)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._write_lock:
+            if self._write_conn is not None:
+                return
+            conn = self._connect()
+            host_columns = ', '.join(f'{c} {"TEXT" if c in ("hostname", "cpu_model", "gpu_model", "os_info") else "REAL"}'
+                                     for c in HOST_COLUMNS)
+            metric_columns = ', '.join(f'{c} REAL' for c in METRIC_COLUMNS)
+            stat_columns = ', '.join(f'{c} REAL' for c in rollup_columns(METRIC_COLUMNS))
+            had_rollups = conn.execute(
+                f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_{TIERS[0]}'").fetchone()
+            with conn:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS hosts '
+                             f'(id INTEGER PRIMARY KEY, ip TEXT UNIQUE NOT NULL, {host_columns})')
+                conn.execute(f'CREATE TABLE IF NOT EXISTS samples '
+                             f'(ts REAL NOT NULL, host_id INTEGER NOT NULL REFERENCES hosts(id), {metric_columns})')
+                conn.execute('CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts)')
+                for tier in TIERS:
+                    conn.execute(f'CREATE TABLE IF NOT EXISTS rollup_{tier} '
+                                 f'(host_id INTEGER NOT NULL, ts REAL NOT NULL, samples INTEGER, {stat_columns}, '
+                                 f'state TEXT, PRIMARY KEY (host_id, ts))')
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS rollup_{tier}_ts ON rollup_{tier} (ts)')
+                deduplicated = self._unique_samples(conn)
+            for row in conn.execute(f'SELECT id, ip, {", ".join(HOST_COLUMNS)} FROM hosts'):
+                self._hosts[row[1]] = (row[0], tuple(row[2:]))
+            if not had_rollups or deduplicated:
+                self._rebuild_rollups(conn)
+            self._write_conn = conn
+
+    def _unique_samples(self, conn):
+        """
+        Make samples unique per (host_id, ts). Databases from before the
+        constraint may hold duplicates: they are deleted and, when there were
+        any, the rollups cleared for a rebuild. Returns True in that case.
+        """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'samples_host_ts_unique'").fetchone():
+            return False
+        removed = conn.execute('DELETE FROM samples WHERE rowid NOT IN '
+                               '(SELECT min(rowid) FROM samples GROUP BY host_id, ts)').rowcount
+        conn.execute('DROP INDEX IF EXISTS samples_host_ts')
+        conn.execute('CREATE UNIQUE INDEX samples_host_ts_unique ON samples (host_id, ts)')
+        if removed <= 0:
+            return False
+        print(f"Removed {removed} duplicate samples, rebuilding rollups")
+        for tier in TIERS:
+            conn.execute(f'DELETE FROM rollup_{tier}')
+        return True
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.open()
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _host_id(self, conn, ip, details):
+        known = self._hosts.get(ip)
+        if known is not None and known[1] == details:
+            return known[0]
+        assignments = ', '.join(f'{c} = excluded.{c}' for c in HOST_COLUMNS)
+        conn.execute(
+            f'INSERT INTO hosts (ip, {", ".join(HOST_COLUMNS)}) VALUES (?{", ?" * len(HOST_COLUMNS)}) '
+            f'ON CONFLICT(ip) DO UPDATE SET {assignments}',
+            (ip,) + details)
+        host_id = conn.execute('SELECT id FROM hosts WHERE ip = ?', (ip,)).fetchone()[0]
+        self._hosts[ip] = (host_id, details)
+        return host_id
+
+    def write_rows(self, rows):
+        """
+        Insert rows laid out as CSV_COLUMNS, timestamps as epoch seconds or
+        local time strings. Samples already stored for a host and timestamp
+        are skipped; returns the number of rows inserted.
+        """
+        self.open()
+        index = {c: i for i, c in enumerate(CSV_COLUMNS)}
+        host_idx = [index[c] for c in HOST_COLUMNS]
+        metric_idx = [index[c] for c in METRIC_COLUMNS]
+        ts_idx, ip_idx = index['timestamp'], index['ip']
+        parsed = {}
+        values = []
+        sql = (f'INSERT OR IGNORE INTO samples (ts, host_id, {", ".join(METRIC_COLUMNS)}) '
+               f'VALUES (?, ?{", ?" * len(METRIC_COLUMNS)})')
+        with self._write_lock:
+            conn = self._write_conn
+            with conn:
+                for row in rows:
+                    ts = row[ts_idx]
+                    if isinstance(ts, str):
+                        if ts not in parsed:
+                            parsed[ts] = parse_timestamp(ts)
+                        ts = parsed[ts]
+                    host_id = self._host_id(conn, row[ip_idx], tuple(row[i] for i in host_idx))
+                    sample = (ts, host_id) + tuple(row[i] for i in metric_idx)
+                    # Only new samples go into the rollups
+                    if conn.execute(sql, sample).rowcount:
+                        values.append(sample)
+                self._update_rollups(conn, values)
+        return len(values)
+
+    def _rollup_bucket(self, conn, tier, host_id, start):
+        """Return (bucket, is_open) for one host's bucket, opening it when it is the newest."""
+        key = (tier, host_id)
+        current = self._open_buckets.get(key)
+        if current is not None and current[0] == start:
+            return current[1], True
+        row = conn.execute(
+            f'SELECT samples, {", ".join(rollup_columns(METRIC_COLUMNS))}, state '
+            f'FROM rollup_{tier} WHERE host_id = ? AND ts = ?', (host_id, start)).fetchone()
+        if row is None:
+            bucket = Bucket(METRIC_COLUMNS)
+        elif row[-1] is not None:
+            bucket = Bucket.from_state(METRIC_COLUMNS, row[0], row[-1])
+        else:
+            # A closed bucket got a late sample: min, max and mean stay exact, p95 is kept as is.
+            return Bucket.from_values(METRIC_COLUMNS, row[:-1]), False
+        if current is not None and current[0] > start:
+            return bucket, False
+        if current is not None:
+            conn.execute(f'UPDATE rollup_{tier} SET state = NULL WHERE host_id = ? AND ts = ?',
+                         (host_id, current[0]))
+        self._open_buckets[key] = (start, bucket)
+        return bucket, True
+
+    def _update_rollups(self, conn, values):
+        """Add (ts, host_id, metrics...) samples to every rollup tier."""
+        if not values:
+            return
+        timestamps = np.array([v[0] for v in values], dtype=float)
+        host_ids = np.array([v[1] for v in values], dtype=np.int64)
+        data = np.array([v[2:] for v in values], dtype=float)
+        columns = ['host_id', 'ts', 'samples'] + rollup_columns(METRIC_COLUMNS) + ['state']
+        sql = f'INSERT OR REPLACE INTO rollup_{{}} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        for tier in TIERS:
+            for host_id, start, indices in group_samples(timestamps, host_ids, tier):
+                bucket, is_open = self._rollup_bucket(conn, tier, host_id, start)
+                bucket.add(data[indices])
+                state = bucket.state() if is_open else None
+                conn.execute(sql.format(tier), [host_id, start] + bucket.values() + [state])
+
+    def _rebuild_rollups(self, conn, chunksize=100000):
+        """Compute the rollup tiers from every stored sample, e.g. after upgrading a database."""
+        total = conn.execute('SELECT count(*) FROM samples').fetchone()[0]
+        if not total:
+            return
+        print(f"Building rollups from {total} stored samples...")
+        reader = self._connect()
+        try:
+            cursor = reader.execute(
+                f'SELECT ts, host_id, {", ".join(METRIC_COLUMNS)} FROM samples ORDER BY host_id, ts')
+            with conn:
+                while True:
+                    rows = cursor.fetchmany(chunksize)
+                    if not rows:
+                        break
+                    self._update_rollups(conn, rows)
+        finally:
+            reader.close()
+
+    def flush(self):
+        # Every batch is committed by write_rows.
+        pass
+
+    def close(self):
+        with self._write_lock:
+            if self._write_conn is not None:
+                self._write_conn.close()
+                self._write_conn = None
+
+    def _host_ids(self, conn, hosts):
+        placeholders = ', '.join('?' * len(hosts))
+        return [r[0] for r in conn.execute(
+            f'SELECT id FROM hosts WHERE ip IN ({placeholders}) OR hostname IN ({placeholders})',
+            list(hosts) * 2)]
+
+    def _where(self, conn, start=None, end=None, hosts=None):
+        """WHERE clause and parameters on the `s` alias for the query filters."""
+        where, params = [], []
+        if start is not None:
+            where.append('s.ts >= ?')
+            params.append(start)
+        if end is not None:
+            where.append('s.ts < ?')
+            params.append(end)
+        if hosts is not None:
+            ids = self._host_ids(conn, hosts)
+            where.append(f's.host_id IN ({", ".join("?" * len(ids)) or "NULL"})')
+            params.extend(ids)
+        return (f' WHERE {" AND ".join(where)}' if where else ''), params
+
+    def _select(self, start=None, end=None, hosts=None, table='samples', metric_columns=None, extra_columns=()):
+        """SQL and parameters selecting rows of table in CSV_COLUMNS layout, then extra_columns."""
+        conn = self._reader()
+        where, params = self._where(conn, start, end, hosts)
+        metric_columns = metric_columns or {c: f's.{c}' for c in METRIC_COLUMNS}
+        columns = []
+        for c in CSV_COLUMNS:
+            if c == 'timestamp':
+                columns.append(f"strftime('{TIMESTAMP_FORMAT}', s.ts, 'unixepoch', 'localtime') AS timestamp")
+            elif c in METRIC_COLUMNS:
+                columns.append(f'{metric_columns[c]} AS {c}')
+            else:
+                columns.append(f'h.{c}')
+        columns.extend(f's.{c}' for c in extra_columns)
+        sql = f'SELECT {", ".join(columns)} FROM {table} s JOIN hosts h ON h.id = s.host_id{where}'
+        return conn, sql, params
+
+    def query(self, start=None, end=None, hosts=None, limit=None):
+        """Rows in time order, as a DataFrame with CSV_COLUMNS; limit keeps the newest rows."""
+        conn, sql, params = self._select(start, end, hosts)
+        if limit is None:
+            return pd.read_sql_query(sql + ' ORDER BY s.ts, s.rowid', conn, params=params)
+        # Read the newest rows backwards through the index, then restore time order.
+        df = pd.read_sql_query(sql + ' ORDER BY s.ts DESC, s.rowid DESC LIMIT ?', conn, params=params + [limit])
+        return df.iloc[::-1].reset_index(drop=True)
+
+    def query_range(self, start, end, hosts=None, resolution=None):
+        """
+        Rows from start to end at a resolution (0 for raw samples, a tier
+        width, or None to pick one for the span); returns (resolution, DataFrame).
+        Rollup rows are in ROLLUP_QUERY_COLUMNS layout, one per host and bucket.
+        """
+        if resolution is None:
+            resolution = choose_resolution(start, end)
+        if resolution == 0:
+            return 0, self.query(start, end, hosts)
+        if resolution not in TIERS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        # Include the bucket that start falls in
+        start = (start // resolution) * resolution
+        conn, sql, params = self._select(start, end, hosts, table=f'rollup_{resolution}',
+                                         metric_columns={c: f's.{c}_mean' for c in METRIC_COLUMNS},
+                                         extra_columns=ROLLUP_QUERY_COLUMNS[len(CSV_COLUMNS):])
+        return resolution, pd.read_sql_query(sql + ' ORDER BY s.ts, s.host_id', conn, params=params)
+
+    def aggregate(self, start, end, hosts=None, metrics=None, bucket=60, agg='mean'):
+        """
+        agg of each metric per host over bucket-second buckets from start to
+        end. min, max and mean over buckets that are a multiple of a rollup
+        tier are computed from that tier instead of the raw samples.
+        """
+        metrics = list(metrics or METRIC_COLUMNS)
+        check_aggregation(metrics, bucket, agg)
+        tiers = [t for t in TIERS if bucket % t == 0] if agg in ('mean', 'min', 'max') else []
+        conn = self._reader()
+        if tiers:
+            tier = tiers[-1]
+            where, params = self._where(conn, (start // tier) * tier, end, hosts)
+            columns = ', '.join(f's.{m}_{agg} AS {m}' for m in metrics)
+            df = pd.read_sql_query(
+                f'SELECT s.ts, h.ip, h.hostname, s.samples, {columns} '
+                f'FROM rollup_{tier} s JOIN hosts h ON h.id = s.host_id{where}', conn, params=params)
+            if agg != 'mean':
+                return aggregate_frame(df, bucket, agg, metrics)
+            # Mean of means, weighted by the samples in each rollup bucket that had a value
+            weights = [f'{m}_weight' for m in metrics]
+            for m, w in zip(metrics, weights):
+                df[w] = df['samples'].where(df[m].notna(), 0)
+                df[m] = df[m] * df['samples']
+            sums = aggregate_frame(df, bucket, 'sum', metrics + weights)
+            for m, w in zip(metrics, weights):
+                sums[m] = sums[m] / sums[w].where(sums[w] > 0)
+            return sums[['ts', 'ip', 'hostname'] + metrics]
+        where, params = self._where(conn, start, end, hosts)
+        df = pd.read_sql_query(
+            f'SELECT s.ts, h.ip, h.hostname, {", ".join(f"s.{m}" for m in metrics)} '
+            f'FROM samples s JOIN hosts h ON h.id = s.host_id{where} ORDER BY s.ts', conn, params=params)
+        return aggregate_frame(df, bucket, agg, metrics)
+
+    def prune(self, before, batch=50000):
+        """
+        Delete raw samples and 1 minute rollups older than before, in small
+        batches so the writer is never blocked for long; coarser rollups are
+        kept. Returns the number of samples deleted.
+        """
+        self.open()
+        removed = 0
+        for table in ('samples', f'rollup_{TIERS[0]}'):
+            while True:
+                with self._write_lock:
+                    with self._write_conn as conn:
+                        count = conn.execute(
+                            f'DELETE FROM {table} WHERE rowid IN '
+                            f'(SELECT rowid FROM {table} WHERE ts < ? LIMIT ?)', (before, batch)).rowcount
+                if table == 'samples':
+                    removed += count
+                if count < batch:
+                    break
+        return removed
+
+    def summary(self):
+        conn = self._reader()
+        first, last, total = conn.execute('SELECT min(ts), max(ts), count(*) FROM samples').fetchone()
+        latest = []
+        metric_sql = ', '.join(f's.{c}' for c in SUMMARY_COLUMNS[1:])
+        for host_id, hostname in conn.execute('SELECT id, hostname FROM hosts ORDER BY id'):
+            row = conn.execute(
+                f'SELECT {metric_sql} FROM samples s WHERE s.host_id = ? ORDER BY s.ts DESC LIMIT 1',
+                (host_id,)).fetchone()
+            if row is not None:
+                latest.append(dict(zip(SUMMARY_COLUMNS, (hostname,) + row)))
+
+        def fmt(ts):
+            return datetime.fromtimestamp(ts).strftime(TIMESTAMP_FORMAT) if ts is not None else None
+
+        return {
+            'total_entries': total,
+            'machines': len({r['hostname'] for r in latest}),
+            'time_range': {'start': fmt(first), 'end': fmt(last)},
+            'latest_data': latest
+        }
+
+    def export_csv(self, start=None, end=None, hosts=None, chunksize=50000):
+        """Yield the selected rows as CSV text chunks, header first."""
+        conn, sql, params = self._select(start, end, hosts)
+        header = True
+        for chunk in pd.read_sql_query(sql + ' ORDER BY s.ts, s.rowid', conn, params=params, chunksize=chunksize):
+            yield chunk.to_csv(index=False, header=header)
+            header = False
+        if header:
+            yield ','.join(CSV_COLUMNS) + '\n'
+
+    def import_csv(self, path, chunksize=50000):
+        """Import a CSV log written by any lamn version; returns the number of rows imported."""
+        imported = 0
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            for column in CSV_COLUMNS:
+                if column not in chunk.columns:
+                    chunk[column] = None
+            chunk = chunk[CSV_COLUMNS].astype(object).where(chunk[CSV_COLUMNS].notna(), None)
+            # Rows imported before are skipped, so running a migration twice is harmless
+            imported += self.write_rows(chunk.values.tolist())
+        return imported
+
+
+def open_store(kind='sqlite', path=None, log_dir='logs'):
+    """Create and open the configured store."""
+    if kind == 'csv':
+        store = CsvStore(path or os.path.join(log_dir, 'machine_metrics.csv'))
+    elif kind == 'sqlite':
+        store = SqliteStore(path or os.path.join(log_dir, 'metrics.db'))
+    else:
+        raise ValueError(f"Unknown storage backend: {kind}")
+    store.open()
+    return store
+
+
+def migrate_csv(store, paths=None, log_dir='logs'):
+    """Import CSV logs (by default every live and archived log in log_dir) into store."""
+    if not paths:
+        # Oldest first, so rollup buckets fill in time order
+        paths = sorted(glob.glob(os.path.join(log_dir, 'machine_metrics*.csv*')), key=os.path.getmtime)
+    total = 0
+    for path in paths:
+        count = store.import_csv(path)
+        print(f"Imported {count} rows from {path}")
+        total += count
+    return total
+
+
+class BatchWriter:
+    """
+    Single writer thread in front of a sink with write_rows() and flush().
+
+    put() never blocks on disk; the writer drains the queue and hands the
+    sink one batch at a time.
+    """
+
+    def __init__(self, sink, max_batch=MAX_BATCH_ROWS, max_delay=MAX_BATCH_DELAY):
+        self.sink = sink
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.rows_written = 0
+        self.on_write = None  # called with (seconds, rows) after every batch written
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = object()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lamn-writer", daemon=True)
+                self._thread.start()
+
+    def put(self, rows):
+        """Queue a list of rows for writing."""
+        if rows:
+            self.start()
+            self._queue.put(rows)
+
+    def stop(self, timeout=5):
+        """Flush everything queued so far and stop the writer thread."""
+        if self._thread is not None:
+            self._queue.put(self._stopping)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            self.sink.write_rows(batch)
+            self.sink.flush()
+            self.rows_written += len(batch)
+        except Exception as e:
+            print(f"Error writing {len(batch)} rows: {e}")
+            return
+        if self.on_write is not None:
+            self.on_write(time.perf_counter() - started, len(batch))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._stopping:
+                return
+            batch = list(item)
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._stopping:
+                    stop = True
+                    break
+                batch.extend(item)
+            self._write(batch)
+            if stop:
+                return
@@ -0,0 +1,66 @@
+import pytest
+
+from lamn.alerts import AlertEngine, build_rule
+
+
+def engine(*rules):
+    engine = AlertEngine([build_rule(rule) for rule in rules], sinks=[])
+    sent = []
+    engine.notifier.put = sent.append  # collect notifications instead of delivering them
+    return engine, sent
+
+
+def feed(engine, values, metric='disk_percent', start=0, step=60):
+    timestamps = [start + i * step for i in range(len(values))]
+    engine.observe('10.0.0.1', 'node1', timestamps, [{metric: value} for value in values])
+
+
+def test_fires_above_limit_and_clears_below_clear_level():
+    alerts, sent = engine({"name": "disk", "metric": "disk_percent", "above": 95, "clear": 90})
+    feed(alerts, [80, 96])
+    assert [a['status'] for a in sent] == ['firing']
+    assert alerts.active()[0]['value'] == 96
+
+    # Inside the hysteresis band the alert stays active and nothing is sent
+    feed(alerts, [94, 91, 95, 90.5], start=120)
+    assert len(sent) == 1 and len(alerts.active()) == 1
+
+    feed(alerts, [89], start=360)
+    assert [a['status'] for a in sent] == ['firing', 'resolved']
+    assert alerts.active() == []
+
+
+def test_band_does_not_trip_a_quiet_alert():
+    # Below the limit but above the clear level: never fired, so nothing happens
+    alerts, sent = engine({"name": "disk", "metric": "disk_percent", "above": 95, "clear": 90})
+    feed(alerts, [92, 94, 93])
+    assert sent == [] and alerts.active() == []
+
+
+def test_below_rule_hysteresis():
+    alerts, sent = engine({"name": "free", "metric": "free", "below": 10, "clear": 20})
+    feed(alerts, [50, 5, 15, 19, 25], metric='free')
+    assert [a['status'] for a in sent] == ['firing', 'resolved']
+    assert sent[1]['timestamp'] == 4 * 60
+
+
+def test_duration_must_hold_before_firing():
+    alerts, sent = engine({"name": "hot", "metric": "cpu", "above": 90, "for": 120})
+    feed(alerts, [95, 95, 50, 95, 95], metric='cpu')
+    assert sent == []
+    feed(alerts, [95], metric='cpu', start=300)
+    assert [a['status'] for a in sent] == ['firing']
+    assert sent[0]['since'] == 300
+
+
+def test_missing_values_are_skipped():
+    alerts, sent = engine({"name": "disk", "metric": "disk_percent", "above": 95, "clear": 90})
+    feed(alerts, [96, None, None])
+    assert [a['status'] for a in sent] == ['firing']
+
+
+def test_level_needs_exactly_one_direction():
+    with pytest.raises(ValueError):
+        build_rule({"metric": "cpu"})
+    with pytest.raises(ValueError):
+        build_rule({"metric": "cpu", "above": 1, "below": 2})
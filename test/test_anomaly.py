@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from lamn.anomaly import AnomalyDetector
+
+METRICS = ['cpu_percent', 'memory_percent']
+
+
+def series(n, seed, start=0, step=1):
+    """n samples of both metrics with a little noise, one every step seconds."""
+    rng = np.random.default_rng(seed)
+    timestamps = [start + i * step for i in range(n)]
+    samples = [{'cpu_percent': 20 + rng.normal(0, 2), 'memory_percent': 50 + rng.normal(0, 1)}
+               for _ in range(n)]
+    return timestamps, samples
+
+
+def detector(**kwargs):
+    kwargs.setdefault('warmup', 30)
+    return AnomalyDetector(METRICS, **kwargs)
+
+
+def test_quiet_series_has_no_anomalies():
+    anomalies = detector()
+    anomalies.observe('10.0.0.1', 'node1', *series(300, seed=1))
+    assert anomalies.anomalies() == []
+    assert anomalies.series == 2
+
+
+def test_lasting_change_is_one_anomaly():
+    anomalies = detector()
+    anomalies.observe('10.0.0.1', 'node1', *series(120, seed=2))
+    spike = [{'cpu_percent': 95.0, 'memory_percent': 50.0} for _ in range(5)]
+    anomalies.observe('10.0.0.1', 'node1', list(range(120, 125)), spike)
+    event, = anomalies.anomalies()
+    assert (event['ip'], event['hostname'], event['metric']) == ('10.0.0.1', 'node1', 'cpu_percent')
+    assert (event['start'], event['end'], event['samples']) == (120, 124, 5)
+    assert event['active'] and event['value'] == 95.0
+    assert event['expected'] == pytest.approx(20, abs=2)
+
+    # Back to normal: the anomaly ends and nothing new is reported
+    anomalies.observe('10.0.0.1', 'node1', *series(10, seed=3, start=125))
+    event, = anomalies.anomalies()
+    assert not event['active'] and event['end'] == 124
+    assert anomalies.anomalies(active=True) == []
+
+
+def test_no_anomaly_during_warmup():
+    anomalies = detector(warmup=50)
+    timestamps, samples = series(20, seed=4)
+    samples[-1]['cpu_percent'] = 99.0
+    anomalies.observe('10.0.0.1', 'node1', timestamps, samples)
+    assert anomalies.anomalies() == []
+
+
+def test_missing_values_are_skipped():
+    anomalies = detector()
+    timestamps, samples = series(100, seed=5)
+    for sample in samples[::3]:
+        sample['memory_percent'] = None
+    anomalies.observe('10.0.0.1', 'node1', timestamps, samples)
+    assert anomalies.anomalies() == []
+
+
+def test_batch_matches_one_host_at_a_time():
+    hosts = [(f'10.0.0.{i}', f'node{i}', *series(150 + 10 * i, seed=i)) for i in range(1, 5)]
+    for _, _, _, samples in hosts[::2]:
+        samples[-3]['cpu_percent'] = 90.0
+    one_by_one, batched = detector(), detector()
+    for host in hosts:
+        one_by_one.observe(*host)
+    batched.observe_many(hosts)
+    assert one_by_one.anomalies() == batched.anomalies()
+    assert {event['ip'] for event in batched.anomalies()} == {'10.0.0.1', '10.0.0.3'}
+    for a, b in ((one_by_one._mean, batched._mean), (one_by_one._var, batched._var)):
+        assert np.allclose(a[:4], b[:4])
+
+
+def test_open_anomalies_are_tracked_per_host():
+    # One host's open anomaly must not end another host's anomaly, or keep it open
+    anomalies = detector()
+    hosts = [(f'10.0.0.{i}', f'node{i}', *series(120, seed=10 + i)) for i in (1, 2)]
+    anomalies.observe_many(hosts)
+    spike = [{'cpu_percent': 95.0, 'memory_percent': 50.0}]
+    anomalies.observe_many([('10.0.0.1', 'node1', [120], spike), ('10.0.0.2', 'node2', [120], spike)])
+    normal = [{'cpu_percent': 20.0, 'memory_percent': 50.0}]
+    anomalies.observe_many([('10.0.0.1', 'node1', [121], spike), ('10.0.0.2', 'node2', [121], normal)])
+    active = {event['ip']: event['active'] for event in anomalies.anomalies()}
+    assert active == {'10.0.0.1': True, '10.0.0.2': False}
+
+
+def test_remove_ends_open_anomalies_and_frees_the_row():
+    anomalies = detector()
+    anomalies.observe('10.0.0.1', 'node1', *series(120, seed=20))
+    anomalies.observe('10.0.0.1', 'node1', [120], [{'cpu_percent': 95.0}])
+    anomalies.remove('10.0.0.1')
+    assert anomalies.anomalies(active=True) == [] and anomalies.series == 0
+    # A new host reuses the row with a fresh state
+    anomalies.observe('10.0.0.2', 'node2', [200], [{'cpu_percent': 95.0}])
+    assert anomalies._rows == {'10.0.0.2': 0}
+    assert anomalies._mean[0, 0] == 95.0
+
+
+def test_filters():
+    anomalies = detector()
+    for ip in ('10.0.0.1', '10.0.0.2'):
+        anomalies.observe(ip, 'node' + ip[-1], *series(120, seed=30))
+        anomalies.observe(ip, 'node' + ip[-1], [120], [{'cpu_percent': 95.0, 'memory_percent': 90.0}])
+    assert len(anomalies.anomalies()) == 4
+    assert {e['ip'] for e in anomalies.anomalies(hosts=['node2'])} == {'10.0.0.2'}
+    assert {e['metric'] for e in anomalies.anomalies(metrics=['memory_percent'])} == {'memory_percent'}
+    assert anomalies.anomalies(start=121) == []
@@ -0,0 +1,99 @@
+import gzip
+import os
+
+import pytest
+
+from lamn.storage import CSV_COLUMNS, ArchiveManager, CsvStore, archive_path, format_timestamp
+
+T0 = 1700000040
+DAY = 86400
+
+
+def row(ts, cpu):
+    values = dict.fromkeys(CSV_COLUMNS)
+    values.update(timestamp=ts, ip='10.0.0.1', hostname='node1', cpu_percent=cpu)
+    return [values[column] for column in CSV_COLUMNS]
+
+
+class Store:
+    def __init__(self):
+        self.pruned = []
+
+    def prune(self, before):
+        self.pruned.append(before)
+        return 0
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / 'machine_metrics.csv')
+
+
+def archive(log_path, name, age_days=0, size=100, now=T0):
+    """An archived log next to log_path, last modified age_days before now."""
+    base, _ = os.path.splitext(log_path)
+    path = f'{base}_{name}.csv'
+    with open(path, 'w') as f:
+        f.write('timestamp\n' + 'x' * (size - len('timestamp\n')))
+    mtime = now - age_days * DAY
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_compress_replaces_the_archive(log_path):
+    path = archive(log_path, '20240101_000000')
+    with open(path) as f:
+        original = f.read()
+    manager = ArchiveManager(log_path, compression='gzip')
+    target = manager.compress(path)
+    assert target == path + '.gz' and not os.path.exists(path)
+    with gzip.open(target, 'rt') as f:
+        assert f.read() == original
+    # Modification time, the archive's age for retention, is kept
+    assert os.path.getmtime(target) == T0
+
+
+def test_compressed_archives_are_still_queried(log_path):
+    store = CsvStore(log_path)
+    store.write_rows([row(T0 + i, float(i)) for i in range(10)])
+    store.close()
+    path = archive_path(log_path)
+    os.replace(log_path, path)
+    store.write_rows([row(T0 + 10, 10.0)])
+    store.close()
+    ArchiveManager(log_path, index=store.archives, compression='gzip').compress(path)
+    df = store.aggregate(T0, T0 + 60, metrics=['cpu_percent'], bucket=60, agg='count')
+    assert df['cpu_percent'].tolist() == [11]
+
+
+def test_retention_by_age(log_path):
+    old = archive(log_path, '20230101_000000', age_days=40)
+    recent = archive(log_path, '20240101_000000', age_days=5)
+    ArchiveManager(log_path, max_age_days=30, max_bytes=0).enforce_retention(now=T0)
+    assert not os.path.exists(old) and os.path.exists(recent)
+
+
+def test_retention_by_total_size_removes_the_oldest_first(log_path):
+    paths = [archive(log_path, f'2024010{i}_000000', age_days=5 - i, size=400) for i in range(4)]
+    ArchiveManager(log_path, max_age_days=0, max_bytes=1000).enforce_retention(now=T0)
+    assert [os.path.exists(path) for path in paths] == [False, False, True, True]
+
+
+def test_retention_leaves_the_live_log_alone(log_path):
+    with open(log_path, 'w') as f:
+        f.write('timestamp\n' + format_timestamp(T0 - 90 * DAY) + '\n')
+    os.utime(log_path, (T0 - 90 * DAY, T0 - 90 * DAY))
+    ArchiveManager(log_path, max_age_days=30, max_bytes=1).enforce_retention(now=T0)
+    assert os.path.exists(log_path)
+
+
+def test_store_is_not_pruned_by_default(log_path):
+    store = Store()
+    ArchiveManager(log_path, store=store, max_age_days=30).enforce_retention(now=T0)
+    assert store.pruned == []
+
+
+def test_store_pruning_is_opt_in(log_path):
+    store = Store()
+    ArchiveManager(log_path, store=store, max_age_days=30, store_max_age_days=90).enforce_retention(now=T0)
+    assert store.pruned == [T0 - 90 * DAY]
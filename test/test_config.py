@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+
+import pytest
+
+from lamn.config import AgentRegistry
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / 'agents.json'
+
+
+def write(path, entries):
+    """Edit the file as another process would, with a distinct modification time."""
+    path.write_text(json.dumps(entries))
+    stamp = os.stat(path).st_mtime_ns + 10 ** 9
+    os.utime(path, ns=(stamp, stamp))
+
+
+def test_missing_file_is_created_empty(path):
+    registry = AgentRegistry(str(path))
+    assert registry.ips() == []
+    assert json.loads(path.read_text()) == []
+
+
+def test_reloads_only_when_the_file_changes(path):
+    write(path, ['10.0.0.1', {'ip': '10.0.0.2', 'tags': 'gpu', 'group': 'lab'}])
+    registry = AgentRegistry(str(path))
+    assert registry.ips() == ['10.0.0.1', '10.0.0.2']
+    version = registry.version
+    registry.ips()
+    assert registry.version == version
+
+    write(path, ['10.0.0.3'])
+    assert registry.ips() == ['10.0.0.3']
+    assert registry.version == version + 1
+
+
+def test_tags_and_groups(path):
+    write(path, [{'ip': '10.0.0.1', 'tags': ['gpu', 'big']}, {'ip': '10.0.0.2', 'group': 'lab'},
+                 {'ip': '10.0.0.3', 'tags': 'gpu', 'port': 5001}])
+    registry = AgentRegistry(str(path))
+    assert registry.ips(tags=['gpu']) == ['10.0.0.1', '10.0.0.3']
+    assert registry.tagged(['lab', 'big']) == {'10.0.0.1', '10.0.0.2'}
+    assert registry.labels() == {'big': 1, 'gpu': 2, 'lab': 1}
+    assert registry.attribute('port') == {'10.0.0.3': 5001}
+
+
+def test_invalid_file_keeps_the_last_good_list(path, caplog):
+    write(path, ['10.0.0.1'])
+    registry = AgentRegistry(str(path))
+    registry.ips()
+    path.write_text('["10.0.0.1", ')
+    with caplog.at_level(logging.WARNING, logger='lamn.config'):
+        assert registry.ips() == ['10.0.0.1']
+    assert 'Ignoring invalid' in caplog.text
+    # Fixed on the next edit
+    write(path, ['10.0.0.1', '10.0.0.2'])
+    assert registry.ips() == ['10.0.0.1', '10.0.0.2']
+
+
+def test_invalid_file_on_first_read_raises(path):
+    path.write_text('[{"name": "no ip"}]')
+    with pytest.raises(ValueError):
+        AgentRegistry(str(path)).ips()
+
+
+def test_add_and_remove(path):
+    registry = AgentRegistry(str(path))
+    assert registry.add('10.0.0.1')
+    assert registry.add('10.0.0.1', tags=['gpu'])
+    assert not registry.add('10.0.0.1', tags=['gpu'])
+    assert registry.get('10.0.0.1') == {'ip': '10.0.0.1', 'tags': ['gpu']}
+    assert registry.remove('10.0.0.1') and not registry.remove('10.0.0.1')
+    assert json.loads(path.read_text()) == []
+
+
+def test_write_is_atomic_and_keeps_the_file_mode(path):
+    write(path, ['10.0.0.1'])
+    os.chmod(path, 0o600)
+    registry = AgentRegistry(str(path))
+    registry.add('10.0.0.2', group='lab')
+    assert json.loads(path.read_text()) == ['10.0.0.1', {'ip': '10.0.0.2', 'group': 'lab'}]
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert sorted(os.listdir(path.parent)) == ['agents.json']
+
+
+def test_write_follows_a_symlink(tmp_path):
+    target = tmp_path / 'shared' / 'agents.json'
+    target.parent.mkdir()
+    write(target, [])
+    link = tmp_path / 'agents.json'
+    link.symlink_to(target)
+    AgentRegistry(str(link)).add('10.0.0.1')
+    assert link.is_symlink()
+    assert json.loads(target.read_text()) == ['10.0.0.1']
+
+
+def test_replace(path):
+    registry = AgentRegistry(str(path))
+    registry.add('10.0.0.1')
+    registry.replace(['10.0.0.2', {'ip': '10.0.0.3', 'tags': 'gpu'}])
+    assert registry.ips() == ['10.0.0.2', '10.0.0.3']
+    assert registry.get('10.0.0.3')['tags'] == ['gpu']
+    # An invalid entry is rejected before anything is written
+    with pytest.raises(ValueError):
+        registry.replace(['10.0.0.4', {'tags': ['no ip']}])
+    assert registry.ips() == ['10.0.0.2', '10.0.0.3']
@@ -0,0 +1,75 @@
+import json
+
+from lamn.events import RETRY_MS, EventHub, format_event
+
+
+def parse(message):
+    """SSE message -> (id, event, data)."""
+    fields = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+    return int(fields['id']), fields['event'], json.loads(fields['data'])
+
+
+def open_stream(hub, last_event_id=None, heartbeat=5):
+    stream = hub.stream(lambda: {'hosts': 2}, last_event_id, heartbeat)
+    assert next(stream) == f"retry: {RETRY_MS}\n\n"
+    return stream
+
+
+def test_format_event():
+    assert format_event(3, 'agent', {'ip': '10.0.0.1'}) == 'id: 3\nevent: agent\ndata: {"ip":"10.0.0.1"}\n\n'
+    assert format_event(4, 'agent', b'[1]') == 'id: 4\nevent: agent\ndata: [1]\n\n'
+
+
+def test_new_client_gets_a_snapshot_then_events():
+    hub = EventHub()
+    hub.publish('agent', {'n': 1})
+    stream = open_stream(hub)
+    assert parse(next(stream)) == (1, 'snapshot', {'hosts': 2})
+    hub.publish('agent', {'n': 2})
+    assert parse(next(stream)) == (2, 'agent', {'n': 2})
+    assert hub.clients == 1
+    stream.close()
+    assert hub.clients == 0
+
+
+def test_reconnect_replays_the_missed_events():
+    hub = EventHub(replay=10)
+    for n in range(1, 6):
+        hub.publish('agent', {'n': n})
+    stream = open_stream(hub, last_event_id=3)
+    assert [parse(next(stream))[:2] for _ in range(2)] == [(4, 'agent'), (5, 'agent')]
+    assert hub.backlog == 0
+
+
+def test_reconnect_past_the_replay_buffer_gets_a_snapshot():
+    hub = EventHub(replay=3)
+    for n in range(1, 8):
+        hub.publish('agent', {'n': n})
+    stream = open_stream(hub, last_event_id=2)
+    assert parse(next(stream))[:2] == (7, 'snapshot')
+
+
+def test_unknown_event_id_gets_a_snapshot():
+    # An id from before a server restart is ahead of the new sequence
+    hub = EventHub()
+    hub.publish('agent', {'n': 1})
+    stream = open_stream(hub, last_event_id=500)
+    assert parse(next(stream))[:2] == (1, 'snapshot')
+
+
+def test_slow_client_is_dropped():
+    hub = EventHub(client_queue=2)
+    stream = open_stream(hub)
+    next(stream)
+    for n in range(3):
+        hub.publish('agent', {'n': n})
+    assert hub.clients == 0
+    # The queued events are not delivered; the stream ends so the browser reconnects
+    assert list(stream) == []
+
+
+def test_heartbeat_while_idle():
+    hub = EventHub()
+    stream = open_stream(hub, heartbeat=0.01)
+    next(stream)
+    assert next(stream) == ": keep-alive\n\n"
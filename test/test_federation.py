@@ -0,0 +1,145 @@
+import collections
+import json
+
+import pytest
+import requests
+
+from lamn import aggregator
+from lamn.federation import Federation, HashRing
+
+IPS = [f'10.{i // 250}.{i % 250}.1' for i in range(3000)]
+
+
+# --- Shard assignment ---
+
+def test_hash_ring_spreads_keys_evenly():
+    ring = HashRing(['a', 'b', 'c'])
+    counts = collections.Counter(ring.node(ip) for ip in IPS)
+    assert set(counts) == {'a', 'b', 'c'}
+    assert min(counts.values()) > len(IPS) / 3 * 0.7
+    assert HashRing(['c', 'a', 'b']).node(IPS[0]) == ring.node(IPS[0])
+    assert HashRing([]).node(IPS[0]) is None
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before, after = HashRing(['a', 'b', 'c']), HashRing(['a', 'b', 'c', 'd'])
+    moved = [ip for ip in IPS if before.node(ip) != after.node(ip)]
+    assert all(after.node(ip) == 'd' for ip in moved)
+    assert len(moved) < len(IPS) / 4 * 1.5
+
+
+def test_owner_precedence():
+    federation = Federation({'lab': 'http://lab', 'hpc': 'http://hpc'}, shard='lab',
+                            assign='tags', tags={'hpc': ['cluster']})
+    assert federation.owner({'ip': '10.0.0.1', 'shard': 'lab', 'tags': ['cluster']}) == 'lab'
+    assert federation.owner({'ip': '10.0.0.1', 'group': 'cluster'}) == 'hpc'
+    assert federation.owner({'ip': '10.0.0.1'}) == federation.ring.node('10.0.0.1')
+    agents = [{'ip': ip} for ip in IPS[:100]]
+    local = federation.local(agents)
+    assert local == [a['ip'] for a in agents if federation.ring.node(a['ip']) == 'lab']
+    assert Federation({'lab': 'http://lab'}).local(agents) == IPS[:100]
+
+
+def test_unknown_shard_is_rejected():
+    with pytest.raises(ValueError):
+        Federation({'lab': 'http://lab'}, shard='hpc').check()
+
+
+# --- Aggregator ---
+
+def response(data, status=200, headers=None):
+    answer = requests.Response()
+    answer.status_code = status
+    answer._content = json.dumps(data).encode()
+    answer.headers.update(headers or {})
+    answer.url = 'http://shard'
+    return answer
+
+
+class FakeShard:
+    """A shard answering GETs from routes: path -> function of the query params returning a Response."""
+
+    def __init__(self, name, routes):
+        self.name = name
+        self.routes = routes
+        self.requests = []
+
+    def get(self, path, params=None, **kwargs):
+        self.requests.append((path, dict(params or {})))
+        return self.routes[path](params or {})
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(aggregator, 'cursors', collections.OrderedDict())
+    monkeypatch.setattr(aggregator, 'next_cursor', 1)
+    return aggregator.app.test_client()
+
+
+def use_shards(monkeypatch, *shards):
+    monkeypatch.setattr(aggregator, 'shards', list(shards))
+
+
+def down(params):
+    raise requests.ConnectionError("shard down")
+
+
+def test_rows_are_merged_in_time_order(monkeypatch, client):
+    rows = {'a': ['2024-01-01 00:00:02', '2024-01-01 00:00:04'], 'b': ['2024-01-01 00:00:03']}
+    use_shards(monkeypatch, *[FakeShard(name, {'/csv_data': lambda params, name=name: response(
+        [{'timestamp': ts, 'shard': name} for ts in rows[name]])}) for name in rows],
+        FakeShard('c', {'/csv_data': down}))
+    answer = client.get('/csv_data')
+    assert [row['shard'] for row in answer.get_json()] == ['a', 'b', 'a']
+    assert answer.headers['X-Failed-Shards'] == 'c'
+
+
+def recent(name, hosts, log):
+    """/csv_data?since= of a shard whose cursor counts its calls; since beyond it is a 400."""
+    def answer(params):
+        log.append(params['since'])
+        if params['since'] > len(log):
+            return response({"error": "since must be a cursor"}, status=400)
+        return response({"cursor": len(log), "capacity": 1800, "fields": ["cpu_percent"],
+                         "hosts": hosts(params['since'])})
+    return FakeShard(name, {'/csv_data': answer})
+
+
+def test_recent_samples_use_one_cursor_per_shard(monkeypatch, client):
+    calls = {'a': [], 'b': []}
+    use_shards(monkeypatch,
+               recent('a', lambda since: {'10.0.0.1': {'cpu_percent': [since]}}, calls['a']),
+               recent('b', lambda since: {'10.0.1.1': {'cpu_percent': [since]}}, calls['b']))
+    first = client.get('/csv_data?since=0').get_json()
+    assert set(first['hosts']) == {'10.0.0.1', '10.0.1.1'}
+    assert first['capacity'] == 1800 and first['fields'] == ['cpu_percent']
+    second = client.get(f"/csv_data?since={first['cursor']}").get_json()
+    # Each shard is asked from the cursor it handed out itself
+    assert calls == {'a': [0, 1], 'b': [0, 1]}
+    assert second['cursor'] != first['cursor']
+
+
+def test_shard_that_forgot_its_cursor_is_read_again(monkeypatch, client):
+    calls = []
+    use_shards(monkeypatch, recent('a', lambda since: {'10.0.0.1': {'cpu_percent': [since]}}, calls))
+    cursor = client.get('/csv_data?since=0').get_json()['cursor']
+    aggregator.cursors[cursor] = {'a': 99}
+    answer = client.get(f'/csv_data?since={cursor}')
+    assert answer.status_code == 200
+    assert calls == [0, 99, 0]
+
+
+@pytest.mark.parametrize('since', ['12345', 'abc'])
+def test_unknown_aggregator_cursor(monkeypatch, client, since):
+    use_shards(monkeypatch)
+    assert client.get(f'/csv_data?since={since}').status_code == 400
+
+
+def test_agents_name_the_shard_polling_them(monkeypatch, client):
+    listing = {"agents": [{'ip': '10.0.0.1', 'tags': ['gpu']}, {'ip': '10.0.0.2'}]}
+    use_shards(monkeypatch,
+               FakeShard('a', {'/agents': lambda params: response(dict(listing, polled=['10.0.0.1']))}),
+               FakeShard('b', {'/agents': lambda params: response(dict(listing, polled=['10.0.0.2']))}))
+    data = client.get('/agents').get_json()
+    assert {agent['ip']: agent['shard'] for agent in data['agents']} == {'10.0.0.1': 'a', '10.0.0.2': 'b'}
+    assert data['tags'] == {'gpu': 1}
@@ -0,0 +1,120 @@
+import os
+import stat
+import time
+
+import pytest
+
+from lamn import gpu
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason="the fake nvidia-smi is a shell script")
+
+LINES = ["0, A100, 10, 1000, 40000, 50", "1, A100, 30, 3000, 40000, 60"]
+
+
+def fake_smi(tmp_path, body, count=None):
+    """Write a fake nvidia-smi; count answers --query-gpu=count, None makes that query fail."""
+    script = tmp_path / 'nvidia-smi'
+    answer = f'echo {count}; exit 0' if count is not None else 'exit 6'
+    script.write_text(f'#!/bin/sh\ncase "$1" in --query-gpu=count) {answer};; esac\n{body}\n')
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    return str(script)
+
+
+def loop(*lines, first_delay=0, gap=0.1):
+    """Shell loop printing lines every round, like nvidia-smi --loop."""
+    echoes = f'; sleep {gap}; '.join(f'echo "{line}"' for line in lines)
+    return f'sleep {first_delay}\nwhile true; do {echoes}; sleep 1; done'
+
+
+@pytest.fixture
+def backends():
+    created = []
+    yield created
+    for backend in created:
+        backend.close()
+
+
+def test_parse_smi_line():
+    assert gpu.parse_smi_line(LINES[1]) == {
+        "index": 1, "name": "A100", "utilization": 30.0,
+        "memory_used": 3000.0, "memory_total": 40000.0, "temperature": 60.0}
+    assert gpu.parse_smi_line("0, T4, [N/A], 1, 2, [Not Supported]")["utilization"] is None
+    assert gpu.parse_smi_line("garbage") is None
+
+
+@pytest.mark.parametrize('count', [2, None])
+def test_reports_every_gpu_of_the_first_round(tmp_path, backends, count):
+    # The second GPU's line comes well after the first one
+    backend = gpu.NvidiaSmiLoopBackend(fake_smi(tmp_path, loop(*LINES, gap=0.5), count))
+    backends.append(backend)
+    assert backend.count == count
+    assert [g["index"] for g in backend.gpus()] == [0, 1]
+    assert backend.ready
+
+
+def test_not_ready_before_a_complete_round(tmp_path, backends, monkeypatch):
+    monkeypatch.setattr(gpu, 'FIRST_READING_TIMEOUT', 0.5)
+    backend = gpu.NvidiaSmiLoopBackend(fake_smi(tmp_path, loop(*LINES, gap=2), 2))
+    backends.append(backend)
+    started = time.monotonic()
+    assert backend.gpus() == []
+    assert not backend.ready
+    # The first-reading timeout is spent once, not on every call
+    assert backend.gpus() == []
+    assert time.monotonic() - started < 1.5
+
+
+def test_exited_nvidia_smi_fails(tmp_path, backends):
+    backend = gpu.NvidiaSmiLoopBackend(fake_smi(tmp_path, 'exit 9', 1))
+    backends.append(backend)
+    with pytest.raises(gpu.GpuBackendError):
+        backend.gpus()
+
+
+def test_monitor_falls_back_to_no_gpu(tmp_path, monkeypatch):
+    monkeypatch.setenv('LAMN_NVIDIA_SMI', fake_smi(tmp_path, 'exit 9', 1))
+    monitor = gpu.GpuMonitor(kind='smi')
+    assert monitor.gpus() == []
+    assert isinstance(monitor.backend, gpu.NullBackend)
+    monitor.close()
+
+
+def test_monitor_recreates_a_backend_that_reported_gpus(tmp_path, monkeypatch):
+    # One complete round, then nvidia-smi dies, as on a driver reload
+    monkeypatch.setattr(gpu, 'RETRY_DELAY', 0.2)
+    monkeypatch.setenv('LAMN_NVIDIA_SMI', fake_smi(tmp_path, 'echo "%s"; echo "%s"; sleep 0.3' % tuple(LINES), 2))
+    monitor = gpu.GpuMonitor(kind='smi')
+    try:
+        assert len(monitor.gpus()) == 2
+        time.sleep(0.5)
+        assert monitor.gpus() == []       # failed; retried after the backoff
+        assert monitor.gpus() == []
+        time.sleep(0.3)
+        assert len(monitor.gpus()) == 2
+        assert isinstance(monitor.backend, gpu.NvidiaSmiLoopBackend)
+    finally:
+        monitor.close()
+
+
+def test_slow_start_is_not_cached_as_no_gpu(tmp_path, monkeypatch):
+    client = pytest.importorskip('lamn.client')
+    monkeypatch.setattr(gpu, 'FIRST_READING_TIMEOUT', 0.2)
+    monkeypatch.setenv('LAMN_NVIDIA_SMI', fake_smi(tmp_path, loop(*LINES, first_delay=1), 2))
+    monitor = gpu.GpuMonitor(kind='smi')
+    monkeypatch.setattr(client, 'gpu_monitor', monitor)
+    monkeypatch.setattr(client, 'collect_static_specs', lambda: {"cpu": "cpu", "ram": 0, "os": {}})
+    try:
+        specs = client.SpecCache()
+        assert specs.get()["gpus"] == []
+        deadline = time.monotonic() + 5
+        while not specs.get()["gpus"] and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert specs.get()["gpu"] == "A100, A100"
+        assert len(specs.get()["gpus"]) == 2
+    finally:
+        monitor.close()
+
+
+def test_summarize():
+    assert gpu.summarize([]) is None
+    assert gpu.summarize([{"utilization": 10.0}, {"utilization": None}, {"utilization": 31.0}]) == 20.5
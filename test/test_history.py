@@ -0,0 +1,87 @@
+import pytest
+
+from lamn import history
+from lamn.history import HostWindows, SampleRing
+
+FIELDS = ['cpu', 'memory']
+
+
+def samples(*values):
+    return [{'cpu': value, 'memory': 50.0} for value in values]
+
+
+def test_since_returns_only_new_samples():
+    windows = HostWindows(FIELDS, capacity=10)
+    windows.append('a', [1, 2], samples(10, 20), info={'hostname': 'node-a'})
+    cursor, hosts = windows.since(0)
+    assert cursor == windows.sequence
+    assert hosts['a']['timestamp'] == [1, 2] and hosts['a']['cpu'] == [10, 20]
+    assert hosts['a']['hostname'] == 'node-a'
+
+    windows.append('a', [3], samples(30))
+    windows.append('b', [3], samples(None))
+    cursor, hosts = windows.since(cursor)
+    assert hosts['a']['timestamp'] == [3]
+    assert hosts['b']['cpu'] == [None]
+
+    assert windows.since(cursor) == (cursor, {})
+
+
+def test_since_filters_by_key_or_hostname():
+    windows = HostWindows(FIELDS, capacity=10)
+    windows.append('a', [1], samples(1), info={'hostname': 'node-a'})
+    windows.append('b', [1], samples(2), info={'hostname': 'node-b'})
+    assert list(windows.since(0, keys=['b'])[1]) == ['b']
+    assert list(windows.since(0, keys=['node-a'])[1]) == ['a']
+
+
+def test_since_is_bounded_by_the_window():
+    windows = HostWindows(FIELDS, capacity=3)
+    windows.append('a', list(range(1, 6)), samples(*range(5)))
+    assert windows.since(0)[1]['a']['timestamp'] == [3, 4, 5]
+
+
+def test_old_and_repeated_timestamps_are_dropped():
+    windows = HostWindows(FIELDS, capacity=10)
+    windows.append('a', [1, 2], samples(1, 2))
+    cursor = windows.sequence
+    windows.append('a', [2, 3], samples(2, 3))
+    assert windows.since(cursor)[1]['a']['timestamp'] == [3]
+
+
+@pytest.mark.parametrize('cursor', [-1, 99])
+def test_unknown_cursor_is_rejected(cursor):
+    windows = HostWindows(FIELDS, capacity=10)
+    windows.append('a', [1], samples(1))
+    with pytest.raises(ValueError):
+        windows.since(cursor)
+
+
+def test_removed_host_is_forgotten():
+    windows = HostWindows(FIELDS, capacity=10)
+    windows.append('a', [1], samples(1))
+    windows.remove('a')
+    assert windows.since(0)[1] == {} and len(windows) == 0
+
+
+def test_ring_since_timestamp():
+    ring = SampleRing(FIELDS, capacity=4)
+    for ts in range(1, 7):
+        ring.append(ts, {'cpu': ts})
+    assert ring.since()['timestamp'] == [3, 4, 5, 6]
+    assert ring.since(4)['cpu'] == [5, 6]
+    assert ring.since(4)['memory'] == [None, None]
+
+
+def test_ring_grows_up_to_its_capacity(monkeypatch):
+    monkeypatch.setattr(history, 'INITIAL_SIZE', 2)
+    ring = SampleRing(FIELDS, capacity=5)
+    assert len(ring._times) == 2
+    for ts in range(1, 4):
+        ring.append(ts, {'cpu': ts})
+    assert len(ring._times) == 4
+    for ts in range(4, 9):
+        ring.append(ts, {'cpu': ts, 'memory': 1.0})
+    assert len(ring._times) == 5
+    assert ring.since()['timestamp'] == [4, 5, 6, 7, 8]
+    assert ring.since(6)['cpu'] == [7, 8]
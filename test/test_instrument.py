@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from lamn.instrument import BOUNDS, LatencyHistogram, SamplingProfiler
+from lamn.prometheus import Exposition
+
+
+def test_percentiles_within_bucket_accuracy():
+    histogram = LatencyHistogram()
+    for ms in range(1, 1001):
+        histogram.observe(ms / 1000)
+    summary = histogram.summary()
+    assert summary['count'] == 1000 and summary['max'] == 1.0
+    assert summary['mean'] == pytest.approx(0.5005)
+    assert summary['p50'] == pytest.approx(0.5, rel=0.25)
+    assert summary['p99'] == pytest.approx(0.99, rel=0.25)
+
+
+def test_prometheus_view_of_the_same_histogram():
+    histogram = LatencyHistogram()
+    for seconds in (0.00005, 0.002, 0.002, 0.3, 1000):
+        histogram.observe(seconds)
+    exposition = Exposition()
+    histogram.collect(exposition, 'lamn_poll_duration_seconds', 'Poll time')
+    lines = exposition.render().split('\n')
+    buckets = [line for line in lines if line.startswith('lamn_poll_duration_seconds_bucket')]
+    assert len(buckets) == len(BOUNDS) + 1
+    counts = {line.split('"')[1]: int(line.split()[-1]) for line in buckets}
+    assert counts[repr(BOUNDS[0])] == 1
+    assert counts[repr(min(b for b in BOUNDS if b >= 0.002))] == 3
+    assert counts[repr(BOUNDS[-1])] == 4
+    assert counts['+Inf'] == 5
+    assert 'lamn_poll_duration_seconds_count 5' in lines
+    assert BOUNDS == sorted(BOUNDS)
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_timed_profile_stops_by_itself():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy, args=(stop,), name="busy-worker")
+    worker.start()
+    try:
+        profiler = SamplingProfiler(interval=0.001)
+        assert profiler.start(seconds=0.2)
+        assert not profiler.start()
+        deadline = time.monotonic() + 5
+        while profiler.running and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert not profiler.running
+        assert profiler.samples > 0
+        assert 'busy-worker;' in profiler.collapsed()
+        # A new profile can be started once the timed one is over
+        assert profiler.start()
+        assert profiler.stop() and not profiler.stop()
+    finally:
+        stop.set()
+        worker.join()
@@ -0,0 +1,164 @@
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from lamn.poller import AgentPoller
+
+METRICS = b'{"host": "a", "cpu": 12.5}'
+
+
+def response(body=METRICS, headers=()):
+    head = [b'HTTP/1.1 200 OK', b'Content-Type: application/json',
+            b'Content-Length: %d' % len(body), *headers]
+    return b'\r\n'.join(head) + b'\r\n\r\n' + body
+
+
+class Agent(socketserver.ThreadingTCPServer):
+    """
+    Scripted HTTP agent on localhost: reply(path) returns the raw bytes sent
+    back for each request, or None to hang up without answering.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), AgentHandler)
+        self.reply = lambda path: response()
+        self.connections = 0
+        self.requests = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            request_line = self.rfile.readline()
+            if not request_line:
+                return
+            while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            path = request_line.split()[1].decode()
+            self.server.requests.append(path)
+            answer = self.server.reply(path)
+            if answer is None:
+                return
+            self.wfile.write(answer)
+            if b'Connection: close' in answer:
+                return
+
+
+@pytest.fixture
+def agent():
+    server = Agent()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def poller(agent):
+    poller = AgentPoller(port=agent.port, timeout=1)
+    yield poller
+    poller.loop.call_soon_threadsafe(poller.loop.stop)
+
+
+def poll(poller, history_params=None):
+    result, = poller.poll_many(['127.0.0.1'], lambda ip: history_params)
+    return result
+
+
+def test_polls_reuse_a_keep_alive_connection(agent, poller):
+    for _ in range(3):
+        result = poll(poller)
+        assert result.ok and result.data == {"host": "a", "cpu": 12.5}
+    assert agent.connections == 1
+    assert agent.requests == ['/metrics'] * 3
+
+
+def test_metrics_and_history_share_a_connection(agent, poller):
+    agent.reply = lambda path: response(b'{"samples": {"timestamp": [1.0]}}' if 'history' in path else METRICS)
+    result = poll(poller, {'since': 5})
+    assert result.samples == {"timestamp": [1.0]}
+    assert agent.requests == ['/metrics', '/metrics/history?since=5']
+    assert agent.connections == 1
+
+
+def test_connection_close_is_not_reused(agent, poller):
+    agent.reply = lambda path: response(headers=[b'Connection: close'])
+    assert poll(poller).ok
+    assert poll(poller).ok
+    assert agent.connections == 2
+
+
+def test_chunked_body(agent, poller):
+    half = len(METRICS) // 2
+    chunks = b''.join(b'%x\r\n%s\r\n' % (len(part), part) for part in (METRICS[:half], METRICS[half:]))
+    agent.reply = lambda path: (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                + chunks + b'0\r\n\r\n')
+    assert poll(poller).data == {"host": "a", "cpu": 12.5}
+    assert poll(poller).ok
+    assert agent.connections == 1
+
+
+def test_retries_an_idle_connection_the_agent_dropped(agent, poller):
+    assert poll(poller).ok
+    # The agent hangs up on the pooled connection instead of answering
+    answers = iter([None])
+    agent.reply = lambda path: next(answers, response())
+    assert poll(poller).ok
+    assert agent.connections == 2
+
+
+def test_timeout(agent, poller):
+    agent.reply = lambda path: time.sleep(3)
+    result = poll(poller)
+    assert not result.ok
+    assert result.error.startswith("Timeout error")
+    assert result.latency < 2
+
+
+def test_http_error(agent, poller):
+    agent.reply = lambda path: b'HTTP/1.1 500 INTERNAL SERVER ERROR\r\nContent-Length: 0\r\n\r\n'
+    result = poll(poller)
+    assert not result.ok and "HTTP 500" in result.error
+
+
+def test_missing_history_keeps_the_snapshot(agent, poller):
+    agent.reply = lambda path: (b'HTTP/1.1 404 NOT FOUND\r\nContent-Length: 0\r\n\r\n'
+                                if 'history' in path else response())
+    result = poll(poller, {'since': 0})
+    assert result.ok and result.samples is None
+
+
+@pytest.mark.parametrize('answer', [
+    b'garbage\r\n\r\n',
+    response(b'{"host": '),
+    b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\nConnection: close\r\n\r\n{}',
+])
+def test_malformed_response(agent, poller, answer):
+    agent.reply = lambda path: answer
+    result = poll(poller)
+    assert not result.ok
+    assert result.error
+    # The poller recovers once the agent answers properly again
+    agent.reply = lambda path: response()
+    assert poll(poller).ok
+
+
+def test_refused_connection():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    poller = AgentPoller(port=port, timeout=1)
+    result = poll(poller)
+    poller.loop.call_soon_threadsafe(poller.loop.stop)
+    assert not result.ok and result.error.startswith("Connection error")
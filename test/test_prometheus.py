@@ -0,0 +1,97 @@
+import re
+
+from lamn.prometheus import Counter, Exposition, add_histogram, agents_exposition
+
+# name{label="value",...} value, as in the text format 0.0.4
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? '
+                    r'(-?[0-9.e+-]+|NaN|[+-]Inf)$')
+
+
+def check_format(text):
+    """Every line is a comment or a valid sample, and each family is typed once, before its samples."""
+    assert text.endswith('\n')
+    typed = []
+    for line in text.rstrip('\n').split('\n'):
+        if line.startswith('# TYPE '):
+            typed.append(line.split()[2])
+        elif not line.startswith('# HELP '):
+            assert SAMPLE.match(line), line
+            assert line.startswith(typed[-1])
+    assert len(typed) == len(set(typed))
+
+
+def test_samples_are_grouped_by_family():
+    exposition = Exposition()
+    exposition.add('lamn_cpu_percent', 12.5, {'ip': '10.0.0.1'}, help='CPU')
+    exposition.add('lamn_up', True, {'ip': '10.0.0.1'})
+    exposition.add('lamn_cpu_percent', 30, {'ip': '10.0.0.2'}, help='CPU')
+    exposition.add('lamn_missing', None)
+    exposition.add('lamn_text', 'n/a')
+    text = exposition.render()
+    check_format(text)
+    assert text == ('# HELP lamn_cpu_percent CPU\n'
+                    '# TYPE lamn_cpu_percent gauge\n'
+                    'lamn_cpu_percent{ip="10.0.0.1"} 12.5\n'
+                    'lamn_cpu_percent{ip="10.0.0.2"} 30\n'
+                    '# TYPE lamn_up gauge\n'
+                    'lamn_up{ip="10.0.0.1"} 1\n')
+
+
+def test_label_values_and_special_floats_are_escaped():
+    exposition = Exposition()
+    exposition.add('lamn_x', float('nan'), {'model': 'A "big"\\one\nGPU'})
+    exposition.add('lamn_x', float('inf'), {'model': 'b'})
+    text = exposition.render()
+    check_format(text)
+    assert 'lamn_x{model="A \\"big\\"\\\\one\\nGPU"} NaN\n' in text
+    assert 'lamn_x{model="b"} +Inf\n' in text
+
+
+def test_counter():
+    polls = Counter('lamn_polls_total', 'Agent polls by result', ('result',))
+    polls.inc('ok')
+    polls.inc('ok')
+    polls.inc('error', amount=3)
+    exposition = Exposition()
+    polls.collect(exposition)
+    text = exposition.render()
+    check_format(text)
+    assert '# TYPE lamn_polls_total counter\n' in text
+    assert 'lamn_polls_total{result="ok"} 2\n' in text
+    assert 'lamn_polls_total{result="error"} 3\n' in text
+
+
+def test_histogram_is_cumulative():
+    exposition = Exposition()
+    add_histogram(exposition, 'lamn_poll_duration_seconds', 'Poll time', (0.1, 1), [1, 2], 4.25, 4)
+    text = exposition.render()
+    check_format(text)
+    assert text.split('\n')[2:8] == [
+        'lamn_poll_duration_seconds_bucket{le="0.1"} 1',
+        'lamn_poll_duration_seconds_bucket{le="1.0"} 3',
+        'lamn_poll_duration_seconds_bucket{le="+Inf"} 4',
+        'lamn_poll_duration_seconds_sum 4.25',
+        'lamn_poll_duration_seconds_count 4',
+        '']
+
+
+def test_agents_exposition():
+    text = agents_exposition({
+        '10.0.0.1': {'host': 'node1', 'cpu': 10.0, 'memory': 20.0, 'gpu': None,
+                     'gpus': [{'index': 0, 'name': 'A100', 'utilization': 50.0, 'memory_used': 1024,
+                               'memory_total': None, 'temperature': 60}],
+                     'io': {'disks': {'sda': {'read_bps': 100.0, 'write_bps': 0.0}},
+                            'nics': {'eth0': {'rx_bps': 5.0, 'tx_bps': 6.0}}}},
+        '10.0.0.2': {'error': 'Timeout error'},
+    }).render()
+    check_format(text)
+    assert 'lamn_agent_up{ip="10.0.0.1",hostname="node1"} 1\n' in text
+    assert 'lamn_agent_up{ip="10.0.0.2",hostname="10.0.0.2"} 0\n' in text
+    assert 'lamn_cpu_percent{ip="10.0.0.1",hostname="node1"} 10.0\n' in text
+    assert 'lamn_gpu_percent' not in text and 'lamn_gpu_memory_total_bytes' not in text
+    assert 'lamn_gpu_memory_used_bytes{ip="10.0.0.1",hostname="node1",gpu="0",model="A100"} 1073741824\n' in text
+    assert 'lamn_device_read_bytes_per_second{ip="10.0.0.1",hostname="node1",device="sda"} 100.0\n' in text
+    assert 'lamn_nic_transmit_bytes_per_second{ip="10.0.0.1",hostname="node1",nic="eth0"} 6.0\n' in text
+    # Nothing but up for the agent that failed
+    assert [line for line in text.split('\n') if '10.0.0.2' in line] == [
+        'lamn_agent_up{ip="10.0.0.2",hostname="10.0.0.2"} 0']
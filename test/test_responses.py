@@ -0,0 +1,103 @@
+import gzip
+
+import pytest
+from flask import Flask
+
+from lamn import responses
+from lamn.responses import ResponseCache
+
+BIG = b'[' + b','.join(b'%d' % i for i in range(1000)) + b']'
+
+
+@pytest.fixture
+def app():
+    """App serving /data from a ResponseCache; state holds the cache key and data version."""
+    app = Flask(__name__)
+    app.cache = ResponseCache(max_entries=2)
+    app.state = {'key': '', 'version': 1, 'body': BIG, 'builds': 0}
+
+    @app.route('/data')
+    def data():
+        def build():
+            app.state['builds'] += 1
+            return app.state['body'], {'X-Rows': '1000'}
+        return app.cache.respond(f"/data?{app.state['key']}", app.state['version'], build)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def test_body_is_built_once_per_version(app, client):
+    for _ in range(3):
+        response = client.get('/data')
+        assert response.data == BIG and response.headers['X-Rows'] == '1000'
+    assert app.state['builds'] == 1
+    app.state['version'] = 2
+    client.get('/data')
+    assert app.state['builds'] == 2
+
+
+def test_not_modified_until_the_version_changes(app, client):
+    etag = client.get('/data').headers['ETag']
+    response = client.get('/data', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    assert response.headers['ETag'] == etag
+    app.state['version'] = 2
+    response = client.get('/data', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+
+def test_etag_depends_on_the_key(app, client):
+    first = client.get('/data').headers['ETag']
+    app.state['key'] = 'hosts=a'
+    assert client.get('/data').headers['ETag'] != first
+
+
+def test_gzip_when_accepted(client):
+    response = client.get('/data', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(response.data) == BIG
+
+
+def test_identity_without_accept_encoding(client):
+    response = client.get('/data')
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+
+def test_small_bodies_are_not_compressed(app, client):
+    app.state['body'] = b'{}'
+    response = client.get('/data', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers and response.data == b'{}'
+
+
+def test_gzip_when_brotli_is_missing(monkeypatch, client):
+    monkeypatch.setattr(responses, 'brotli', None)
+    response = client.get('/data', headers={'Accept-Encoding': 'br, gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    response = client.get('/data', headers={'Accept-Encoding': 'br'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_brotli_preferred_when_installed(client):
+    brotli = pytest.importorskip('brotli')
+    response = client.get('/data', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.data) == BIG
+
+
+def test_least_recently_used_entry_is_dropped(app, client):
+    for key in ('a', 'b', 'a', 'c'):
+        app.state['key'] = key
+        client.get('/data')
+    assert app.state['builds'] == 3
+    app.state['key'] = 'a'
+    client.get('/data')
+    assert app.state['builds'] == 3
+    app.state['key'] = 'b'
+    client.get('/data')
+    assert app.state['builds'] == 4
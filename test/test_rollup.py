@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from lamn.rollup import Bucket, MetricAggregate, choose_resolution, group_samples
+
+METRICS = ['cpu', 'memory']
+
+
+def test_bucket_state_merges_like_one_batch():
+    rng = np.random.default_rng(1)
+    first, second = rng.uniform(0, 100, (40, 2)), rng.uniform(0, 100, (25, 2))
+    whole = Bucket(METRICS)
+    whole.add(np.vstack([first, second]))
+
+    bucket = Bucket(METRICS)
+    bucket.add(first)
+    # Stored and restored between the two batches, as across write batches and restarts
+    bucket = Bucket.from_state(METRICS, bucket.samples, bucket.state())
+    bucket.add(second)
+    assert bucket.values() == pytest.approx(whole.values())
+
+
+def test_aggregate_ignores_nan():
+    agg = MetricAggregate()
+    agg.add(np.array([1.0, np.nan, 3.0]))
+    assert agg.stats()[:3] == (1.0, 3.0, 2.0)
+    assert MetricAggregate().stats() == (None, None, None, None)
+
+
+def test_p95_within_sketch_accuracy():
+    values = np.arange(1, 1001, dtype=float)
+    agg = MetricAggregate()
+    for batch in np.array_split(values, 7):
+        agg.add(batch)
+    assert agg.quantile(0.95) == pytest.approx(np.quantile(values, 0.95), rel=0.01)
+
+
+def test_group_samples_by_key_and_bucket():
+    timestamps = np.array([125.0, 5.0, 65.0, 10.0, 70.0])
+    keys = np.array([1, 1, 1, 2, 1])
+    groups = [(key, start, indices.tolist()) for key, start, indices in group_samples(timestamps, keys, 60)]
+    assert groups == [(1, 0.0, [1]), (1, 60.0, [2, 4]), (1, 120.0, [0]), (2, 0.0, [3])]
+
+
+def test_choose_resolution():
+    assert choose_resolution(0, 600) == 0
+    assert choose_resolution(0, 86400) == 900
+    assert choose_resolution(0, 365 * 86400) == 3600
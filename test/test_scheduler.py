@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+from lamn.scheduler import PollScheduler
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def scheduler(clock, **kwargs):
+    kwargs.setdefault('interval', 100)
+    kwargs.setdefault('max_backoff', 1000)
+    return PollScheduler(clock=clock, **kwargs)
+
+
+def poll(schedule, clock, ip):
+    """Advance the clock to the agent's next poll and hand it out."""
+    clock.now = schedule.snapshot()[ip]['next_due']
+    assert schedule.pop_due() == [ip]
+
+
+def test_first_polls_are_spread_over_the_interval(clock):
+    random.seed(1)
+    schedule = scheduler(clock)
+    schedule.sync([f'10.0.0.{i}' for i in range(50)])
+    due = [entry['next_due'] - clock.now for entry in schedule.snapshot().values()]
+    assert all(0 <= offset <= 100 for offset in due)
+    assert max(due) - min(due) > 50
+
+
+def test_failures_back_off_exponentially_up_to_the_cap(clock):
+    random.seed(2)
+    schedule = scheduler(clock, jitter=0)
+    schedule.sync(['a'])
+    delays = []
+    for _ in range(6):
+        poll(schedule, clock, 'a')
+        schedule.record('a', False, 'timeout')
+        delays.append(schedule.snapshot()['a']['next_due'] - clock.now)
+    assert delays == pytest.approx([200, 400, 800, 1000, 1000, 1000])
+    assert schedule.snapshot()['a']['failures'] == 6
+
+    # The next success resets the backoff
+    poll(schedule, clock, 'a')
+    schedule.record('a', True)
+    entry = schedule.snapshot()['a']
+    assert entry['failures'] == 0 and entry['last_error'] is None
+    assert entry['next_due'] - clock.now == pytest.approx(100)
+
+
+def test_jitter_stays_within_bounds(clock):
+    random.seed(3)
+    schedule = scheduler(clock, jitter=0.1)
+    schedule.sync(['a'])
+    capped = set()
+    for failures in range(1, 31):
+        poll(schedule, clock, 'a')
+        schedule.record('a', False, 'timeout')
+        delay = schedule.snapshot()['a']['next_due'] - clock.now
+        expected = min(100 * 2 ** failures, 1000)
+        assert 0.9 * expected <= delay <= 1.1 * expected
+        if expected == 1000:
+            capped.add(delay)
+    assert len(capped) > 10  # jittered, not one fixed delay
+
+
+def test_success_keeps_a_fixed_rate(clock):
+    schedule = scheduler(clock, jitter=0)
+    schedule.sync(['a'])
+    poll(schedule, clock, 'a')
+    due = clock.now
+    clock.now += 7  # the poll took 7 seconds
+    schedule.record('a', True)
+    assert schedule.snapshot()['a']['next_due'] == due + 100
+
+
+def test_in_flight_agents_are_not_handed_out_twice(clock):
+    schedule = scheduler(clock)
+    schedule.sync(['a'])
+    poll(schedule, clock, 'a')
+    assert schedule.poll_now() == []
+    assert schedule.pop_due(clock.now + 10000) == []
+    schedule.record('a', True)
+    assert schedule.poll_now(['a', 'unknown']) == ['a']
+    assert schedule.pop_due() == ['a']
+
+
+def test_readded_agent_ignores_its_old_schedule(clock):
+    random.seed(4)
+    schedule = scheduler(clock)
+    schedule.sync(['a'])
+    old_due = schedule.snapshot()['a']['next_due']
+    schedule.sync([])
+    clock.now += 500
+    schedule.sync(['a'])
+    assert schedule.snapshot()['a']['next_due'] >= clock.now > old_due
+    # The heap entry left from before the removal must not hand the agent out
+    assert schedule.pop_due() == []
@@ -0,0 +1,218 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from lamn.rollup import TIERS
+from lamn.storage import (CSV_COLUMNS, BatchWriter, CsvStore, SqliteStore, format_timestamp, local_epoch,
+                          parse_timestamp)
+
+T0 = 1700000040  # start of a minute, and of no larger rollup bucket
+
+
+@pytest.fixture
+def timezone(monkeypatch):
+    """Switch the local time zone for one test: timezone('America/Chicago')."""
+    if not hasattr(time, 'tzset'):
+        pytest.skip("time.tzset() is not available")
+
+    def switch(name):
+        monkeypatch.setenv('TZ', name)
+        time.tzset()
+    yield switch
+    monkeypatch.undo()
+    time.tzset()
+
+
+def row(ts, cpu, ip='10.0.0.1'):
+    values = dict.fromkeys(CSV_COLUMNS)
+    values.update(timestamp=ts, ip=ip, hostname='node1', cpu_percent=cpu, memory_percent=50.0)
+    return [values[column] for column in CSV_COLUMNS]
+
+
+# --- Timestamps ---
+
+def test_format_and_parse_round_trip(timezone):
+    timezone('America/Chicago')
+    for ts in (T0, 1710054000, 1730620000):
+        assert parse_timestamp(format_timestamp(ts)) == ts
+
+
+def test_local_epoch_matches_parse_timestamp_across_dst(timezone):
+    timezone('America/Chicago')
+    # Winter (CST), the day DST starts, summer (CDT) and the day it ends
+    texts = ['2024-01-15 12:00:00', '2024-03-10 01:59:59', '2024-03-10 03:00:00',
+             '2024-07-01 08:30:00', '2024-11-03 00:30:00', '2024-11-03 02:30:00']
+    epochs = local_epoch(pd.Series(texts))
+    assert epochs.tolist() == [parse_timestamp(text) for text in texts]
+    # One hour of wall clock time apart in summer is 3600 seconds apart
+    summer = local_epoch(pd.Series(['2024-07-01 08:00:00', '2024-07-01 09:00:00']))
+    assert summer.diff().iloc[1] == 3600
+    assert parse_timestamp('2024-07-01 12:00:00') - parse_timestamp('2024-01-01 12:00:00') == 182 * 86400 - 3600
+
+
+# --- Batch writer ---
+
+class Sink:
+    """Records the batches handed to it; fail makes the next write raise."""
+
+    def __init__(self):
+        self.batches = []
+        self.flushes = 0
+        self.fail = False
+        self.written = threading.Event()
+
+    def write_rows(self, rows):
+        if self.fail:
+            self.fail = False
+            raise OSError("disk full")
+        self.batches.append(list(rows))
+        self.written.set()
+
+    def flush(self):
+        self.flushes += 1
+
+
+@pytest.fixture
+def sink():
+    return Sink()
+
+
+def test_flushes_a_full_batch_without_waiting(sink):
+    writer = BatchWriter(sink, max_batch=3, max_delay=30)
+    started = time.monotonic()
+    for i in range(3):
+        writer.put([row(T0 + i, 1.0)])
+    assert sink.written.wait(5)
+    assert time.monotonic() - started < 5
+    assert [len(batch) for batch in sink.batches] == [3]
+    assert sink.flushes == 1 and writer.rows_written == 3
+    writer.stop()
+
+
+def test_flushes_a_partial_batch_after_the_delay(sink):
+    writer = BatchWriter(sink, max_batch=1000, max_delay=0.2)
+    writer.put([row(T0, 1.0), row(T0 + 1, 2.0)])
+    assert not sink.written.wait(0.05)
+    assert sink.written.wait(5)
+    assert sink.batches == [[row(T0, 1.0), row(T0 + 1, 2.0)]]
+    writer.stop()
+
+
+def test_stop_flushes_the_queued_rows(sink):
+    writer = BatchWriter(sink, max_batch=1000, max_delay=60)
+    writer.put([row(T0, 1.0)])
+    writer.put([row(T0 + 1, 2.0)])
+    started = time.monotonic()
+    writer.stop()
+    assert time.monotonic() - started < 5
+    assert sink.batches == [[row(T0, 1.0), row(T0 + 1, 2.0)]]
+    assert writer.queue_depth == 0
+
+
+def test_keeps_writing_after_a_failed_batch(sink):
+    writer = BatchWriter(sink, max_batch=1, max_delay=0)
+    sink.fail = True
+    writer.put([row(T0, 1.0)])
+    writer.put([row(T0 + 1, 2.0)])
+    writer.stop()
+    assert sink.batches == [[row(T0 + 1, 2.0)]]
+    assert writer.rows_written == 1
+
+
+# --- SQLite store ---
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteStore(str(tmp_path / 'metrics.db'))
+    store.open()
+    yield store
+    store.close()
+
+
+def test_duplicate_samples_are_ignored(store):
+    rows = [row(T0 + i, float(i)) for i in range(10)]
+    assert store.write_rows(rows) == 10
+    assert store.write_rows(rows + [row(T0 + 10, 10.0)]) == 1
+    assert len(store.query()) == 11
+    assert minute_rollup(store)['samples'] == 11
+
+
+def test_query_filters_and_keeps_the_newest(store):
+    store.write_rows([row(T0 + i, float(i), ip=f'10.0.0.{1 + i % 2}') for i in range(10)])
+    df = store.query(start=T0 + 2, end=T0 + 7, hosts=['10.0.0.1'])
+    assert df['cpu_percent'].tolist() == [2.0, 4.0, 6.0]
+    assert store.query(limit=3)['cpu_percent'].tolist() == [7.0, 8.0, 9.0]
+
+
+# --- Rollups ---
+
+def minute_rollup(store):
+    resolution, df = store.query_range(T0, T0 + 59, resolution=TIERS[0])
+    assert resolution == TIERS[0] and len(df) == 1
+    return df.iloc[0]
+
+
+def test_rollup_merges_batches(store):
+    values = [float(i % 17) for i in range(60)]
+    assert store.write_rows([row(T0 + i, v) for i, v in enumerate(values[:25])]) == 25
+    assert store.write_rows([row(T0 + 25 + i, v) for i, v in enumerate(values[25:])]) == 35
+    bucket = minute_rollup(store)
+    assert bucket['samples'] == 60
+    assert bucket['cpu_percent'] == pytest.approx(sum(values) / 60)
+    assert (bucket['cpu_percent_min'], bucket['cpu_percent_max']) == (0.0, 16.0)
+    assert bucket['cpu_percent_p95'] == pytest.approx(15.0, rel=0.02)
+
+
+def test_rollup_keeps_merging_after_reopen(tmp_path):
+    path = str(tmp_path / 'metrics.db')
+    store = SqliteStore(path)
+    store.write_rows([row(T0 + i, 10.0) for i in range(30)])
+    store.close()
+    store = SqliteStore(path)
+    store.write_rows([row(T0 + 30 + i, 20.0) for i in range(30)])
+    bucket = minute_rollup(store)
+    store.close()
+    assert bucket['samples'] == 60
+    assert bucket['cpu_percent'] == pytest.approx(15.0)
+    assert (bucket['cpu_percent_min'], bucket['cpu_percent_max']) == (10.0, 20.0)
+
+
+def test_rollup_skips_missing_values(store):
+    store.write_rows([row(T0 + i, None if i % 2 else 30.0) for i in range(10)])
+    bucket = minute_rollup(store)
+    assert bucket['samples'] == 10
+    assert bucket['cpu_percent'] == 30.0
+    assert pd.isna(bucket['net_rx_bps'])
+
+
+@pytest.mark.parametrize('tier', TIERS)
+def test_csv_and_sqlite_rollups_share_buckets(tmp_path, store, timezone, tier):
+    # Half an hour off UTC: local hours are not epoch hours
+    timezone('Asia/Kolkata')
+    csv_store = CsvStore(str(tmp_path / 'metrics.csv'))
+    rows = [row(T0 + i * 300, float(i)) for i in range(48)]
+    csv_store.write_rows(rows)
+    csv_store.close()
+    store.write_rows(rows)
+    end = T0 + 48 * 300
+    columns = ['timestamp', 'samples', 'cpu_percent', 'cpu_percent_min', 'cpu_percent_max']
+    _, from_csv = csv_store.query_range(T0 + 1000, end, resolution=tier)
+    _, from_sqlite = store.query_range(T0 + 1000, end, resolution=tier)
+    assert from_csv[columns].values.tolist() == from_sqlite[columns].values.tolist()
+
+
+# --- Range queries ---
+
+@pytest.mark.parametrize('agg, expected', [('max', [5.0, 11.0]), ('mean', [2.5, 8.5]), ('count', [6, 6])])
+def test_csv_and_sqlite_aggregate_alike(tmp_path, store, agg, expected):
+    rows = [row(T0 + i * 10, float(i)) for i in range(12)]
+    csv_store = CsvStore(str(tmp_path / 'metrics.csv'))
+    csv_store.write_rows(rows)
+    csv_store.close()
+    store.write_rows(rows)
+    for source in (csv_store, store):
+        df = source.aggregate(T0, T0 + 120, metrics=['cpu_percent'], bucket=60, agg=agg)
+        assert df['ts'].tolist() == [T0, T0 + 60]
+        assert df['cpu_percent'].tolist() == expected